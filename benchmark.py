@@ -0,0 +1,235 @@
+#!/usr/bin/python
+"""Measures how generate_homeassistant_mqtt scales with the device count.
+
+Synthesizes domoticz device lists covering every device class the generator
+handles, runs the generation pipeline on each of them in a fresh process and
+reports wall time, peak memory and the time spent in every stage.
+
+Serializer backends are compared with eg --generator_args="--yaml_backend fast".
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_homeassistant_mqtt as gen
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark generate_homeassistant_mqtt on synthetic devices')
+parser.add_argument(
+    '--sizes', dest='sizes', default='100,1000,10000,50000',
+    help='Comma separated device counts to benchmark.')
+parser.add_argument(
+    '--seed', dest='seed', default=1, type=int,
+    help='Seed for the synthetic device lists.')
+parser.add_argument(
+    '--json', dest='json', default=False, action='store_true',
+    help='Print the results as json instead of a table.')
+parser.add_argument(
+    '--generator_args', dest='generator_args', default='',
+    help='Extra generate_homeassistant_mqtt arguments, eg "--routing topic".')
+parser.add_argument(
+    '--pipeline', dest='pipeline', default='streamed',
+    choices=['staged', 'streamed'],
+    help='staged builds every output in memory before writing them, like '
+    '--watch does. streamed writes entities as they are generated, like a '
+    'one-shot run does.')
+parser.add_argument(
+    '--size', dest='size', default=None, type=int, help=argparse.SUPPRESS)
+
+
+# The stages every pipeline times, and so the columns of its table.
+STAGES = {
+    'staged': ['fetch', 'gen', 'groups', 'dump', 'write'],
+    'streamed': ['fetch', 'stream'],
+}
+
+# (Type, SubType, SwitchType, extra fields) for every class the generator
+# knows about, plus a few it skips, so the skipping paths get exercised too.
+DEVICE_CLASSES = [
+    ('Light/Switch', 'Switch', 'On/Off', {'Status': 'On', 'Data': 'On'}),
+    ('Light/Switch', 'Switch', 'Dimmer',
+     {'Status': 'Set Level: 40 %', 'Data': 'Set Level: 40 %', 'Level': 40}),
+    ('Light/Switch', 'Switch', 'Push On Button', {'Status': 'Off', 'Data': 'Off'}),
+    ('Light/Switch', 'Switch', 'Motion Sensor', {'Status': 'Off', 'Data': 'Off'}),
+    ('Light/Switch', 'Switch', 'Door Contact', {'Status': 'Open', 'Data': 'Open'}),
+    ('Light/Switch', 'Switch', 'Contact', {'Status': 'Closed', 'Data': 'Closed'}),
+    ('Light/Switch', 'Switch', 'Door Lock', {'Status': 'Locked', 'Data': 'Locked'}),
+    ('Light/Switch', 'Switch', 'Doorbell', {'Status': 'Off', 'Data': 'Off'}),
+    ('Temp', 'LaCrosse TX3', None, {'Temp': 21.5, 'Data': '21.5 C'}),
+    ('Temp + Humidity', 'THGN122/123', None,
+     {'Temp': 20.1, 'Humidity': 45, 'Data': '20.1 C, 45 %'}),
+    ('Temp + Humidity + Baro', 'BTHR918N', None,
+     {'Temp': 19.0, 'Humidity': 50, 'Barometer': 1012,
+      'Data': '19.0 C, 50 %, 1012 hPa'}),
+    ('Wind', 'WTGR800', None,
+     {'Direction': 180.0, 'DirectionStr': 'S', 'Speed': '1.2', 'Gust': '3.4',
+      'Temp': 11.0, 'Chill': 10.5, 'Data': '180;S;12;34;11.0;10.5'}),
+    ('Humidity', 'LaCrosse TX3', None, {'Humidity': 55, 'Data': 'Humidity 55 %'}),
+    ('Temp + Baro', 'BMP085', None,
+     {'Temp': 22.0, 'Barometer': 1000, 'Data': '22.0 C, 1000 hPa'}),
+    ('General', 'kWh', None,
+     {'Usage': '301.6 Watt', 'CounterToday': '3.1 kWh', 'Data': '5123.456 kWh'}),
+    ('P1 Smart Meter', 'Gas', None, {'Data': '123.4'}),
+    ('General', 'Percentage', None, {'Data': '12%'}),
+]
+
+# The devices of one zwave thermostat, keyed by the last digit of their ID.
+THERMOSTAT_DEVICES = [
+    ('1', 'Thermostat', 'SetPoint', 'Setpoint', {'SetPoint': '70.0'}),
+    ('2', 'Thermostat', 'SetPoint', 'Heating 1', {'SetPoint': '68.0'}),
+    ('3', 'Thermostat', 'SetPoint', 'Econ Heat', {'SetPoint': '60.0'}),
+    ('4', 'General', 'Thermostat Mode', 'Mode',
+     {'Modes': '0;Off;1;Heat;2;Cool;3;Auto;4;Aux Heat;', 'Mode': 1,
+      'Data': 'Heat'}),
+    ('5', 'General', 'Thermostat Fan Mode', 'Fan Mode',
+     {'Modes': '0;Auto Low;1;On Low;', 'Mode': 0, 'Data': 'Auto Low'}),
+    ('6', 'Temp', 'LaCrosse TX3', 'Temperature', {'Temp': 20.0}),
+    ('7', 'General', 'Thermostat Operating State', 'Operating State',
+     {'Mode': 2, 'Data': 'Heating'}),
+]
+
+HARDWARE = [
+    (1, 'ZStick', 'OpenZWave USB'), (2, 'RFX', 'RFXCOM - RFXtrx433 USB'),
+    (3, 'Hue', 'Philips Hue Bridge'), (4, 'Dummy', 'Dummy')]
+
+
+def SynthesizeDevices(count, seed=1):
+  """Returns a /json.htm?type=devices style response with count devices."""
+  rand = random.Random(seed)
+  devices = []
+  # One thermostat per 200 devices. Their two digit ID prefixes are A0 to FF,
+  # other devices get IDs starting with a digit, so they never match.
+  thermostats = min(count // 200, 96)
+  for t in range(thermostats):
+    hw_id, hw_name, hw_type = HARDWARE[0]
+    for suffix, dev_type, sub_type, name, extra in THERMOSTAT_DEVICES:
+      dev = {
+          'idx': str(len(devices) + 1), 'ID': '0{:02X}0{}'.format(0xa0 + t, suffix),
+          'Name': 'Zone {} {}'.format(t, name), 'Type': dev_type,
+          'SubType': sub_type, 'Used': 1, 'HardwareID': hw_id,
+          'HardwareName': hw_name, 'HardwareType': hw_type,
+          'PlanIDs': [t % 8], 'LastUpdate': '2024-01-01 00:00:00'}
+      dev.update(extra)
+      devices.append(dev)
+  while len(devices) < count:
+    dev_type, sub_type, switch_type, extra = rand.choice(DEVICE_CLASSES)
+    hw_id, hw_name, hw_type = rand.choice(HARDWARE)
+    idx = len(devices) + 1
+    dev = {
+        'idx': str(idx), 'ID': '{:07X}'.format(0x1000000 + idx),
+        'Name': '{} {}'.format(switch_type or dev_type, idx), 'Type': dev_type,
+        'SubType': sub_type, 'Used': 0 if rand.random() < 0.05 else 1,
+        'HardwareID': hw_id, 'HardwareName': hw_name, 'HardwareType': hw_type,
+        'PlanIDs': [rand.randrange(8)], 'LastUpdate': '2024-01-01 00:00:00'}
+    if switch_type:
+      dev['SwitchType'] = switch_type
+    dev.update(extra)
+    devices.append(dev)
+  devices.sort(key=lambda d: d['Name'])
+  return {'status': 'OK', 'title': 'Devices', 'ActTime': 1704067200,
+          'result': devices}
+
+
+def RunStages(input_json, out_dir, generator_args, pipeline):
+  """Runs the generation pipeline once, returning the seconds per stage.
+
+  The streamed pipeline generates, dumps and writes in one go, so all of that
+  is reported as the stream stage.
+  """
+  argv = ['--input_json', input_json] + generator_args
+  for name in ['automation', 'binary_sensor', 'climate', 'group', 'light',
+               'lock', 'power', 'sensor']:
+    argv.extend(['--{}_dir'.format(name), os.path.join(out_dir, name)])
+  argv.extend(['--shard_dir', os.path.join(out_dir, 'shards')])
+  gen.args = gen.parser.parse_args(argv)
+  paths = {
+      'automation': ('automation', gen.args.automation_file, 'alias'),
+      'light': ('light', gen.args.light_file, 'name'),
+      'binary_sensor': ('binary_sensor', gen.args.binary_sensor_file, 'name'),
+      'sensor': ('sensor', gen.args.sensor_file, 'name'),
+      'power': ('sensor', gen.args.power_file, 'name'),
+      'utility': ('power', gen.args.power_file, '____'),
+      'climate': ('climate', gen.args.climate_file, 'platform'),
+      'lock': ('lock', gen.args.lock_file, 'name'),
+      'group': ('group', gen.args.group_file, '____'),
+  }
+  paths = {k: (os.path.join(out_dir, d, f), delim)
+           for k, (d, f, delim) in paths.items()}
+  times = {}
+
+  def Timed(stage, func, *func_args):
+    start = time.perf_counter()
+    result = func(*func_args)
+    times[stage] = times.get(stage, 0) + time.perf_counter() - start
+    return result
+
+  views = Timed('fetch', gen.GetDeviceViews, None)
+  if pipeline == 'streamed':
+    Timed('stream', gen.StreamOutputs, views, paths, gen.args.fahrenheit)
+    return times
+  generator = gen.ConfigGenerator(to_f=gen.args.fahrenheit)
+  Timed('gen', generator.Load, views)
+  names = [n for n in gen.OUTPUT_NAMES if n != 'group']
+  outputs = Timed('gen', generator.Outputs, names)
+  outputs.update(Timed('groups', generator.Outputs, ['group']))
+  for name, (path, delimitor_line) in paths.items():
+    Timed('dump', gen.DumpAndSpaceYaml, outputs[name], delimitor_line)
+  Timed('write', gen.WriteOutputs, outputs, paths)
+  return times
+
+
+def RunSize(size, seed, generator_args, pipeline):
+  with tempfile.TemporaryDirectory() as tmp:
+    input_json = os.path.join(tmp, 'devices.json')
+    with open(input_json, 'w') as f:
+      json.dump(SynthesizeDevices(size, seed), f)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+      times = RunStages(input_json, tmp, generator_args, pipeline)
+    wall = time.perf_counter() - start
+  # ru_maxrss is in kilobytes on linux.
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+  return {'size': size, 'wall': wall, 'peak_bytes': peak, 'stages': times}
+
+
+def main():
+  args = parser.parse_args()
+  generator_args = args.generator_args.split()
+  if args.size is not None:
+    json.dump(RunSize(args.size, args.seed, generator_args, args.pipeline),
+              sys.stdout)
+    return
+  results = []
+  for size in [int(s) for s in args.sizes.split(',')]:
+    # A process per size, so peak memory is not inherited from the last one.
+    out = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--size', str(size),
+        '--seed', str(args.seed), '--pipeline', args.pipeline,
+        '--generator_args=' + args.generator_args])
+    results.append(json.loads(out.decode('utf-8')))
+    if not args.json:
+      r = results[-1]
+      stages = STAGES[args.pipeline]
+      if len(results) == 1:
+        print('{:>8} {:>9} {:>9} '.format('devices', 'wall s', 'peak MB') +
+              ' '.join('{:>9}'.format(s) for s in stages))
+      print('{:>8} {:>9.3f} {:>9.1f} '.format(
+          r['size'], r['wall'], r['peak_bytes'] / 1e6) +
+            ' '.join('{:>9.3f}'.format(r['stages'][s]) for s in stages))
+  if args.json:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,865 @@
+"""The bridge and transport side of generate_homeassistant_mqtt.
+
+Clients for the domoticz json api and for mqtt, the translators that turn
+domoticz/out messages into the status topics of the generated entities, and
+what the bridge keeps around them: the energy totals, the state cache, the
+command pipeline and the worker processes. Nothing here reads the command
+line, the script hands everything in.
+"""
+
+import asyncio
+import collections
+import functools
+import gzip
+import http.client
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+
+THERMOSTAT_STATES = {'0': 'off', '1': 'cooling', '2': 'heating'}
+
+
+# The utility_meter cycles kWh meters are totalled over, see --energy.
+ENERGY_CYCLES = ['hourly', 'daily', 'weekly', 'monthly', 'quarterly']
+
+
+class DomoticzError(OSError):
+  """Domoticz refused a request, or could not be reached within the retries."""
+
+
+class DomoticzClient(object):
+  """Talks to the domoticz json api over a pool of kept alive connections.
+
+  Responses are requested gzipped. Requests failing on the connection, by
+  timing out or with a server error are retried with exponential backoff,
+  after that Get raises DomoticzError. Get may be called from several
+  threads at once, see FetchAll, each request gets a connection of its own.
+  """
+
+  def __init__(self, host, timeout=10, retries=3, connections=4, backoff=1.0):
+    self.host = host
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self._idle = []
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(connections)
+
+  def _Connection(self):
+    """Returns (connection, whether it was used before)."""
+    with self._lock:
+      if self._idle:
+        return self._idle.pop(), True
+    return http.client.HTTPConnection(self.host, timeout=self.timeout), False
+
+  def _Request(self, path):
+    conn, reused = self._Connection()
+    try:
+      conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+      resp = conn.getresponse()
+      body = resp.read()
+    except (OSError, http.client.HTTPException):
+      conn.close()
+      if not reused:
+        raise
+      # Domoticz may have closed the connection while it was idle.
+      return self._Request(path)
+    if resp.will_close:
+      conn.close()
+    else:
+      with self._lock:
+        self._idle.append(conn)
+    if resp.status >= 500:
+      raise http.client.HTTPException('HTTP {} {}'.format(resp.status, resp.reason))
+    if resp.status != 200:
+      raise DomoticzError('{}: HTTP {} {}'.format(path, resp.status, resp.reason))
+    if resp.getheader('Content-Encoding') == 'gzip':
+      body = gzip.decompress(body)
+    return body
+
+  def Get(self, params):
+    """Requests /json.htm with the given query parameters, returns the json."""
+    path = '/json.htm?' + urllib.parse.urlencode(params)
+    delay = self.backoff
+    attempts = max(self.retries, 0) + 1
+    for attempt in range(attempts):
+      if attempt:
+        time.sleep(delay)
+        delay *= 2
+      try:
+        with self._slots:
+          return json.loads(self._Request(path).decode('utf-8'))
+      except DomoticzError:
+        raise
+      except (OSError, http.client.HTTPException, ValueError) as e:
+        error = e
+    raise DomoticzError('{} failed {} times, last with: {!r}'.format(
+        path, attempts, error))
+
+
+def FloatFilter(value):
+  """Mirrors jinja's float filter, which turns bad input into 0.0."""
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return 0.0
+
+
+def ToF(value):
+  return FloatFilter(value) * 1.8 + 32
+
+
+# The translators turn a decoded domoticz/out message into the payload of a
+# status topic, doing what the payload_template of the matching automation
+# does. Those taking a temperature conversion (FloatFilter or ToF) or a mode
+# map first get it bound once per table in GenTranslators, so translating a
+# message is a dict lookup and some arithmetic.
+
+def TranslateBinarySensor(msg):
+  return 'ON' if msg['nvalue'] == 1 else 'OFF'
+
+
+def TranslateLock(msg):
+  return '{"state": "LOCK" }' if msg['nvalue'] == 1 else '{"state": "UNLOCK" }'
+
+
+def TranslateLight(msg):
+  if msg['nvalue'] not in (0, 1):
+    return None
+  return '{ "state": "off" }' if msg['nvalue'] == 0 else '{ "state": "on" }'
+
+
+def TranslateDimmer(msg):
+  if msg['nvalue'] != 2:
+    return None
+  # Two spaces, like the template leaves around its {% endwith %}.
+  return '{{"state": "on", "brightness": {}  }}'.format(
+      int(FloatFilter(msg['svalue1']) * 2.55))
+
+
+def TranslateUtilitySensor(msg):
+  return '{{"kwh": {}, "watts": {} }}'.format(
+      FloatFilter(msg['svalue2']) / 1000, msg['svalue1'])
+
+
+def TranslateTemp(temp, msg):
+  return '{{"temperature": {} }}'.format(temp(msg['svalue1']))
+
+
+def TranslateTempHumidity(temp, msg):
+  return '{{"temperature": {}, "humidity": {} }}'.format(
+      temp(msg['svalue1']), msg['svalue2'])
+
+
+def TranslateTempHumidityBaro(temp, msg):
+  return '{{"temperature": {}, "humidity": {}, "barometer": {} }}'.format(
+      temp(msg['svalue1']), msg['svalue2'], msg['svalue4'])
+
+
+def TranslateWind(temp, msg):
+  return ('{{"windspeed": {}, "windgust": {}, "windchill": {}, '
+          '"direction": "{}" }}').format(
+              msg['svalue3'], msg['svalue4'], temp(msg['svalue6']),
+              msg['svalue2'])
+
+
+def TranslateClimateTemp(temp, msg):
+  return str(temp(msg['svalue1']))
+
+
+def TranslateClimateTarget(temp, max_temp, msg):
+  ctof = temp(msg['svalue1'])
+  return str(FloatFilter(msg['svalue1']) if ctof > max_temp else ctof)
+
+
+def TranslateMode(modes, msg):
+  return modes.get(str(msg['nvalue']), '')
+
+
+# SwitchType -> [(status topic kind, translator)] of the switches.
+SWITCH_TRANSLATORS = {
+    'Motion Sensor': [('sensor', TranslateBinarySensor)],
+    'Door Contact': [('sensor', TranslateBinarySensor)],
+    'Contact': [('sensor', TranslateBinarySensor)],
+    'On/Off': [('light', TranslateLight)],
+    'Push On Button': [('light', TranslateLight)],
+    'Dimmer': [('light', TranslateLight), ('light', TranslateDimmer)],
+    'Door Lock': [('lock', TranslateLock)],
+}
+# Type -> translator of the temperature sensors.
+TEMP_TRANSLATORS = {
+    'Temp': TranslateTemp,
+    'Temp + Humidity': TranslateTempHumidity,
+    'Temp + Humidity + Baro': TranslateTempHumidityBaro,
+    'Wind': TranslateWind,
+}
+TRANSLATE_THERMOSTAT_STATE = functools.partial(TranslateMode, THERMOSTAT_STATES)
+
+
+def TranslateMessage(table, payload):
+  """Yields (topic, payload) for every status topic a domoticz/out message updates."""
+  try:
+    msg = json.loads(payload)
+    translators = table.get(msg['idx'], ())
+  except (ValueError, KeyError, TypeError):
+    return ()
+  return Translate(translators, msg)
+
+
+def Translate(translators, msg):
+  for topic, translator in translators:
+    try:
+      out = translator(msg)
+    except (KeyError, IndexError, TypeError, ValueError):
+      continue
+    except Exception as e:
+      # A failing translator costs its topic, not the mqtt connection.
+      print('Translating {} failed ({!r})'.format(topic, e))
+      continue
+    if out is not None:
+      yield topic, out
+
+
+# Switch statuses domoticz sends as nvalue 1.
+ON_STATUSES = ['On', 'Open', 'Locked']
+
+
+def _Number(value):
+  """The number in a formatted value such as "301.6 Watt" or "5123.456 kWh"."""
+  return FloatFilter(str(value).split(' ')[0])
+
+
+def DeviceStateMessage(dev):
+  """Rebuilds the domoticz/out message for a /json.htm?type=devices entry.
+
+  The device list has the states formatted for display, this maps them back to
+  the nvalue and svalueN fields the translators read. Wind speeds are assumed
+  to be in m/s, domoticz's default, as domoticz/out has them in 0.1 m/s.
+  """
+  msg = {'idx': int(dev.idx), 'nvalue': 0}
+  svalues = []
+  if dev.SwitchType is not None:
+    status = dev.Get('Status', '')
+    if status.startswith('Set Level'):
+      msg['nvalue'] = 2
+    elif status in ON_STATUSES:
+      msg['nvalue'] = 1
+    svalues = [dev.Get('Level', 0)]
+  elif dev.Mode is not None:
+    msg['nvalue'] = int(dev.Mode)
+  elif dev.SetPoint is not None:
+    svalues = [dev.SetPoint]
+  elif dev.Type == 'Wind':
+    svalues = [
+        dev.Get('Direction', 0), dev.Get('DirectionStr', ''),
+        int(round(_Number(dev.Get('Speed', 0)) * 10)),
+        int(round(_Number(dev.Get('Gust', 0)) * 10)),
+        dev.Get('Temp', 0), dev.Get('Chill', 0)]
+  elif dev.SubType == 'kWh':
+    svalues = [_Number(dev.Get('Usage', 0)), _Number(dev.Get('Data', 0)) * 1000]
+  elif dev.Type == 'Temp + Baro':
+    svalues = [dev.Get('Temp', 0), dev.Get('Barometer', 0)]
+  elif dev.Temp is not None or dev.Humidity is not None:
+    svalues = [
+        dev.Get('Temp', 0), dev.Get('Humidity', 0),
+        dev.Get('HumidityStatus', ''), dev.Get('Barometer', 0)]
+  for i, value in enumerate(svalues):
+    msg['svalue{}'.format(i + 1)] = str(value)
+  return msg
+
+
+def EnergyPeriods(now):
+  """The period of every ENERGY_CYCLES cycle the time now is in, local time."""
+  tm = time.localtime(now)
+  return {
+      'hourly': time.strftime('%Y-%m-%d %H', tm),
+      'daily': time.strftime('%Y-%m-%d', tm),
+      'weekly': time.strftime('%G-W%V', tm),
+      'monthly': time.strftime('%Y-%m', tm),
+      'quarterly': '{}-Q{}'.format(tm.tm_year, (tm.tm_mon + 2) // 3),
+  }
+
+
+class EnergyTotals(object):
+  """Totals the consumption of kWh meters per ENERGY_CYCLES cycle.
+
+  Does what a utility_meter per meter and cycle does in home assistant, for
+  all cycles of a meter at once: every cycle remembers the period it is in
+  and the meter reading it started at. When a reading falls in a new period,
+  that period starts at the reading before it. A reading below the last one
+  is a reset meter, the totals carry on from there.
+  The state is kept in path, if given, written at most every interval
+  seconds and whenever a period starts. A state that cannot be written is
+  reported and tried again an interval later, the totals carry on. If
+  shared, other processes total other meters into the same path, see
+  --bridge_workers, so only the meters totalled here are written, merged
+  into what the file holds.
+  """
+
+  def __init__(self, path=None, interval=60, clock=time.time, shared=False):
+    self.path = os.path.abspath(path) if path else None
+    self.interval = interval
+    self.shared = shared
+    self._clock = clock
+    # DeviceKey -> {'last': reading, 'periods': {cycle: [period, start]}}
+    self.meters = self._Load()
+    self._updated = set()
+    self._saved = clock()
+    self._dirty = False
+    self._periods = (None, None)  # (minute, EnergyPeriods)
+
+  def _Load(self):
+    if not self.path or not os.path.exists(self.path):
+      return {}
+    with open(self.path, 'rb') as f:
+      return json.loads(f.read().decode('utf-8'))
+
+  def _Periods(self, now):
+    # Periods only start on the minute, so they are worked out once a minute.
+    minute = int(now // 60)
+    if self._periods[0] != minute:
+      self._periods = (minute, EnergyPeriods(now))
+    return self._periods[1]
+
+  def Translate(self, key, msg):
+    """A translator, see GenTranslators, for the meter with DeviceKey key."""
+    reading = FloatFilter(msg['svalue2']) / 1000
+    now = self._clock()
+    periods = self._Periods(now)
+    meter = self.meters.get(key)
+    if meter is None:
+      meter = self.meters[key] = {'last': reading, 'periods': {}}
+    last = meter['last']
+    started = False
+    totals = collections.OrderedDict()
+    for cycle in ENERGY_CYCLES:
+      period, start = meter['periods'].get(cycle, (None, reading))
+      if reading < last:
+        start += reading - last
+      if period != periods[cycle]:
+        started = started or period is not None
+        start = min(last, reading) if period is not None else reading
+      meter['periods'][cycle] = [periods[cycle], start]
+      totals[cycle] = round(reading - start, 3)
+    meter['last'] = reading
+    self._updated.add(key)
+    self._dirty = True
+    if started or now - self._saved >= self.interval:
+      self.Save()
+    return json.dumps(totals)
+
+  def Save(self):
+    """Writes the state, if it changed. Returns whether it is saved."""
+    if not self.path or not self._dirty:
+      return True
+    try:
+      self._Write()
+    except OSError as e:
+      print('Saving the energy totals to {} failed: {}'.format(self.path, e))
+      self._saved = self._clock()
+      return False
+    self._saved = self._clock()
+    self._dirty = False
+    return True
+
+  def _Write(self):
+    lock = None
+    meters = self.meters
+    if self.shared:
+      import fcntl
+      lock = open(self.path + '.lock', 'a')
+      fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      if self.shared:
+        meters = self._Load()
+        meters.update((key, self.meters[key]) for key in self._updated)
+      # Written next to path and renamed over it, so a crash never leaves
+      # half a state behind.
+      fd, tmp_path = tempfile.mkstemp(
+          dir=os.path.dirname(self.path),
+          prefix='.' + os.path.basename(self.path))
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          f.write(json.dumps(meters, sort_keys=True).encode('utf-8'))
+        os.replace(tmp_path, self.path)
+      except BaseException:
+        if os.path.exists(tmp_path):
+          os.unlink(tmp_path)
+        raise
+    finally:
+      if lock:
+        lock.close()
+
+
+class StateCache(object):
+  """Decides which translated states are worth publishing.
+
+  Remembers what was last published to every status topic. A state is
+  dropped if it is the same, or if none of its fields changed by more than
+  its --deadband, or those that did were published less than their
+  --min_interval ago. Json payloads are compared field by field, anything
+  else is a single field named after the last level of the topic.
+  """
+
+  def __init__(self, deadbands=None, min_intervals=None, clock=time.monotonic):
+    self.deadbands = deadbands or {}
+    self.min_intervals = min_intervals or {}
+    self._clock = clock
+    # topic -> (payload, fields, time published)
+    self._last = {}
+    self.published = self.suppressed = 0
+
+  @staticmethod
+  def _Fields(topic, payload):
+    try:
+      value = json.loads(payload)
+    except ValueError:
+      value = payload
+    if isinstance(value, dict):
+      return value
+    return {topic.rsplit('/', 1)[-1]: value}
+
+  def _Changed(self, field, value, last):
+    if value == last:
+      return False
+    deadband = self.deadbands.get(field)
+    if (deadband is not None and
+        isinstance(value, (int, float)) and not isinstance(value, bool) and
+        isinstance(last, (int, float)) and not isinstance(last, bool)):
+      return abs(value - last) > deadband
+    return True
+
+  def Record(self, topic, payload):
+    """Notes payload as published to topic."""
+    self._last[topic] = (payload, self._Fields(topic, payload), self._clock())
+
+  def Check(self, topic, payload):
+    """Returns whether to publish payload to topic, recording it if so."""
+    last = self._last.get(topic)
+    if last is not None:
+      last_payload, last_fields, published = last
+      if payload == last_payload:
+        self.suppressed += 1
+        return False
+      fields = self._Fields(topic, payload)
+      age = self._clock() - published
+      if fields.keys() == last_fields.keys() and not any(
+          self._Changed(field, value, last_fields[field]) and
+          age >= self.min_intervals.get(field, 0)
+          for field, value in fields.items()):
+        self.suppressed += 1
+        return False
+    self.Record(topic, payload)
+    self.published += 1
+    return True
+
+  def Clear(self):
+    self._last.clear()
+
+
+# The CommandPipeline queue of the scene commands, apart from any hardware.
+SCENES = object()
+
+
+class CommandPipeline(object):
+  """Coalesces and paces the commands home assistant sends to domoticz.
+
+  Commands are queued per hardware and sent to domoticz/in at its command
+  rate. A command for an idx that already has one of the same kind queued
+  replaces it in place, so a dragged dimmer sends the level it stopped at
+  instead of every step on the way, without losing its place in the queue.
+  Scenes are switched through a queue of their own at the default rate, as
+  their idx is not that of a device and domoticz spreads them over the
+  hardware of their devices itself.
+  """
+
+  def __init__(self, publish, hardware, rates=None, default_rate=0,
+               topic='domoticz/in'):
+    """publish is the client's Publish, hardware maps idx to hardware name."""
+    self._publish = publish
+    self._topic = topic
+    self._hardware = hardware
+    self._rates = rates or {}
+    self._default_rate = default_rate
+    self._queues = {}
+    self._tasks = []
+    self.sent = self.coalesced = 0
+
+  @staticmethod
+  def _Key(payload):
+    try:
+      msg = json.loads(payload)
+      return int(msg['idx']), msg.get('command', 'udevice')
+    except (ValueError, KeyError, TypeError, AttributeError):
+      return None
+
+  def Submit(self, payload):
+    key = self._Key(payload)
+    if key is None:
+      hardware = None
+    elif key[1] == 'switchscene':
+      hardware = SCENES
+    else:
+      hardware = self._hardware.get(key[0])
+    if hardware not in self._queues:
+      self._queues[hardware] = (collections.OrderedDict(), asyncio.Event())
+      self._tasks.append(asyncio.ensure_future(self._Send(hardware)))
+    queue, wake = self._queues[hardware]
+    if key is None:
+      # Not a command we understand, pass it on as it is.
+      key = object()
+    if key in queue:
+      self.coalesced += 1
+    queue[key] = payload
+    wake.set()
+
+  async def _Send(self, hardware):
+    queue, wake = self._queues[hardware]
+    rate = self._rates.get(hardware, self._default_rate)
+    interval = 1.0 / rate if rate > 0 else 0
+    while True:
+      while not queue:
+        wake.clear()
+        await wake.wait()
+      _, payload = queue.popitem(last=False)
+      await self._publish(self._topic, payload)
+      self.sent += 1
+      # What arrives meanwhile is coalesced.
+      await asyncio.sleep(interval)
+
+  def Close(self):
+    for task in self._tasks:
+      task.cancel()
+
+
+class MqttError(Exception):
+  """The broker refused or broke off the MQTT conversation."""
+
+
+class MqttClient(object):
+  """Minimal asyncio MQTT 3.1.1 client.
+
+  Only QoS 0 is supported, which is all the bridge needs, and it keeps the
+  script free of dependencies beyond yaml.
+  """
+
+  def __init__(self, host, port=1883, client_id='domoticz_hass_bridge',
+               username=None, password=None, keepalive=60):
+    self.host = host
+    self.port = port
+    self.client_id = client_id
+    self.username = username
+    self.password = password
+    self.keepalive = keepalive
+    self._reader = self._writer = self._ping_task = None
+    self._packet_id = 0
+
+  @staticmethod
+  def _String(value):
+    if isinstance(value, str):
+      value = value.encode('utf-8')
+    return struct.pack('!H', len(value)) + value
+
+  @staticmethod
+  def _Packet(header, body):
+    length = len(body)
+    encoded = bytearray()
+    while True:
+      byte, length = length % 128, length // 128
+      encoded.append(byte | 0x80 if length else byte)
+      if not length:
+        break
+    return bytes([header]) + bytes(encoded) + body
+
+  async def _ReadPacket(self):
+    header = (await self._reader.readexactly(1))[0]
+    length = shift = 0
+    while True:
+      byte = (await self._reader.readexactly(1))[0]
+      length |= (byte & 0x7f) << shift
+      shift += 7
+      if not byte & 0x80:
+        break
+    body = await self._reader.readexactly(length) if length else b''
+    return header, body
+
+  async def _Ping(self):
+    while True:
+      await asyncio.sleep(self.keepalive / 2)
+      self._writer.write(self._Packet(0xc0, b''))
+
+  async def Connect(self):
+    self._reader, self._writer = await asyncio.open_connection(
+        self.host, self.port)
+    flags = 0x02  # clean session
+    payload = self._String(self.client_id)
+    if self.username is not None:
+      flags |= 0x80
+      payload += self._String(self.username)
+      if self.password is not None:
+        flags |= 0x40
+        payload += self._String(self.password)
+    self._writer.write(self._Packet(0x10, (
+        self._String('MQTT') + struct.pack('!BBH', 4, flags, self.keepalive) +
+        payload)))
+    header, body = await asyncio.wait_for(self._ReadPacket(), self.keepalive)
+    if header >> 4 != 2 or len(body) != 2 or body[1] != 0:
+      raise MqttError('connection refused: {!r}'.format(body))
+    self._ping_task = asyncio.ensure_future(self._Ping())
+
+  async def Subscribe(self, topic):
+    self._packet_id = self._packet_id % 0xffff + 1
+    self._writer.write(self._Packet(0x82, (
+        struct.pack('!H', self._packet_id) + self._String(topic) + b'\x00')))
+    await self._writer.drain()
+
+  async def Unsubscribe(self, topic):
+    """Unsubscribes, dropping the messages still arriving until it is done.
+
+    Not to be used while Messages() is being read.
+    """
+    self._packet_id = self._packet_id % 0xffff + 1
+    packet_id = struct.pack('!H', self._packet_id)
+    self._writer.write(self._Packet(0xa2, packet_id + self._String(topic)))
+    await self._writer.drain()
+    while True:
+      header, body = await asyncio.wait_for(
+          self._ReadPacket(), self.keepalive * 1.5)
+      if header >> 4 == 11 and body[:2] == packet_id:
+        return
+
+  async def Publish(self, topic, payload, retain=False):
+    if isinstance(payload, str):
+      payload = payload.encode('utf-8')
+    self._writer.write(self._Packet(
+        0x31 if retain else 0x30, self._String(topic) + payload))
+    await self._writer.drain()
+
+  async def Messages(self, idle=None):
+    """Yields (topic, payload) for each message received on a subscription.
+
+    With idle, stops once no packet arrived for that many seconds, eg when
+    the retained messages of a subscription are all in. Only publishing is
+    left to do with the client after that.
+    """
+    while True:
+      try:
+        header, body = await asyncio.wait_for(
+            self._ReadPacket(), idle or self.keepalive * 1.5)
+      except asyncio.TimeoutError:
+        if idle:
+          return
+        raise
+      kind = header >> 4
+      if kind == 3:
+        qos = (header >> 1) & 0x03
+        pos = 2 + struct.unpack('!H', body[:2])[0]
+        topic = body[2:pos].decode('utf-8')
+        if qos:
+          if qos == 1:
+            self._writer.write(self._Packet(0x40, body[pos:pos + 2]))
+          pos += 2
+        yield topic, body[pos:]
+      elif kind == 9 and 0x80 in body[2:]:
+        raise MqttError('subscription refused')
+
+  async def Close(self):
+    if self._ping_task:
+      self._ping_task.cancel()
+    if self._writer:
+      try:
+        self._writer.write(self._Packet(0xe0, b''))
+        self._writer.close()
+        await self._writer.wait_closed()
+      except OSError:
+        pass
+    self._reader = self._writer = self._ping_task = None
+
+
+def TopicMatches(pattern, topic):
+  """Whether topic matches an mqtt subscription with + wildcards."""
+  levels = topic.split('/')
+  pattern = pattern.split('/')
+  return len(pattern) == len(levels) and all(
+      p in ('+', level) for p, level in zip(pattern, levels))
+
+
+# Matches the idx of a domoticz/out message without parsing all of it.
+IDX_FIELD = re.compile(rb'"idx"\s*:\s*(\d+)')
+
+
+def WorkerOf(ns, idx, workers):
+  """The --bridge_workers worker that translates the messages of a device.
+
+  Consecutive idxs go to different workers, so a burst of messages from
+  devices added together is spread over all of them.
+  """
+  return (zlib.crc32(ns.encode('utf-8')) + idx) % workers
+
+
+def PartitionTable(table, ns, worker, workers):
+  """The part of a GenTranslators table a worker translates for."""
+  return dict((idx, translators) for idx, translators in table.items()
+              if WorkerOf(ns, idx, workers) == worker)
+
+
+class BridgeWorkers(object):
+  """The --bridge_workers processes RunBridge hands domoticz/out messages to.
+
+  Every device belongs to one worker, see WorkerOf, so its messages are
+  translated and published in the order they arrived. Messages of devices
+  without translators are dropped right away. The others are handed over in
+  batches: whatever the bridge reads in one go is sent once it has to wait
+  for the broker again. A worker busy with a batch does not hold up the
+  bridge, what its pipe does not take yet is written once it does. A worker
+  that stopped is restarted with the batches it did not get.
+  A worker process runs target(*target_args, worker, conn), which receives
+  ('load', fetched) tuples, lists of (namespace, payload) and finally None
+  on conn, see Receive.
+  """
+
+  def __init__(self, count, target, target_args=()):
+    self._context = multiprocessing.get_context('spawn')
+    self._target = target
+    self._target_args = tuple(target_args)
+    self._workers = [None] * count  # (process, connection)
+    self._batches = [[] for _ in range(count)]
+    # Per worker, the frames its pipe did not take yet: [frame, bytes
+    # written, whether it is a batch].
+    self._pending = [collections.deque() for _ in range(count)]
+    self._watching = {}  # worker -> the loop waiting to write to its pipe
+    self._flush = None
+    self._load = None
+    self.known = {}  # namespace -> idxs with translators
+
+  def _Start(self, worker):
+    if self._workers[worker]:
+      self._Unwatch(worker)
+      self._workers[worker][1].close()
+    self._pending[worker].clear()
+    conn, child_conn = self._context.Pipe()
+    process = self._context.Process(
+        target=self._target, args=self._target_args + (worker, child_conn),
+        name='bridge_worker_{}'.format(worker), daemon=True)
+    process.start()
+    child_conn.close()
+    os.set_blocking(conn.fileno(), False)
+    self._workers[worker] = (process, conn)
+    if self._load:
+      self._Send(worker, self._load)
+
+  def _Restart(self, worker):
+    print('Bridge worker {} stopped, restarting it'.format(worker))
+    batches = [frame for frame, _, batch in self._pending[worker] if batch]
+    self._Start(worker)
+    for frame in batches:
+      self._pending[worker].append([frame, 0, True])
+    self._Write(worker)
+
+  def _Send(self, worker, data, batch=False):
+    """Queues data for the worker, framed as Connection.send_bytes does."""
+    pending = self._pending[worker]
+    pending.append([struct.pack('!i', len(data)) + data, 0, batch])
+    if len(pending) == 1:
+      self._Write(worker)
+
+  def _Write(self, worker):
+    """Writes the pending frames of worker as far as its pipe takes them."""
+    conn = self._workers[worker][1]
+    pending = self._pending[worker]
+    try:
+      while pending:
+        frame = pending[0]
+        frame[1] += os.write(conn.fileno(), memoryview(frame[0])[frame[1]:])
+        if frame[1] == len(frame[0]):
+          pending.popleft()
+    except BlockingIOError:
+      pass
+    except OSError:
+      self._Restart(worker)
+      return
+    if not pending:
+      self._Unwatch(worker)
+    elif worker not in self._watching:
+      loop = self._watching[worker] = asyncio.get_running_loop()
+      loop.add_writer(conn.fileno(), self._Write, worker)
+
+  def _Unwatch(self, worker):
+    loop = self._watching.pop(worker, None)
+    if loop:
+      loop.remove_writer(self._workers[worker][1].fileno())
+
+  def Load(self, fetched, tables):
+    """Hands the workers the FetchViews devices the bridge just fetched."""
+    self.known = dict((ns, frozenset(table)) for ns, table in tables.items())
+    self._load = pickle.dumps(('load', fetched), pickle.HIGHEST_PROTOCOL)
+    for worker, running in enumerate(self._workers):
+      if running is None or not running[0].is_alive():
+        self._Start(worker)
+      else:
+        self._Send(worker, self._load)
+
+  def Submit(self, ns, payload):
+    match = IDX_FIELD.search(payload)
+    if not match:
+      return
+    idx = int(match.group(1))
+    if idx not in self.known.get(ns, ()):
+      return
+    self._batches[WorkerOf(ns, idx, len(self._workers))].append((ns, payload))
+    if self._flush is None:
+      self._flush = asyncio.get_running_loop().call_soon(self._Flush)
+
+  def _Flush(self):
+    self._flush = None
+    for worker, batch in enumerate(self._batches):
+      if batch:
+        self._Send(
+            worker, pickle.dumps(batch, pickle.HIGHEST_PROTOCOL), batch=True)
+        del batch[:]
+
+  def Close(self):
+    if self._flush:
+      self._flush.cancel()
+    for worker, running in enumerate(self._workers):
+      if running:
+        self._Unwatch(worker)
+        conn = running[1]
+        try:
+          # Whatever is still pending, then None, which stops the worker.
+          os.set_blocking(conn.fileno(), True)
+          for frame, written, _ in self._pending[worker]:
+            view = memoryview(frame)[written:]
+            while view:
+              view = view[os.write(conn.fileno(), view):]
+          conn.send(None)
+        except OSError:
+          pass
+    for running in self._workers:
+      if running:
+        running[0].join(5)
+        if running[0].is_alive():
+          running[0].terminate()
+
+
+async def Receive(conn):
+  """conn.recv(), waiting for it without blocking the event loop."""
+  if not conn.poll():
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(
+        conn.fileno(), lambda: readable.done() or readable.set_result(None))
+    try:
+      await readable
+    finally:
+      loop.remove_reader(conn.fileno())
+  return conn.recv()
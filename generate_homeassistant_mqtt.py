@@ -1,20 +1,125 @@
 #!/usr/bin/python
 
 import argparse
+import asyncio
 import collections
-import urllib.request as urllib2
+import concurrent.futures
+import functools
+import hashlib
+import io
+import itertools
 import json
 import os
+import re
+import signal
+import sys
+import tempfile
+import time
+import types
 # The above imports are standard. Yaml is not, so we do it in main to
 # kick out a useful error message if it is not found.
 
+# The bridge side, see domoticz_bridge.py.
+from domoticz_bridge import (
+    ENERGY_CYCLES, SWITCH_TRANSLATORS, TEMP_TRANSLATORS, THERMOSTAT_STATES,
+    TRANSLATE_THERMOSTAT_STATE, BridgeWorkers, CommandPipeline,
+    DeviceStateMessage, DomoticzClient, DomoticzError, EnergyTotals,
+    FloatFilter, MqttClient, MqttError, PartitionTable, Receive, StateCache,
+    ToF, TopicMatches, Translate, TranslateClimateTarget, TranslateClimateTemp,
+    TranslateMessage, TranslateMode, TranslateUtilitySensor)
+
+
+def FieldValues(spec):
+  """Parses "field=number,..." arguments into a dict."""
+  values = {}
+  for item in spec.split(','):
+    field, _, value = item.partition('=')
+    try:
+      values[field.strip()] = float(value)
+    except ValueError:
+      raise argparse.ArgumentTypeError(
+          'expected field=number, got {!r}'.format(item))
+  return values
+
+
+def PositiveInt(spec):
+  """Parses a count that has to be at least 1."""
+  try:
+    value = int(spec)
+  except ValueError:
+    value = 0
+  if value < 1:
+    raise argparse.ArgumentTypeError(
+        'expected a whole number of at least 1, got {!r}'.format(spec))
+  return value
+
+
+def NonNegativeInt(spec):
+  """Parses a count that may be 0, but not less."""
+  try:
+    value = int(spec)
+  except ValueError:
+    value = -1
+  if value < 0:
+    raise argparse.ArgumentTypeError(
+        'expected a whole number of at least 0, got {!r}'.format(spec))
+  return value
+
+
+# A domoticz server. Its devices get their idx and names namespaced with the
+# name, if there is one, and its mqtt topics start with topic_prefix.
+Instance = collections.namedtuple('Instance', ['name', 'host', 'topic_prefix'])
+
+
+def Instances(spec):
+  """Parses "[name=]host[@topic prefix],..." arguments into Instances."""
+  instances = []
+  for item in spec.split(','):
+    name, _, host = item.rpartition('=')
+    host, _, prefix = host.partition('@')
+    name, host, prefix = name.strip(), host.strip(), prefix.strip()
+    if not host or not re.match(r'[a-z0-9_]*\Z', name):
+      raise argparse.ArgumentTypeError(
+          'expected [name=]host[@topic prefix], with a name of lower case '
+          'letters, digits and _, got {!r}'.format(item))
+    if not prefix:
+      prefix = 'domoticz/' + name if name else 'domoticz'
+    instances.append(Instance(name, host, prefix))
+  for field in ['name', 'topic_prefix']:
+    values = [getattr(i, field) for i in instances]
+    if len(set(values)) != len(values):
+      raise argparse.ArgumentTypeError(
+          'every domoticz needs a {} of its own, got {!r}'.format(
+              field.replace('_', ' '), spec))
+  return instances
+
 
 parser = argparse.ArgumentParser(
     description='Generate homeassistant mqtt configs for domoticz')
 
 parser.add_argument(
-    '--domoticz_host', dest='host', default='localhost:8080',
-    help='The domoticz host to connect to. EG "192.168.1.5:8080"')
+    '--domoticz_host', dest='host', default='localhost:8080', type=Instances,
+    help='The domoticz host to connect to. EG "192.168.1.5:8080". For '
+         'several, a comma separated list of name=host, eg '
+         '"garage=192.168.1.6:8080,barn=192.168.1.7:8080". Their device '
+         'names get the name in front, their aliases and ids the name and an '
+         '_, and their topics start with domoticz/name instead of domoticz, '
+         'which must match the prefixes set in their MQTT hardware. Another '
+         'topic prefix is given as name=host@prefix. One host may be left '
+         'without a name, it keeps the plain domoticz topics.')
+parser.add_argument(
+    '--http_timeout', dest='http_timeout', default=10, type=float,
+    help='Seconds to wait for domoticz when talking to it.')
+parser.add_argument(
+    '--http_retries', dest='http_retries', default=3,
+    type=NonNegativeInt,
+    help='How often a failed domoticz request is retried, first after a '
+         'second, then waiting twice as long each time.')
+parser.add_argument(
+    '--http_connections', dest='http_connections', default=4,
+    type=PositiveInt,
+    help='Most requests sent to domoticz at once, each over its own kept '
+         'alive connection.')
 
 parser.add_argument(
     '--fahrenheit', '-f', dest='fahrenheit', default=True, action='store_true',
@@ -70,6 +175,13 @@ parser.add_argument(
     '--scene_file', dest='scene_file', default='domoticz_scene.yaml',
     help='Which file to write the generated scene items to.')
 
+parser.add_argument(
+    '--scenes', dest='scenes', default=False, action='store_true',
+    help='Also generate the domoticz scenes, as home assistant scenes, and '
+         'the domoticz groups, as lights. Either is switched with a single '
+         'switchscene command, which domoticz passes on to all of its '
+         'devices. The Lights group becomes the domoticz group with the '
+         'same lights, if there is one. Not read from --input_json.')
 parser.add_argument(
     '--lock_dir', dest='lock_dir', default='lock',
     help='Destination dir for lock file')
@@ -82,7 +194,36 @@ parser.add_argument(
 parser.add_argument(
     '--power_file', dest='power_file', default='domoticz_power.yaml',
     help='Destination dir for power file')
+parser.add_argument(
+    '--shard_by', dest='shard_by', default=None, choices=['plan', 'hardware'],
+    help='Split the entities of every output but the groups into a file per '
+         'domoticz room plan or per hardware, in --shard_dir, so a change '
+         'only rewrites the file of its plan or hardware. The usual output '
+         'file then just includes them. Plan files are named by the plan '
+         'idx, so they stay put when a plan is renamed. Entities of no '
+         'single device, like the climates, go to the domoticz file.')
+parser.add_argument(
+    '--shard_dir', dest='shard_dir', default='domoticz_shards',
+    help='Destination dir for the --shard_by files, with a dir per output.')
 
+parser.add_argument(
+    '--changed_domains_file', dest='changed_domains_file', default=None,
+    help='After writing, store the home assistant domains (automation, '
+         'light, ...) whose files changed in this file, one per line, eg for '
+         'a hook that reloads only those.')
+parser.add_argument(
+    '--yaml_backend', dest='yaml_backend', default='auto',
+    choices=['auto', 'python', 'libyaml', 'fast'],
+    help='How the yaml is written. "libyaml" uses the C emitter, "python" the '
+         'pure python one, "auto" libyaml when pyyaml was built with it. '
+         '"fast" writes the simple entries directly, and the rest as auto '
+         'does. The output is the same with all of them.')
+parser.add_argument(
+    '--yaml_anchors', dest='yaml_anchors', default=False, action='store_true',
+    help='Write repeated parts of the config, like the mqtt triggers and '
+         'conditions, once with a yaml anchor and refer to them with aliases '
+         'after that. Makes the files a lot smaller. The whole file is held '
+         'in memory to find those parts.')
 
 parser.add_argument(
     '--ignore_types', dest='ignore_types',
@@ -90,16 +231,296 @@ parser.add_argument(
 parser.add_argument(
     '--climate_naming_override', dest='climate_names',
     default='50:Downstairs Thermostat,40:Upstairs Thermostat', help='TODO')
+parser.add_argument(
+    '--input_json', dest='input_json', default=None,
+    help='Read the device list from this file, a saved '
+         '/json.htm?type=devices response, instead of asking domoticz. '
+         'In --watch mode the file is re-read on every poll.')
+parser.add_argument(
+    '--server_side_filter', dest='server_side_filter', default=False,
+    action='store_true',
+    help='Let domoticz filter the device list, one request per device type, '
+         'instead of fetching it once and filtering it here.')
+parser.add_argument(
+    '--watch', dest='watch', default=False, action='store_true',
+    help='Keep running, polling domoticz for changed devices and rewriting '
+         'only the files whose entities changed.')
+parser.add_argument(
+    '--watch_interval', dest='watch_interval', default=10, type=float,
+    help='Seconds between polls in --watch mode.')
+parser.add_argument(
+    '--watch_full_refresh', dest='watch_full_refresh', default=3600,
+    type=float,
+    help='Seconds between full device list fetches in --watch mode, which '
+         'pick up deleted devices.')
+parser.add_argument(
+    '--routing', dest='routing', default='payload', choices=['payload', 'topic'],
+    help='How automations pick out their device. "payload" triggers every '
+         'automation on domoticz/out and filters on the idx in the payload. '
+         '"topic" triggers each automation on its own per-idx topic (see '
+         '--idx_topic), so home assistant only evaluates the automations of '
+         'the device that changed.')
+parser.add_argument(
+    '--idx_topic', dest='idx_topic', default='{prefix}/out/{idx}',
+    help='Per device topic domoticz publishes to, used with --routing=topic. '
+         'Must match the publish topic configured on the domoticz MQTT '
+         'hardware. "{idx}" is replaced with the device idx, "{prefix}" with '
+         'the topic prefix of its domoticz, see --domoticz_host.')
+parser.add_argument(
+    '--translation', dest='translation', default='automation',
+    choices=['automation', 'bridge'],
+    help='Who translates domoticz/out into the per device status topics. '
+         '"automation" generates home assistant automations for it, "bridge" '
+         'leaves it to a running --bridge and only generates the entities.')
+parser.add_argument(
+    '--discovery', dest='discovery', default=False, action='store_true',
+    help='Publish the light, binary sensor, sensor, lock and climate '
+         'entities as retained home assistant mqtt discovery configs instead '
+         'of writing their files, so they change without a reload. Only new '
+         'and changed entities are published, and the configs of removed '
+         'ones are cleared. Their files are emptied, so the entities of an '
+         'earlier run without --discovery do not show up twice, but stay for '
+         'configuration.yaml to include. Automations, utility meters and '
+         'groups are still written to their files.')
+parser.add_argument(
+    '--discovery_prefix', dest='discovery_prefix', default='homeassistant',
+    help='Discovery prefix configured in the home assistant mqtt integration.')
 
-
-MOTION_SENSORS = []
-DOOR_SENSORS = []
-TEMP_SENSORS = []
-LIGHT_SWITCHES = []
-CLIMATE_DEVS = []
-LOCK_DEVS = []
-
-GROUPED_SENSORS = {}
+parser.add_argument(
+    '--priming', dest='priming', default='automation',
+    choices=['automation', 'retained'],
+    help='How home assistant gets the device states at start. "automation" '
+         'generates an automation asking domoticz for every device. '
+         '"retained" publishes all status topics retained instead, so the '
+         'broker hands them out. Run --prime once to seed them, a --bridge '
+         'does so itself whenever it connects.')
+parser.add_argument(
+    '--prime', dest='prime', default=False, action='store_true',
+    help='Instead of writing config files, read the state of every device '
+         'with one request, publish it retained to the status topics and '
+         'exit. See --priming.')
+parser.add_argument(
+    '--bridge', dest='bridge', default=False, action='store_true',
+    help='Instead of writing config files, run as a daemon that translates '
+         'domoticz/out messages into the per device status topics.')
+parser.add_argument(
+    '--bridge_workers', dest='bridge_workers', default=1, type=PositiveInt,
+    help='Processes the bridge translates domoticz/out messages in. With '
+         'more than one, the bridge only reads the idx of every message and '
+         'hands it to the worker owning that device, which translates and '
+         'publishes it over a connection of its own. The messages of a '
+         'device stay in order.')
+parser.add_argument(
+    '--command_topic', dest='command_topic', default='{prefix}/in',
+    help='Topic the generated entities and automations send domoticz '
+         'commands to, "{prefix}" is replaced with the topic prefix of the '
+         'domoticz, see --domoticz_host. Set it to anything else, eg '
+         '{prefix}/in/queue, to have a running --bridge coalesce and pace '
+         'them on their way to domoticz/in.')
+parser.add_argument(
+    '--command_rate', dest='command_rate', default=4, type=float,
+    help='Commands per second the bridge sends to the devices of one '
+         'hardware, see --command_topic. 0 for no limit.')
+parser.add_argument(
+    '--hardware_command_rate', dest='hardware_command_rate', default={},
+    type=FieldValues,
+    help='--command_rate for specific hardware, by name, eg "ZStick=1,RFX=10".')
+parser.add_argument(
+    '--publish_on_change', dest='publish_on_change', default=False,
+    action='store_true',
+    help='Have the bridge only publish states that changed. Needs '
+         '--priming retained, as home assistant would not get the unchanged '
+         'states after a restart otherwise.')
+parser.add_argument(
+    '--deadband', dest='deadband', default={}, type=FieldValues,
+    help='With --publish_on_change, how much a field has to change to be '
+         'published, eg "watts=5,kwh=0.01,temperature=0.2". Fields are the '
+         'keys of the status json (temperature, humidity, barometer, '
+         'windspeed, windgust, windchill, watts, kwh, brightness, and the '
+         '--energy cycles, eg daily), or the last topic level for plain '
+         'payloads (temp, target).')
+parser.add_argument(
+    '--min_interval', dest='min_interval', default={}, type=FieldValues,
+    help='With --publish_on_change, the seconds to wait after a publish '
+         'before a change to a field is published again, eg "watts=30". '
+         'Changes in between go out with the next report after that.')
+parser.add_argument(
+    '--energy', dest='energy', default='utility_meter',
+    choices=['utility_meter', 'bridge'],
+    help='Who totals the hourly, daily, weekly, monthly and quarterly '
+         'consumption of kWh meters. "utility_meter" generates home '
+         'assistant utility_meter entries for it. "bridge" has the --bridge '
+         'total the readings as it translates them and publish all totals '
+         'of a meter in one status message, so only mqtt sensors are '
+         'generated. Needs --translation bridge.')
+parser.add_argument(
+    '--energy_state', dest='energy_state', default='domoticz_energy.json',
+    help='With --energy bridge, the file the bridge keeps the energy totals '
+         'in, so they survive restarts.')
+parser.add_argument(
+    '--energy_checkpoint', dest='energy_checkpoint', default=60, type=float,
+    help='Seconds between writes of --energy_state. The start of a new '
+         'period is written right away.')
+parser.add_argument(
+    '--mqtt_host', dest='mqtt_host', default='localhost',
+    help='MQTT broker the bridge connects to.')
+parser.add_argument(
+    '--mqtt_port', dest='mqtt_port', default=1883, type=int,
+    help='MQTT broker port.')
+parser.add_argument(
+    '--mqtt_username', dest='mqtt_username', default=None,
+    help='MQTT username, if the broker requires one.')
+parser.add_argument(
+    '--mqtt_password', dest='mqtt_password', default=None,
+    help='MQTT password, if the broker requires one.')
+
+
+TEMP_DEVICE_TYPES = [
+    'Temp', 'Humidity', 'Temp + Humidity', 'Temp + Humidity + Baro',
+    'Temp + Baro', 'Heating', 'Thermostat 1']
+UTILITY_DEVICE_TYPES = [
+    'General', 'Thermostat', 'RFXMeter', 'RFXSensor', 'P1 Smart Meter',
+    'YouLess Meter', 'Air Quality', 'Usage', 'Lux', 'Weight', 'Energy',
+    'Current', 'Current/Energy']
+CLIMATE_MAX_TEMP = '78'
+CLIMATE_MIN_TEMP = '52'
+
+# Output files, in the order they are written. scene only with --scenes.
+OUTPUT_NAMES = [
+    'automation', 'light', 'binary_sensor', 'sensor', 'power', 'utility',
+    'climate', 'lock', 'scene', 'group']
+# Home assistant domain to reload when an output changes.
+OUTPUT_DOMAINS = {
+    'automation': 'automation', 'light': 'light',
+    'binary_sensor': 'binary_sensor', 'sensor': 'sensor', 'power': 'sensor',
+    'utility': 'utility_meter', 'climate': 'climate', 'lock': 'lock',
+    'scene': 'scene', 'group': 'group'}
+# Outputs StreamOutputs writes entity by entity. The rest are mappings, which
+# yaml.dump sorts, so they are written in one go.
+STREAMED_OUTPUTS = [
+    'automation', 'light', 'binary_sensor', 'sensor', 'power', 'climate',
+    'lock']
+# The outputs a single device can add entries to.
+DEVICE_OUTPUTS = [
+    'automation', 'light', 'binary_sensor', 'sensor', 'power', 'utility',
+    'lock']
+# Outputs --shard_by splits up.
+SHARDED_OUTPUTS = [
+    'automation', 'light', 'binary_sensor', 'sensor', 'power', 'utility',
+    'climate', 'lock']
+# Outputs that are mappings rather than lists.
+MAPPING_OUTPUTS = ['utility', 'group']
+# The --shard_by shard of the entries that are not of a single device.
+SHARED_SHARD = 'domoticz'
+# Outputs whose entities --discovery publishes, with their home assistant
+# component.
+DISCOVERY_COMPONENTS = {
+    'light': 'light', 'binary_sensor': 'binary_sensor', 'sensor': 'sensor',
+    'power': 'sensor', 'lock': 'lock', 'climate': 'climate'}
+# Seconds without a retained discovery config after which all of them are
+# taken to have arrived.
+DISCOVERY_WAIT = 1.0
+# Device fields the generated config depends on. Everything else is state.
+CONFIG_FIELDS = [
+    'Name', 'SwitchType', 'Type', 'SubType', 'Modes', 'HardwareName', 'Used',
+    'PlanIDs']
+
+# Device fields the generator and the bridge read. ParseDevices drops the rest.
+DEVICE_FIELDS = [
+    'idx', 'ID', 'Name', 'Type', 'SubType', 'SwitchType', 'HardwareName',
+    'HardwareType', 'Used', 'Modes', 'Status', 'Level', 'Mode', 'SetPoint',
+    'Direction', 'DirectionStr', 'Speed', 'Gust', 'Temp', 'Chill', 'Usage',
+    'Data', 'Barometer', 'Humidity', 'HumidityStatus', 'PlanIDs']
+# Fields of a /json.htm?type=scenes entry the generator reads.
+SCENE_FIELDS = ['idx', 'Name', 'Type']
+# Fields with few distinct values, shared between devices rather than kept
+# as a copy per device.
+INTERNED_FIELDS = [
+    'Type', 'SubType', 'SwitchType', 'HardwareName', 'HardwareType']
+
+
+class Device(object):
+  """The parts of a /json.htm?type=devices entry the generator uses.
+
+  Fields missing from the entry are None, except Used, which defaults to 1.
+  Instance is the name of the domoticz the device is from, see TagDevices.
+  """
+  __slots__ = DEVICE_FIELDS + ['Instance']
+
+  def __init__(self, entry):
+    for field in DEVICE_FIELDS:
+      setattr(self, field, entry.get(field))
+    for field in INTERNED_FIELDS:
+      value = getattr(self, field)
+      if isinstance(value, str):
+        setattr(self, field, sys.intern(value))
+    if self.Used is None:
+      self.Used = 1
+    self.Instance = ''
+
+  def Get(self, field, default=None):
+    """A field, or default if the entry did not have it."""
+    value = getattr(self, field)
+    return default if value is None else value
+
+
+class Scene(object):
+  """A domoticz scene or group, Type tells which, see GetScenes.
+
+  Devices holds the idxs of the devices of a group. Like Device it has an
+  Instance, so TagDevices works on scenes too.
+  """
+  __slots__ = SCENE_FIELDS + ['Devices', 'Instance']
+
+  def __init__(self, entry):
+    for field in SCENE_FIELDS:
+      setattr(self, field, entry.get(field))
+    self.Devices = ()
+    self.Instance = ''
+
+  def _Fields(self):
+    return tuple(getattr(self, f) for f in self.__slots__)
+
+  def __eq__(self, other):
+    return isinstance(other, Scene) and self._Fields() == other._Fields()
+
+
+class Groups(object):
+  """The entity names the group output is made of, see GenGroupYaml.
+
+  The Gen* functions add to the one they are given, so every run, and every
+  device in a ConfigGenerator, collects its own.
+  """
+  __slots__ = ['motion_sensors', 'door_sensors', 'temp_sensors',
+               'light_switches', 'grouped_sensors', 'light_groups']
+
+  def __init__(self):
+    self.motion_sensors = []
+    self.door_sensors = []
+    self.temp_sensors = []
+    self.light_switches = []
+    self.grouped_sensors = {}
+    # domoticz group name -> names of its devices
+    self.light_groups = {}
+
+  def _Fields(self):
+    return (self.motion_sensors, self.door_sensors, self.temp_sensors,
+            self.light_switches, self.grouped_sensors, self.light_groups)
+
+  def Merge(self, other):
+    """Adds the names collected by other."""
+    self.motion_sensors.extend(other.motion_sensors)
+    self.door_sensors.extend(other.door_sensors)
+    self.temp_sensors.extend(other.temp_sensors)
+    self.light_switches.extend(other.light_switches)
+    self.grouped_sensors.update(other.grouped_sensors)
+    self.light_groups.update(other.light_groups)
+
+  def __eq__(self, other):
+    return isinstance(other, Groups) and self._Fields() == other._Fields()
+
+  def __bool__(self):
+    return any(self._Fields())
 
 
 class UnsortableList(list):
@@ -114,30 +535,102 @@ class UnsortableOrderedDict(collections.OrderedDict):
     return UnsortableList(collections.OrderedDict.items(self, *args, **kwargs))
 
 
+def Namespace(dev):
+  """The name of the domoticz instance a device is from, see TagDevices."""
+  return dev.Instance
+
+
+def NsIdx(ns, idx):
+  """An idx, or other per instance id, made unique across instances."""
+  return '{}_{}'.format(ns, idx) if ns else str(idx)
+
+
+def DeviceKey(dev):
+  return NsIdx(Namespace(dev), dev.idx)
+
+
+def TopicPrefix(ns):
+  for instance in args.host:
+    if instance.name == ns:
+      return instance.topic_prefix
+  return 'domoticz/' + ns if ns else 'domoticz'
+
+
+def OutTopic(ns):
+  """The topic the domoticz of a namespace publishes its devices to."""
+  return TopicPrefix(ns) + '/out'
+
+
+def InTopic(ns):
+  """The topic the domoticz of a namespace takes commands from."""
+  return TopicPrefix(ns) + '/in'
+
+
+def CommandTopic(ns):
+  """The topic home assistant sends the commands for a namespace to."""
+  return args.command_topic.format(prefix=TopicPrefix(ns))
+
+
+def StatusTopic(dev, kind):
+  """The topic home assistant reads the state of a device from."""
+  return '{}/{}/{}/status'.format(OutTopic(Namespace(dev)), dev.idx, kind)
+
+
+def GenOutTrigger(idx, ns=''):
+  if args.routing == 'topic':
+    return {'platform': 'mqtt',
+            'topic': args.idx_topic.format(prefix=TopicPrefix(ns), idx=idx)}
+  return {'platform': 'mqtt', 'topic': OutTopic(ns)}
+
+
+def GenOutConditions(idx, value_template=None):
+  """Conditions for an automation triggered by GenOutTrigger.
+
+  With payload routing every automation sees every message, so the idx has to
+  be checked. With topic routing the trigger already did that.
+  """
+  conditions = []
+  if args.routing == 'payload':
+    conditions.append({
+        'condition': 'template',
+        'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(idx=idx)})
+  if value_template:
+    conditions.append({'condition': 'template', 'value_template': value_template})
+  if len(conditions) > 1:
+    return {'condition': 'and', 'conditions': conditions}
+  return conditions
+
+
+def GenStatusPublish(topic, payload_template):
+  """The action publishing a translated domoticz/out message to a status topic."""
+  data = {'topic': topic, 'payload_template': payload_template}
+  if args.priming == 'retained':
+    # Retained, so the primed state is replaced and not just shadowed.
+    data['retain'] = True
+  return {'service': 'mqtt.publish', 'data_template': data}
+
+
 def GenLockAutomation(dev):
   data = UnsortableOrderedDict()
-  data['alias'] = '{idx}_lock'.format(**dev)
-  data['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-  data['condition'] = [{
-      'condition': 'template',
-      'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(**dev)}]
-  data['action'] = [
-      {'service': 'mqtt.publish',
-       'data_template': {
-           'topic': 'domoticz/out/{idx}/lock/status'.format(**dev),
-           'payload_template': '{"state": {% if trigger.payload_json.nvalue == 1 %}"LOCK"{% else %}"UNLOCK"{% endif %} }'}
-      }]
+  data['alias'] = DeviceKey(dev) + '_lock'
+  data['trigger'] = GenOutTrigger(dev.idx, Namespace(dev))
+  condition = GenOutConditions(dev.idx)
+  if condition:
+    data['condition'] = condition
+  data['action'] = [GenStatusPublish(
+      StatusTopic(dev, 'lock'),
+      '{"state": {% if trigger.payload_json.nvalue == 1 %}"LOCK"{% else %}"UNLOCK"{% endif %} }')]
   return data
 
 
 def GenLockConfigs(dev):
   data = UnsortableOrderedDict()
-  data['name'] = '{Name}'.format(**dev)
+  data['name'] = dev.Name
   data['platform'] = 'mqtt'
-  data['command_topic'] = 'domoticz/in'
-  data['payload_lock'] = '{{"command": "switchlight", "idx": {idx}, "switchcmd": "On"}}'.format(**dev)
-  data['payload_unlock'] = '{{"command": "switchlight", "idx": {idx}, "switchcmd": "Off"}}'.format(**dev)
-  data['state_topic'] = 'domoticz/out/{idx}/lock/status'.format(**dev)
+  data['command_topic'] = CommandTopic(Namespace(dev))
+  data['payload_lock'] = '{{"command": "switchlight", "idx": {}, "switchcmd": "On"}}'.format(dev.idx)
+  data['payload_unlock'] = '{{"command": "switchlight", "idx": {}, "switchcmd": "Off"}}'.format(dev.idx)
+  data['state_topic'] = StatusTopic(dev, 'lock')
   data['state_locked'] = 'LOCK'
   data['state_unlocked'] = 'UNLOCK'
   data['value_template'] = '{{ value_json.state }}'
@@ -148,262 +641,233 @@ def GenLockConfigs(dev):
 #       This would allow for the automation to be a single entry for all lights.
 def GenLightAutomation(dev):
   data = UnsortableOrderedDict()
-  data['alias'] = '{idx}_light'.format(**dev)
+  data['alias'] = DeviceKey(dev) + '_light'
   # data['hide_entity'] = True
-  data['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-  data['condition'] = {'condition': 'and', 'conditions': [
-          {'condition': 'template',
-           'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(**dev)},
-          {'condition': 'template',
-           'value_template': '{{ trigger.payload_json.nvalue in [0, 1] }}'}]}
-  data['action'] = [
-          {'service': 'mqtt.publish',
-           'data_template': {
-              'topic': 'domoticz/out/{idx}/light/status'.format(**dev),
-              'payload_template' : '{ "state": {% if trigger.payload_json.nvalue == 0 %}"off"{% else %}"on"{% endif %} }'}
-          }]
+  data['trigger'] = GenOutTrigger(dev.idx, Namespace(dev))
+  data['condition'] = GenOutConditions(
+      dev.idx, '{{ trigger.payload_json.nvalue in [0, 1] }}')
+  data['action'] = [GenStatusPublish(
+      StatusTopic(dev, 'light'),
+      '{ "state": {% if trigger.payload_json.nvalue == 0 %}"off"{% else %}"on"{% endif %} }')]
   return data
 
 
 def GenDimmerAutomation(dev):
   data = UnsortableOrderedDict()
-  data['alias'] = '{idx}_dimmer'.format(**dev)
+  data['alias'] = DeviceKey(dev) + '_dimmer'
   #data['hide_entity'] = True
-  data['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-  data['condition'] = {'condition': 'and', 'conditions': [
-          {'condition': 'template',
-           'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(**dev)},
-          {'condition': 'template',
-           'value_template': '{{ trigger.payload_json.nvalue == 2 }}'}]}
-  data['action']= [
-          {'service': 'mqtt.publish', 'data_template':
-              {'topic': 'domoticz/out/{idx}/light/status'.format(**dev),
-               'payload_template': '{"state": "on", "brightness": {% with d_val=trigger.payload_json.svalue1|float * 2.55 %}{{ d_val|int }} {% endwith %} }'}}]
+  data['trigger'] = GenOutTrigger(dev.idx, Namespace(dev))
+  data['condition'] = GenOutConditions(
+      dev.idx, '{{ trigger.payload_json.nvalue == 2 }}')
+  data['action']= [GenStatusPublish(
+      StatusTopic(dev, 'light'),
+      '{"state": "on", "brightness": {% with d_val=trigger.payload_json.svalue1|float * 2.55 %}{{ d_val|int }} {% endwith %} }')]
   return(data)
 
 
-def GenLightConfigs(dev):
-  d = dict(dev)
-  LIGHT_SWITCHES.append(dev['Name'])
-  is_dimmer = dev['SwitchType'] == 'Dimmer'
-  d['dim_tmpl'] = ''
-  d['command_on_template'] = '\'{"command": "switchlight", "switchcmd": "On"}\''
-  if is_dimmer:
-    d['dim_tmpl'] = "brightness_template: '{{ value_json.brightness }}'"
-    d['command_on_template'] = """>
-    {"command": "switchlight", "idx": """ + dev['idx'] + """,
-    {%- if brightness is defined -%}
-    "switchcmd": "Set Level", "level": {{ brightness // 2.55}}
-    {%- else -%}
-    "switchcmd": "On"
-    {%- endif -%}
-    }"""
+def GenLightConfigs(dev, groups):
+  groups.light_switches.append(dev.Name)
+  is_dimmer = dev.SwitchType == 'Dimmer'
   data = UnsortableOrderedDict()
-  data['name'] = '{Name}'.format(**d)
+  data['name'] = dev.Name
   #data['hide_entity'] = True
   data['platform'] = 'mqtt'
   data['schema'] = 'template'
-  data['command_topic'] = 'domoticz/in'
-  data['state_topic'] = 'domoticz/out/{idx}/light/status'.format(**d)
+  data['command_topic'] = CommandTopic(Namespace(dev))
+  data['state_topic'] = StatusTopic(dev, 'light')
   data['state_template'] = '{{ value_json.state }}'
-  data['command_off_template'] = '{{"command": "switchlight", "idx": {idx}, "switchcmd": "Off"}}'.format(**d)
+  data['command_off_template'] = '{{"command": "switchlight", "idx": {}, "switchcmd": "Off"}}'.format(dev.idx)
   if is_dimmer:
-    data['command_on_template'] = ('{"command": "switchlight", "idx": ' + dev['idx'] +
+    data['command_on_template'] = ('{"command": "switchlight", "idx": ' + dev.idx +
         ', {%- if brightness is defined -%}"switchcmd": "Set Level", "level": '
         '{{ brightness // 2.55}}{%- else -%}"switchcmd": "On"{%- endif -%} }').encode('ascii', 'ignore')
     data['brightness_template'] = '{{ value_json.brightness|int }}'
   else:
-    data['command_on_template'] = ('{"command": "switchlight", "switchcmd": "On", "idx": ' + dev['idx'] + '}').encode('ascii', 'ignore')
+    data['command_on_template'] = ('{"command": "switchlight", "switchcmd": "On", "idx": ' + dev.idx + '}').encode('ascii', 'ignore')
   return data
 
 
 def GenBinarySensorAutomation(dev):
   data = UnsortableOrderedDict()
-  data['alias'] = '{idx}_sensor'.format(**dev)
+  data['alias'] = DeviceKey(dev) + '_sensor'
   #data['hide_entity'] = True
-  data['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-  data['condition'] = [{
-      'condition': 'template',
-      'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(**dev)}]
-  data['action'] = [{
-      'service': 'mqtt.publish',
-      'data_template': {
-          'topic': 'domoticz/out/{idx}/sensor/status'.format(**dev),
-          'payload_template': '{% if trigger.payload_json.nvalue == 1 %}ON{% else %}OFF{% endif %}'}}]
+  data['trigger'] = GenOutTrigger(dev.idx, Namespace(dev))
+  condition = GenOutConditions(dev.idx)
+  if condition:
+    data['condition'] = condition
+  data['action'] = [GenStatusPublish(
+      StatusTopic(dev, 'sensor'),
+      '{% if trigger.payload_json.nvalue == 1 %}ON{% else %}OFF{% endif %}')]
   return data
 
 
-def GenBinarySensor(dev):
-  d = dict(dev)
+def GenBinarySensor(dev, groups):
   s_type = {
       'Door Contact': 'opening',
       'Motion Sensor': 'motion',
       'Contact': 'opening',
   }
-  if dev['SwitchType'] == 'Motion Sensor':
-    MOTION_SENSORS.append(dev['Name'])
+  if dev.SwitchType == 'Motion Sensor':
+    groups.motion_sensors.append(dev.Name)
   else:
-    DOOR_SENSORS.append(dev['Name'])
-  d['d_type'] = "device_class: {}".format(s_type.get(dev['SwitchType'], 'None'))
+    groups.door_sensors.append(dev.Name)
   data = UnsortableOrderedDict()
-  data['name'] = '{Name}'.format(**dev)
+  data['name'] = dev.Name
   data['platform'] = 'mqtt'
-  data['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-  data['device_class'] = s_type.get(dev['SwitchType'], 'None')
+  data['state_topic'] = StatusTopic(dev, 'sensor')
+  data['device_class'] = s_type.get(dev.SwitchType, 'None')
   return data
 
 def GenUtilitySensorAutomation(dev):
-  d = dict(dev)
   data = UnsortableOrderedDict()
-  data['alias'] = '{idx}_kwh_sensor'.format(**dev)
-  data['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-  data['condition'] = [{
-      'condition': 'template',
-      'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(**dev)}]
-  data['action'] = [{
-      'service': 'mqtt.publish',
-      'data_template': {
-          'topic': 'domoticz/out/{idx}/sensor/status'.format(**dev),
-          'payload_template': '{"kwh": {{ trigger.payload_json.svalue2|float / 1000 }}, "watts": {{ trigger.payload_json.svalue1 }} }'}}]
+  data['alias'] = DeviceKey(dev) + '_kwh_sensor'
+  data['trigger'] = GenOutTrigger(dev.idx, Namespace(dev))
+  condition = GenOutConditions(dev.idx)
+  if condition:
+    data['condition'] = condition
+  data['action'] = [GenStatusPublish(
+      StatusTopic(dev, 'sensor'),
+      '{"kwh": {{ trigger.payload_json.svalue2|float / 1000 }}, "watts": {{ trigger.payload_json.svalue1 }} }')]
   return data
 
 
-def GenPowerConfigs(dev):
-  d = dict(dev)
-  key = dev['Name'].replace(' ', '_')
-  data = []
+def GenPowerConfigs(dev, groups):
   kwh = UnsortableOrderedDict()
-  kwh['name'] = '{Name}_kwh'.format(**dev)
+  kwh['name'] = dev.Name + '_kwh'
   kwh['platform'] = 'mqtt'
-  kwh['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
+  kwh['state_topic'] = StatusTopic(dev, 'sensor')
   kwh['unit_of_measurement'] = 'kwh'
   kwh['value_template'] = '{{ value_json.kwh }}'
   watts = UnsortableOrderedDict()
-  watts['name'] = '{Name}_watts'.format(**dev)
+  watts['name'] = dev.Name + '_watts'
   watts['platform'] = 'mqtt'
-  watts['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
+  watts['state_topic'] = StatusTopic(dev, 'sensor')
   watts['unit_of_measurement'] = 'watts'
   watts['value_template'] = '{{ value_json.watts }}'
-  GROUPED_SENSORS[ConvertName(dev['Name'])] = [dev['Name'], kwh['name'], watts['name']]
+  groups.grouped_sensors[ConvertName(dev.Name)] = [
+      dev.Name, kwh['name'], watts['name']]
   return [kwh, watts]
 
 
-def GenUtilityMeterConfigs(dev):
+def GenUtilityMeterConfigs(dev, groups):
   d = UnsortableOrderedDict()
-  key = ConvertName(dev['Name'])
+  key = ConvertName(dev.Name)
   grouped_sensors = []
-  for duration in ['hourly', 'daily', 'weekly', 'monthly', 'quarterly']:
+  for duration in ENERGY_CYCLES:
     sensor_key = '{}_{}_energy'.format(key, duration)
     d[sensor_key] = {
         'source': 'sensor.{}_kwh'.format(key),
         'cycle': duration}
     grouped_sensors.append(sensor_key)
-  GROUPED_SENSORS[key + 'consumption'] = [dev['Name'] + ' Consumption'] + grouped_sensors
+  groups.grouped_sensors[key + 'consumption'] = [
+      dev.Name + ' Consumption'] + grouped_sensors
   return d
 
 
-def GenTempSensorAutomation(dev, to_f=False):
-  temp = 'trigger.payload_json.svalue1|float'
-  if to_f:
-    temp += ' * 1.8 + 32'
-  payload_template = ""
-  if dev['Type'] == "Temp + Humidity":
-    payload_template = ('{"temperature": {{ ' + temp + ' }}, "humidity": {{ trigger.payload_json.svalue2 }} }')
-  elif dev['Type'] == "Temp":
-    payload_template = '{"temperature": {{ ' + temp + ' }} }'
-  elif dev['Type'] == "Temp + Humidity + Baro":
-    payload_template = '{"temperature": {{ ' + temp + ' }}, "humidity": {{ trigger.payload_json.svalue2 }}, "barometer": {{ trigger.payload_json.svalue4 }} }'
-  elif dev['Type'] == "Wind":
-    payload_template = '{"windspeed": {{ trigger.payload_json.svalue3 }}, "windgust": {{ trigger.payload_json.svalue4 }}, "windchill": {{ ' + temp.replace('svalue1', 'svalue6') + ' }}, "direction": "{{ trigger.payload_json.svalue2 }}" }'
-  else:
-    print('Not implemented: {}'.format(dev['Type']))
+def GenEnergySensors(dev, groups):
+  """Sensors for the totals --energy bridge publishes, see EnergyTotals.
+
+  They get the names of the utility meters they replace, so the entity ids,
+  and the history home assistant has for them, stay the same.
+  """
+  key = ConvertName(dev.Name)
+  data = []
+  for duration in ENERGY_CYCLES:
+    e = UnsortableOrderedDict()
+    e['name'] = '{}_{}_energy'.format(dev.Name, duration)
+    e['platform'] = 'mqtt'
+    e['state_topic'] = StatusTopic(dev, 'energy')
+    e['unit_of_measurement'] = 'kWh'
+    e['value_template'] = '{{{{ value_json.{} }}}}'.format(duration)
+    data.append(e)
+  groups.grouped_sensors[key + 'consumption'] = [
+      dev.Name + ' Consumption'] + [
+          '{}_{}_energy'.format(key, duration) for duration in ENERGY_CYCLES]
+  return data
+
+
+# What a temperature sensor device of a type adds: the fields it gets a sensor
+# entity for, the fields its grouped sensor lists, if it has one, and the
+# payload template of its status automation. The payload has a %s for the
+# fahrenheit conversion, it is None for the types without an automation.
+TempSensorClass = collections.namedtuple(
+    'TempSensorClass', ['fields', 'group', 'payload'])
+# Type -> TempSensorClass.
+TEMP_SENSOR_CLASSES = {
+    'Temp': TempSensorClass(
+        ['temperature'], None,
+        '{"temperature": {{ trigger.payload_json.svalue1|float%s }} }'),
+    'Humidity': TempSensorClass(
+        ['humidity'], ['humidity', 'temperature'], None),
+    'Temp + Humidity': TempSensorClass(
+        ['temperature', 'humidity'], ['humidity', 'temperature'],
+        '{"temperature": {{ trigger.payload_json.svalue1|float%s }}, '
+        '"humidity": {{ trigger.payload_json.svalue2 }} }'),
+    'Temp + Humidity + Baro': TempSensorClass(
+        ['temperature', 'humidity', 'barometer'],
+        ['humidity', 'temperature', 'barometer'],
+        '{"temperature": {{ trigger.payload_json.svalue1|float%s }}, '
+        '"humidity": {{ trigger.payload_json.svalue2 }}, '
+        '"barometer": {{ trigger.payload_json.svalue4 }} }'),
+    'Temp + Baro': TempSensorClass(['temperature'], None, None),
+    'Wind': TempSensorClass(
+        ['windspeed', 'windgust', 'windchill', 'direction'],
+        ['windspeed', 'windgust', 'windchill', 'direction'],
+        '{"windspeed": {{ trigger.payload_json.svalue3 }}, '
+        '"windgust": {{ trigger.payload_json.svalue4 }}, '
+        '"windchill": {{ trigger.payload_json.svalue6|float%s }}, '
+        '"direction": "{{ trigger.payload_json.svalue2 }}" }'),
+}
+# Sensor field -> (unit, value_template). A unit of None is the temperature
+# unit.
+SENSOR_FIELDS = {
+    'temperature': (None, '{{ value_json.temperature }}'),
+    'humidity': ('%', '{{ value_json.humidity }}'),
+    'barometer': ('hPa', '{{ value_json.barometer}}'),
+    'windspeed': ('speed', '{{ value_json.windspeed }}'),
+    'windgust': ('gust', '{{ value_json.windgust }}'),
+    'windchill': (None, '{{ value_json.windchill }}'),
+    'direction': ('dir', '{{ value_json.direction }}'),
+}
+
+
+def GenTempSensorAutomation(dev, sensor, to_f=False):
+  if sensor.payload is None:
     return None
   data = UnsortableOrderedDict()
-  data['alias'] = '{idx}_sensor'.format(**dev)
+  data['alias'] = DeviceKey(dev) + '_sensor'
   #data['hide_entity'] = True
-  data['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-  data['condition'] = [{
-      'condition': 'template',
-      'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(**dev)}]
-  data['action'] = [{
-      'service': 'mqtt.publish', 'data_template': {
-          'topic': 'domoticz/out/{idx}/sensor/status'.format(**dev),
-          'payload_template': payload_template}}]
+  data['trigger'] = GenOutTrigger(dev.idx, Namespace(dev))
+  condition = GenOutConditions(dev.idx)
+  if condition:
+    data['condition'] = condition
+  data['action'] = [GenStatusPublish(
+      StatusTopic(dev, 'sensor'), sensor.payload % (' * 1.8 + 32' if to_f else ''))]
   return data
 
 
-def GenTempSensorList(dev, to_f=False):
+def GenTempSensorList(dev, sensor, groups, to_f=False):
   t_unit = 'F' if to_f else 'C'
   data = []
-  key = dev['Name'].replace(' ', '_')
-  if 'Temp' in dev['Type']:
-    e = UnsortableOrderedDict()
-    e['name'] = '{Name}_temperature'.format(**dev)
-    e['platform'] = 'mqtt'
-    e['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-    e['unit_of_measurement'] = t_unit
-    e['value_template'] = '{{ value_json.temperature }}'
-    data.append(e)
-    TEMP_SENSORS.append(e['name'])
-  if 'Humidity' in dev['Type']:
-    e = UnsortableOrderedDict()
-    e['name'] = '{Name}_humidity'.format(**dev)
-    e['platform'] = 'mqtt'
-    e['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-    e['unit_of_measurement'] = '%'
-    e['value_template'] = '{{ value_json.humidity }}'
-    data.append(e)
-    TEMP_SENSORS.append(e['name'])
-    GROUPED_SENSORS[key] = [
-        dev['Name'], e['name'], dev['Name'] + '_temperature']
-  if dev['Type'] == 'Temp + Humidity + Baro':
+  for field in sensor.fields:
+    unit, value_template = SENSOR_FIELDS[field]
     e = UnsortableOrderedDict()
-    e['name'] = '{Name}_barometer'.format(**dev)
+    e['name'] = '{}_{}'.format(dev.Name, field)
     e['platform'] = 'mqtt'
-    e['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-    e['unit_of_measurement'] = 'hPa'
-    e['value_template'] = '{{ value_json.barometer}}'
+    e['state_topic'] = StatusTopic(dev, 'sensor')
+    e['unit_of_measurement'] = t_unit if unit is None else unit
+    e['value_template'] = value_template
     data.append(e)
-    TEMP_SENSORS.append(e['name'])
-    GROUPED_SENSORS[key].append(e['name'])
-  if dev['Type'] == "Wind":
-    s = UnsortableOrderedDict()
-    s['name'] = '{Name}_windspeed'.format(**dev)
-    s['platform'] = 'mqtt'
-    s['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-    s['unit_of_measurement'] = 'speed'
-    s['value_template'] = '{{ value_json.windspeed }}'
-    data.append(s)
-    g = UnsortableOrderedDict()
-    g['name'] = '{Name}_windgust'.format(**dev)
-    g['platform'] = 'mqtt'
-    g['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-    g['unit_of_measurement'] = 'gust'
-    g['value_template'] = '{{ value_json.windgust }}'
-    data.append(g)
-    c = UnsortableOrderedDict()
-    c['name'] = '{Name}_windchill'.format(**dev)
-    c['platform'] = 'mqtt'
-    c['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-    c['unit_of_measurement'] = t_unit
-    c['value_template'] = '{{ value_json.windchill }}'
-    data.append(c)
-    d = UnsortableOrderedDict()
-    d['name'] = '{Name}_direction'.format(**dev)
-    d['platform'] = 'mqtt'
-    d['state_topic'] = 'domoticz/out/{idx}/sensor/status'.format(**dev)
-    d['unit_of_measurement'] = 'dir'
-    d['value_template'] = '{{ value_json.direction }}'
-    data.append(d)
-    TEMP_SENSORS.extend([s['name'], g['name'], c['name'], d['name']])
-    GROUPED_SENSORS[key] = [
-        dev['Name'], s['name'], g['name'], c['name'], d['name']]
+    groups.temp_sensors.append(e['name'])
+  if sensor.group:
+    groups.grouped_sensors[dev.Name.replace(' ', '_')] = [dev.Name] + [
+        '{}_{}'.format(dev.Name, field) for field in sensor.group]
   return data
 
 
-def GenGroupedSensors():
+def GenGroupedSensors(groups):
   data = UnsortableOrderedDict()
-  for name, items in GROUPED_SENSORS.items():
+  for name, items in groups.grouped_sensors.items():
     name = ConvertName(name)
     data[name] = UnsortableOrderedDict()
     data[name]['name'] = items[0]
@@ -412,55 +876,113 @@ def GenGroupedSensors():
   return data
 
 
-def GenGroups():
+def GenGroups(groups):
   data = UnsortableOrderedDict()
-  l = TEMP_SENSORS[:]
-  l.extend(MOTION_SENSORS[:])
-  l.extend(DOOR_SENSORS)
-  for name, devs in GROUPED_SENSORS.items():
-    for dev in devs:
-      if dev in l:
-        l.remove(dev)
+  # Sensors in a grouped sensor are listed through their group instead. Each
+  # time a name is grouped, drop its first remaining occurrence.
+  grouped = collections.Counter(
+      dev for devs in groups.grouped_sensors.values() for dev in devs)
+  l = []
+  for name in itertools.chain(
+      groups.temp_sensors, groups.motion_sensors, groups.door_sensors):
+    if grouped[name]:
+      grouped[name] -= 1
+    else:
+      l.append(name)
   data['sensors'] = UnsortableOrderedDict()
   data['sensors']['name'] = 'Sensors'
   data['sensors']['entities'] = [
       'sensor.{}'.format(ConvertName(x)) for x in l]
   data['sensors']['entities'].extend([
-      'group.{}'.format(ConvertName(x)) for x in GROUPED_SENSORS.keys()])
+      'group.{}'.format(ConvertName(x)) for x in groups.grouped_sensors.keys()])
   data['lights'] = UnsortableOrderedDict()
   data['lights']['name'] = 'Lights'
   data['lights']['entities'] = [
-      'light.{}'.format(ConvertName(x)) for x in LIGHT_SWITCHES]
+      'light.{}'.format(ConvertName(x)) for x in groups.light_switches]
+  # A domoticz group of the very same lights switches them in one go.
+  for name, members in sorted(groups.light_groups.items()):
+    if members and set(members) == set(groups.light_switches):
+      data['lights']['entities'] = ['light.{}'.format(ConvertName(name))]
+      break
+  return data
+
+
+def SceneCommand(scene, switchcmd):
+  return '{{"command": "switchscene", "idx": {}, "switchcmd": "{}"}}'.format(
+      scene.idx, switchcmd)
+
+
+def GenSceneConfigs(scene):
+  data = UnsortableOrderedDict()
+  data['name'] = scene.Name
+  data['platform'] = 'mqtt'
+  data['command_topic'] = CommandTopic(Namespace(scene))
+  data['payload_on'] = SceneCommand(scene, 'On')
   return data
 
 
-def GetThermostats(host, to_f=False):
+def GenGroupLightConfigs(scene, names, groups):
+  """A light switching a domoticz group. It has no state topic, so home
+  assistant assumes the state it was last switched to."""
+  keys = [NsIdx(Namespace(scene), idx) for idx in scene.Devices]
+  groups.light_groups[scene.Name] = [names[k] for k in keys if k in names]
+  data = UnsortableOrderedDict()
+  data['name'] = scene.Name
+  data['platform'] = 'mqtt'
+  data['schema'] = 'template'
+  data['command_topic'] = CommandTopic(Namespace(scene))
+  data['command_off_template'] = SceneCommand(scene, 'Off')
+  data['command_on_template'] = SceneCommand(scene, 'On')
+  return data
+
+
+def GenScene(scene, names):
+  """Like GenDevice, for a domoticz scene or group.
+
+  names maps the DeviceKey of the devices to their names. Returns (outputs,
+  groups).
+  """
+  groups = Groups()
+  if scene.Type == 'Scene':
+    return {'scene': [GenSceneConfigs(scene)]}, groups
+  if scene.Type == 'Group':
+    return {'light': [GenGroupLightConfigs(scene, names, groups)]}, groups
+  return {}, groups
+
+
+def FindThermostats(devs):
   # TODO: This method needs help, really complex and full of corner cases.
-  tof = ''
-  if to_f:
-    tof += ' * 1.8 + 32'
-  climate_data = []
-  automation_data = []
-  devs = GetDevices(host, None, None)
+  # (namespace, ID) of the thermostats, devices of other domoticz instances
+  # can have the same IDs.
   thermostat_ids = []
   for d in devs['result']:
-    if d['Type'] == 'Thermostat':
-      t_id = d['ID'].lstrip('0')
-      if 'ZWave' in d['HardwareType']:
+    if d.Type == 'Thermostat':
+      t_id = d.ID.lstrip('0')
+      if 'ZWave' in d.HardwareType:
         t_id = t_id[:2]
-        thermostat_ids.append(t_id)
-  thermostat_ids = set(thermostat_ids)
-  thermostats = {}
-  for t_id in thermostat_ids:
-    t_devs = [x for x in devs['result'] if x['ID'].lstrip('0').startswith(t_id)]
+        thermostat_ids.append((Namespace(d), t_id))
+  # Keep the first seen order, so the output does not depend on set ordering.
+  thermostat_ids = list(dict.fromkeys(thermostat_ids))
+  # Index every device under each thermostat ID length, so finding the devices
+  # whose ID starts with a thermostat ID is a lookup rather than a scan.
+  id_lengths = set(len(t_id) for _, t_id in thermostat_ids)
+  by_prefix = collections.defaultdict(list)
+  for x in devs['result']:
+    x_id = x.ID.lstrip('0')
+    for length in id_lengths:
+      if len(x_id) >= length:
+        by_prefix[Namespace(x), x_id[:length]].append(x)
+  thermostats = []
+  for ns, t_id in thermostat_ids:
+    t_devs = by_prefix.get((ns, t_id), [])
     t_modes = t_modes_rev = f_modes = f_modes_rev = h_setpoint = c_setpoint = cur_temp = None
     tmode_idx = tstate_idx = fmode_idx = hset_idx = cset_idx = t_idx = None
     for dev in t_devs:
-      if dev['SubType'] == 'Thermostat Mode':
+      if dev.SubType == 'Thermostat Mode':
         t_modes = {}
         t_modes_rev = {}
-        tmode_idx = dev['idx']
-        m = dev['Modes'].lower().split(';')
+        tmode_idx = dev.idx
+        m = dev.Modes.lower().split(';')
         i = 0
         while (i < len(m)):
           if i+1 == len(m): break
@@ -470,115 +992,135 @@ def GetThermostats(host, to_f=False):
           t_modes_rev[m[i]] = m[i+1].replace(' ', '_')  # map str(int) to logical name
           t_modes[m[i+1].replace(' ', '_')] = int(m[i])  # map logical name to int
           i += 2
-      elif dev['SubType'] == 'Thermostat Fan Mode':
+      elif dev.SubType == 'Thermostat Fan Mode':
         f_modes = {}
         f_modes_rev = {}
-        fmode_idx = dev['idx']
-        m = dev['Modes'].lower().split(';')
+        fmode_idx = dev.idx
+        m = dev.Modes.lower().split(';')
         i = 0
         while (i < len(m)):
           if i+1 == len(m): break
           f_modes_rev[m[i]] = m[i+1]  # map str(int) to logical name
           f_modes[m[i+1]] = int(m[i])  # map logical name to int
           i += 2
-      elif dev['SubType'] == 'SetPoint':
+      elif dev.SubType == 'SetPoint':
         # Guessing for heating vs cooling
         for t in ['heat', 'warm', 'fire', 'setpoint', 'target']:
-          if t in dev['Name'].lower():
-            if not 'econ' in dev['Name'].lower():
-              hset_idx = dev['idx']
+          if t in dev.Name.lower():
+            if not 'econ' in dev.Name.lower():
+              hset_idx = dev.idx
           else:
             pass  # my thermostat only has one setpoint, but domoticz has 2
-      elif dev['Type'] == 'Temp':
-        t_idx = dev['idx']
-      elif dev['SubType'] == 'Thermostat Operating State':
-        tstate_idx = dev['idx']
+      elif dev.Type == 'Temp':
+        t_idx = dev.idx
+      elif dev.SubType == 'Thermostat Operating State':
+        tstate_idx = dev.idx
+    thermostats.append({
+        'ns': ns, 't_id': NsIdx(ns, t_id), 't_idx': t_idx, 'hset_idx': hset_idx,
+        'tmode_idx': tmode_idx, 't_modes': t_modes, 't_modes_rev': t_modes_rev,
+        'fmode_idx': fmode_idx, 'f_modes': f_modes, 'f_modes_rev': f_modes_rev,
+        'tstate_idx': tstate_idx, 'idxs': [DeviceKey(x) for x in t_devs]})
+  return thermostats
+
+
+def GetThermostats(devs, to_f=False):
+  tof = ''
+  if to_f:
+    tof += ' * 1.8 + 32'
+  climate_data = []
+  automation_data = []
+  t_ids = []
+  member_idxs = set()
+  overrides = {}
+  if args.climate_names:
+    for i in args.climate_names.split(','):
+      k,v = i.split(':')
+      overrides[k] = v
+  # With the bridge translating domoticz/out, only the set automations remain.
+  outbound = args.translation == 'automation'
+  for t in FindThermostats(devs):
+    t_id, ns = t['t_id'], t['ns']
+    out_topic, in_topic = OutTopic(ns), InTopic(ns)
+    t_ids.append(t_id)
+    member_idxs.update(t['idxs'])
+    t_idx, hset_idx, tstate_idx = t['t_idx'], t['hset_idx'], t['tstate_idx']
+    tmode_idx, t_modes, t_modes_rev = t['tmode_idx'], t['t_modes'], t['t_modes_rev']
+    fmode_idx, f_modes, f_modes_rev = t['fmode_idx'], t['f_modes'], t['f_modes_rev']
     climate = UnsortableOrderedDict()
     climate['platform'] = 'mqtt'
-    if args.climate_names:
-      overrides = {}
-      for i in args.climate_names.split(','):
-        k,v = i.split(':')
-        overrides[k] = v
     if overrides.get(t_id):
       climate['name'] = overrides.get(t_id)
     else:
-      climate['name'] = 'Thermostat'  # TODO how to get the right name here?
+      # TODO how to get the right name here?
+      climate['name'] = '{} Thermostat'.format(ns) if ns else 'Thermostat'
     climate['send_if_off'] = 'true'
     if t_idx:
-      climate['current_temperature_topic'] = 'domoticz/out/climate/{idx}/temp'.format(idx=t_idx)
+      climate['current_temperature_topic'] = '{}/climate/{}/temp'.format(out_topic, t_idx)
       a = UnsortableOrderedDict()
-      a['alias'] = '{idx}_climate_temp'.format(idx=t_idx)
+      a['alias'] = NsIdx(ns, t_idx) + '_climate_temp'
       #a['hide_entity'] = True
-      a['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-      a['condition'] = [{
-          'condition': 'template',
-          'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(idx=t_idx)}]
-      a['action'] = [
-          {'service': 'mqtt.publish',
-           'data_template': {
-              'payload_template': '{{{{ trigger.payload_json.svalue1|float {} }}}}'.format(tof),
-              'topic': 'domoticz/out/climate/{idx}/temp'.format(idx=t_idx)}}]
-
-      automation_data.append(a)
+      a['trigger'] = GenOutTrigger(t_idx, ns)
+      condition = GenOutConditions(t_idx)
+      if condition:
+        a['condition'] = condition
+      a['action'] = [GenStatusPublish(
+          '{}/climate/{}/temp'.format(out_topic, t_idx),
+          '{{{{ trigger.payload_json.svalue1|float {} }}}}'.format(tof))]
+
+      if outbound:
+        automation_data.append(a)
     if hset_idx:
-      climate['temperature_state_topic'] = 'domoticz/out/climate/{idx}/target'.format(idx=hset_idx)
-      climate['temperature_command_topic'] = 'domoticz/in/climate/{idx}/set'.format(idx=hset_idx)
-      climate['max_temp'] = '78'
-      climate['min_temp'] = '52'
+      climate['temperature_state_topic'] = '{}/climate/{}/target'.format(out_topic, hset_idx)
+      climate['temperature_command_topic'] = '{}/climate/{}/set'.format(in_topic, hset_idx)
+      climate['max_temp'] = CLIMATE_MAX_TEMP
+      climate['min_temp'] = CLIMATE_MIN_TEMP
       a = UnsortableOrderedDict()
       b = UnsortableOrderedDict()
-      a['alias'] = '{idx}_target_temp'.format(idx=hset_idx)
+      a['alias'] = NsIdx(ns, hset_idx) + '_target_temp'
       #a['hide_entity'] = True
-      a['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-      a['condition'] = [{
-          'condition': 'template',
-          'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(idx=hset_idx)}]
-      a['action'] = [{'service': 'mqtt.publish', 'data_template': {
-              'payload_template': (
-                  '{% set max_temp = ' + climate['max_temp'] + ' %}'
-                  '{% set ctof = trigger.payload_json.svalue1|float ' + tof + ' %}'
-                  '{% if ctof > max_temp %}'
-                      '{{ trigger.payload_json.svalue1|float }}'
-                  '{% else %}'
-                      '{{ ctof }}'
-                  '{% endif %}'),
-
-              'topic': 'domoticz/out/climate/{idx}/target'.format(idx=hset_idx)}
-              }]
-      b['alias'] = '{idx}_target_temp_set'.format(idx=hset_idx)
+      a['trigger'] = GenOutTrigger(hset_idx, ns)
+      condition = GenOutConditions(hset_idx)
+      if condition:
+        a['condition'] = condition
+      a['action'] = [GenStatusPublish(
+          '{}/climate/{}/target'.format(out_topic, hset_idx),
+          '{% set max_temp = ' + climate['max_temp'] + ' %}'
+          '{% set ctof = trigger.payload_json.svalue1|float ' + tof + ' %}'
+          '{% if ctof > max_temp %}'
+              '{{ trigger.payload_json.svalue1|float }}'
+          '{% else %}'
+              '{{ ctof }}'
+          '{% endif %}')]
+      b['alias'] = NsIdx(ns, hset_idx) + '_target_temp_set'
       #b['hide_entity'] = True
-      b['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/in/climate/{idx}/set'.format(idx=hset_idx)}
+      b['trigger'] = {'platform': 'mqtt', 'topic': '{}/climate/{}/set'.format(in_topic, hset_idx)}
       b['action'] = [
           {'service': 'mqtt.publish',
            'data_template': {
                # domoticz bug, don't convert back to C, since the thermostat actually expects F.
               'payload_template': '{{"idx": {idx}, "svalue": "{{{{ trigger.payload_json }}}}" }} '.format(idx=hset_idx),
-              'topic': 'domoticz/in'}}]
-      automation_data.extend([a, b])
+              'topic': CommandTopic(ns)}}]
+      automation_data.extend([a, b] if outbound else [b])
     if tmode_idx:
-      climate['mode_state_topic'] = 'domoticz/out/climate/{idx}/mode'.format(idx=tmode_idx)
-      climate['mode_command_topic'] = 'domoticz/in/climate/{idx}/mode'.format(idx=tmode_idx)
+      climate['mode_state_topic'] = '{}/climate/{}/mode'.format(out_topic, tmode_idx)
+      climate['mode_command_topic'] = '{}/climate/{}/mode'.format(in_topic, tmode_idx)
       climate['modes'] = list(t_modes.keys())
       a = UnsortableOrderedDict()
       b = UnsortableOrderedDict()
-      a['alias'] = '{idx}_state'.format(idx=tmode_idx)
+      a['alias'] = NsIdx(ns, tmode_idx) + '_state'
       #a['hide_entity'] = True
-      a['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-      a['condition'] = [{
-          'condition': 'template',
-          'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(idx=tmode_idx)}]
-      a['action'] = [
-          {'service': 'mqtt.publish',
-           'data_template': {
-              'payload_template': (
-                  '{% with mode_map={' + ','.join(['"{k}": "{v}"'.format(k=k, v=v) for k,v in t_modes_rev.items()]) + '} %}'
-                    '{{ mode_map[trigger.payload_json.nvalue|string] }}'
-                  '{% endwith %}'),
-              'topic': 'domoticz/out/climate/{idx}/mode'.format(idx=tmode_idx)}}]
-      b['alias'] = '{idx}_state_set'.format(idx=tmode_idx)
+      a['trigger'] = GenOutTrigger(tmode_idx, ns)
+      condition = GenOutConditions(tmode_idx)
+      if condition:
+        a['condition'] = condition
+      a['action'] = [GenStatusPublish(
+          '{}/climate/{}/mode'.format(out_topic, tmode_idx),
+          '{% with mode_map={' + ','.join(['"{k}": "{v}"'.format(k=k, v=v) for k,v in t_modes_rev.items()]) + '} %}'
+            '{{ mode_map[trigger.payload_json.nvalue|string] }}'
+          '{% endwith %}')]
+      b['alias'] = NsIdx(ns, tmode_idx) + '_state_set'
       #b['hide_entity'] = True
-      b['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/in/climate/{idx}/mode'.format(idx=tmode_idx)}
+      b['trigger'] = {'platform': 'mqtt', 'topic': '{}/climate/{}/mode'.format(in_topic, tmode_idx)}
       b['action'] = [
           {'service': 'mqtt.publish',
            'data_template': {
@@ -586,51 +1128,45 @@ def GetThermostats(host, to_f=False):
                   '{% with mode_map={' + ','.join(['"{k}": "{v}"'.format(k=k, v=v) for k,v in t_modes.items()]) + '} %}'
                     '{ "idx": ' + '{}'.format(tmode_idx) + ', "nvalue": {{ mode_map[trigger.payload] }} }'
                   '{% endwith %}'),
-              'topic': 'domoticz/in'}}]
-      automation_data.extend([a, b])
+              'topic': CommandTopic(ns)}}]
+      automation_data.extend([a, b] if outbound else [b])
     if tstate_idx:
-      climate['action_topic'] = 'domoticz/out/climate/{idx}/action'.format(idx=tstate_idx)
+      climate['action_topic'] = '{}/climate/{}/action'.format(out_topic, tstate_idx)
       a = UnsortableOrderedDict()
       b = UnsortableOrderedDict()
-      a['alias'] = '{idx}_action'.format(idx=tstate_idx)
+      a['alias'] = NsIdx(ns, tstate_idx) + '_action'
       #a['hide_entity'] = True
-      a['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-      a['condition'] = [{
-          'condition': 'template',
-          'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(idx=tstate_idx)}]
-      a['action'] = [
-          {'service': 'mqtt.publish',
-           'data_template': {
-               'payload_template': (
-                   '{% with mode_map={"0": "off", "1": "cooling", "2": "heating"} %}'
-                     '{{ mode_map[trigger.payload_json.nvalue|string] }}'
-                   '{% endwith %}'
-                     ),
-               'topic': 'domoticz/out/climate/{idx}/action'.format(idx=tstate_idx)}}]
-      automation_data.extend([a])
+      a['trigger'] = GenOutTrigger(tstate_idx, ns)
+      condition = GenOutConditions(tstate_idx)
+      if condition:
+        a['condition'] = condition
+      a['action'] = [GenStatusPublish(
+          '{}/climate/{}/action'.format(out_topic, tstate_idx),
+          '{% with mode_map={' + ', '.join(['"{k}": "{v}"'.format(k=k, v=v) for k,v in THERMOSTAT_STATES.items()]) + '} %}'
+            '{{ mode_map[trigger.payload_json.nvalue|string] }}'
+          '{% endwith %}')]
+      if outbound:
+        automation_data.append(a)
     if fmode_idx:
-      climate['fan_mode_state_topic'] = 'domoticz/out/climate/{idx}/mode'.format(idx=fmode_idx)
-      climate['fan_mode_command_topic'] = 'domoticz/in/climate/{idx}/mode'.format(idx=fmode_idx)
+      climate['fan_mode_state_topic'] = '{}/climate/{}/mode'.format(out_topic, fmode_idx)
+      climate['fan_mode_command_topic'] = '{}/climate/{}/mode'.format(in_topic, fmode_idx)
       climate['fan_modes'] = list(f_modes.keys())
       a = UnsortableOrderedDict()
       b = UnsortableOrderedDict()
-      a['alias'] = '{idx}_state'.format(idx=fmode_idx)
+      a['alias'] = NsIdx(ns, fmode_idx) + '_state'
       #a['hide_entity'] = True
-      a['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/out'}
-      a['condition'] = [{
-          'condition': 'template',
-          'value_template': '{{{{ trigger.payload_json.idx == {idx} }}}}'.format(idx=fmode_idx)}]
-      a['action'] = [
-          {'service': 'mqtt.publish',
-           'data_template': {
-              'payload_template': (
-                  '{% with mode_map={' + ','.join(['"{k}": "{v}"'.format(k=k, v=v) for k,v in f_modes_rev.items()]) + '} %}'
-                    '{{ mode_map[trigger.payload_json.nvalue|string] }}'
-                  '{% endwith %}'),
-              'topic': 'domoticz/out/climate/{idx}/mode'.format(idx=fmode_idx)}}]
-      b['alias'] = '{idx}_state_set'.format(idx=fmode_idx)
+      a['trigger'] = GenOutTrigger(fmode_idx, ns)
+      condition = GenOutConditions(fmode_idx)
+      if condition:
+        a['condition'] = condition
+      a['action'] = [GenStatusPublish(
+          '{}/climate/{}/mode'.format(out_topic, fmode_idx),
+          '{% with mode_map={' + ','.join(['"{k}": "{v}"'.format(k=k, v=v) for k,v in f_modes_rev.items()]) + '} %}'
+            '{{ mode_map[trigger.payload_json.nvalue|string] }}'
+          '{% endwith %}')]
+      b['alias'] = NsIdx(ns, fmode_idx) + '_state_set'
       #b['hide_entity'] = True
-      b['trigger'] = {'platform': 'mqtt', 'topic': 'domoticz/in/climate/{idx}/mode'.format(idx=fmode_idx)}
+      b['trigger'] = {'platform': 'mqtt', 'topic': '{}/climate/{}/mode'.format(in_topic, fmode_idx)}
       b['action'] = [
           {'service': 'mqtt.publish',
            'data_template': {
@@ -638,21 +1174,21 @@ def GetThermostats(host, to_f=False):
                   '{% with mode_map={' + ','.join(['"{k}": "{v}"'.format(k=k, v=v) for k,v in f_modes.items()]) + '} %}'
                     '{ "idx": ' + '{}'.format(tmode_idx) + ', "nvalue": {{ mode_map[trigger.payload] }} }'
                   '{% endwith %}'),
-              'topic': 'domoticz/in'}}]
-      automation_data.extend([a, b])
+              'topic': CommandTopic(ns)}}]
+      automation_data.extend([a, b] if outbound else [b])
     climate_data.append(climate)
-  return {'automation': automation_data, 'climate': climate_data}
+  return {'automation': automation_data, 'climate': climate_data,
+          't_ids': t_ids, 'idxs': member_idxs}
 
 def GenAllDeviceQueryActions(devices):
-  data = []
+  # A generator, so YamlWriter can stream the actions one at a time.
   for dev in devices['result']:
     d = UnsortableOrderedDict()
     d['service'] = 'mqtt.publish'
     d['data_template'] = {
-        'topic': 'domoticz/in',
-        'payload_template': '{{"command": "getdeviceinfo", "idx": {idx} }}'.format(**dev)}
-    data.append(d)
-  return data
+        'topic': CommandTopic(Namespace(dev)),
+        'payload_template': '{{"command": "getdeviceinfo", "idx": {} }}'.format(dev.idx)}
+    yield d
 
 
 def GenStartupAutomation(devices):
@@ -664,48 +1200,1143 @@ def GenStartupAutomation(devices):
   return data
 
 
-def GetDevices(host, dev_filter, only_used=True):
-  base_url = 'http://{host}/json.htm'.format(host=host)
-  used = '&used=true' if only_used else ''
-  dev_f = ''
+# The handlers of DEVICE_CLASSES. Each takes (dev, groups, to_f) and returns
+# a dict of output name to the entries the device adds to it. The automations
+# go to 'automation', a None one marks a device whose state is not translated.
+
+def GenBinarySensorClass(dev, groups, to_f):
+  return {'automation': [GenBinarySensorAutomation(dev)],
+          'binary_sensor': [GenBinarySensor(dev, groups)]}
+
+
+def GenLightClass(dev, groups, to_f):
+  return {'automation': [GenLightAutomation(dev)],
+          'light': [GenLightConfigs(dev, groups)]}
+
+
+def GenDimmerClass(dev, groups, to_f):
+  return {'automation': [GenLightAutomation(dev), GenDimmerAutomation(dev)],
+          'light': [GenLightConfigs(dev, groups)]}
+
+
+def GenLockClass(dev, groups, to_f):
+  return {'automation': [GenLockAutomation(dev)],
+          'lock': [GenLockConfigs(dev)]}
+
+
+def GenPowerClass(dev, groups, to_f):
+  if args.energy == 'bridge':
+    return {'automation': [GenUtilitySensorAutomation(dev)],
+            'power': GenPowerConfigs(dev, groups) + GenEnergySensors(dev, groups)}
+  return {'automation': [GenUtilitySensorAutomation(dev)],
+          'power': GenPowerConfigs(dev, groups),
+          'utility': [GenUtilityMeterConfigs(dev, groups)]}
+
+
+def GenTempSensorClass(sensor, dev, groups, to_f):
+  return {'automation': [GenTempSensorAutomation(dev, sensor, to_f=to_f)],
+          'sensor': GenTempSensorList(dev, sensor, groups, to_f=to_f)}
+
+
+def GenThermostatClass(dev, groups, to_f):
+  """Thermostat devices are turned into climates by GetThermostats."""
+  return {}
+
+
+# (Type, SubType, SwitchType) -> handler of the devices of that class. Type
+# and SubType may be None to match any, SwitchType None only matches devices
+# without one. Devices no class matches are reported as not implemented.
+# New classes are added here, before the first device is generated.
+DEVICE_CLASSES = {
+    (None, None, 'Motion Sensor'): GenBinarySensorClass,
+    (None, None, 'Door Contact'): GenBinarySensorClass,
+    (None, None, 'Contact'): GenBinarySensorClass,
+    (None, None, 'On/Off'): GenLightClass,
+    (None, None, 'Push On Button'): GenLightClass,
+    (None, None, 'Dimmer'): GenDimmerClass,
+    (None, None, 'Door Lock'): GenLockClass,
+    (None, 'kWh', None): GenPowerClass,
+    ('Thermostat', 'SetPoint', None): GenThermostatClass,
+    ('General', 'Thermostat Mode', None): GenThermostatClass,
+    ('General', 'Thermostat Fan Mode', None): GenThermostatClass,
+    ('General', 'Thermostat Operating State', None): GenThermostatClass,
+}
+DEVICE_CLASSES.update(
+    ((dev_type, None, None), functools.partial(GenTempSensorClass, sensor))
+    for dev_type, sensor in TEMP_SENSOR_CLASSES.items())
+
+
+@functools.lru_cache(maxsize=None)
+def FindDeviceClass(dev_type, sub_type, switch_type):
+  """The DEVICE_CLASSES handler of a device, None if there is none.
+
+  The most specific class wins. The answer is cached, so for every device but
+  the first of its class this is a single lookup.
+  """
+  for key in [(dev_type, sub_type, switch_type), (dev_type, None, switch_type),
+              (None, sub_type, switch_type), (None, None, switch_type)]:
+    handler = DEVICE_CLASSES.get(key)
+    if handler:
+      return handler
+  return None
+
+
+def DeviceClassName(dev):
+  return ' / '.join(str(f) for f in (dev.Type, dev.SubType, dev.SwitchType)
+                  if f is not None)
+
+
+def GenDevice(dev, view, to_f=False):
+  """Runs the DEVICE_CLASSES handler of a device of a GetDeviceViews view.
+
+  Returns (outputs, groups, missing): outputs maps output names to the
+  entries the device adds to them, groups is the Groups the device adds names
+  to and missing is the DeviceClassName of a device that is not implemented,
+  None for the others.
+  """
+  if view == 'light' and args.ignore_types:
+    if dev.HardwareName in args.ignore_types.split(','):
+      print('Skipping {} due to hardware type {}'.format(
+          dev.Name, dev.HardwareName))
+      view = None
+  groups = Groups()
+  if view is None:
+    return {}, groups, None
+  handler = FindDeviceClass(dev.Type, dev.SubType, dev.SwitchType)
+  if handler is None:
+    return {}, groups, DeviceClassName(dev)
+  outputs = handler(dev, groups, to_f)
+  automations = outputs.pop('automation', [])
+  missing = DeviceClassName(dev) if None in automations else None
+  if args.translation == 'automation' and not missing:
+    outputs['automation'] = automations
+  return outputs, groups, missing
+
+
+def ReportNotImplemented(missing):
+  """Prints the not implemented device classes GenDevice counted."""
+  if missing:
+    print('Not implemented: {}'.format(', '.join(
+        '{} ({})'.format(name, count)
+        for name, count in sorted(missing.items()))))
+
+
+def Fingerprint(dev):
+  return tuple(getattr(dev, f) for f in CONFIG_FIELDS)
+
+
+def ShardName(dev):
+  """The --shard_by shard the entities of a device go to.
+
+  Devices in several plans go to the one with the lowest idx, devices in
+  none to plan_none.
+  """
+  if args.shard_by == 'plan':
+    plans = sorted(int(p) for p in dev.PlanIDs or [] if int(p))
+    shard = 'plan_{}'.format(plans[0]) if plans else 'plan_none'
+  else:
+    shard = 'hardware_{}'.format(dev.HardwareName or 'none')
+  shard = '_'.join(filter(None, [Namespace(dev), shard]))
+  return re.sub(r'\W+', '_', shard.lower()).strip('_')
+
+
+def CollectShards(entries, mapping, sharded):
+  """Turns (shard, entry) pairs into the yaml data of an output.
+
+  The entries of mapping outputs are merged into one. If sharded, returns an
+  OrderedDict of shard name to the data of that shard instead.
+  """
+  shards = collections.OrderedDict()
+  for shard, entry in entries:
+    shard = shard if sharded else None
+    if mapping:
+      shards.setdefault(shard, {}).update(entry)
+    else:
+      shards.setdefault(shard, []).append(entry)
+  if sharded:
+    return shards
+  return shards.get(None, {} if mapping else [])
+
+
+class ConfigGenerator(object):
+  """Generates the output files from a device snapshot, caching per device.
+
+  Update() only reruns the Gen* functions for devices whose CONFIG_FIELDS
+  changed and reports which outputs need to be rewritten because of them.
+  """
+
+  def __init__(self, to_f=False):
+    self.to_f = to_f
+    self.devices = collections.OrderedDict()  # idx -> dev, in name order
+    self.generated = {}  # idx -> (fingerprint, view, outputs, groups)
+    self.scenes = []
+    self.thermostats = {
+        'automation': [], 'climate': [], 't_ids': [], 'idxs': set()}
+
+  def _Generate(self, dev, view, missing):
+    outputs, groups, name = GenDevice(dev, view, to_f=self.to_f)
+    if name:
+      missing[name] += 1
+    key = DeviceKey(dev)
+    old = self.generated.get(key)
+    self.generated[key] = (Fingerprint(dev), view, outputs, groups)
+    affected = set(outputs)
+    if old:
+      affected.update(old[2])
+      if old[3] != groups:
+        affected.add('group')
+    elif groups:
+      affected.add('group')
+    return affected
+
+  def _GenerateThermostats(self):
+    old = self.thermostats
+    self.thermostats = GetThermostats(
+        {'result': list(self.devices.values())}, to_f=self.to_f)
+    if (old['automation'] != self.thermostats['automation'] or
+        old['climate'] != self.thermostats['climate']):
+      return {'automation', 'climate'}
+    return set()
+
+  def _IsThermostatDevice(self, dev):
+    if DeviceKey(dev) in self.thermostats['idxs'] or dev.Type == 'Thermostat':
+      return True
+    return NsIdx(Namespace(dev), dev.ID.lstrip('0')).startswith(
+        tuple(self.thermostats['t_ids']))
+
+  def Load(self, views):
+    """Generates everything from a GetDeviceViews result."""
+    self.devices = collections.OrderedDict(
+        (DeviceKey(dev), dev) for dev in views['startup']['result'])
+    self.generated = {}
+    self.scenes = list(views['scene']['result'])
+    missing = collections.Counter()
+    for view in ['light', 'temp', 'utility']:
+      for dev in views[view]['result']:
+        self._Generate(dev, view, missing)
+    for idx, dev in self.devices.items():
+      if idx not in self.generated:
+        self._Generate(dev, None, missing)
+    self._GenerateThermostats()
+    ReportNotImplemented(missing)
+    return set(OUTPUT_NAMES)
+
+  def Update(self, devices, complete=False):
+    """Applies changed devices, eg from a lastupdate poll.
+
+    If complete is set, devices is the whole device list and anything missing
+    from it was deleted. Returns the names of the outputs that changed.
+    """
+    affected = set()
+    missing = collections.Counter()
+    resort = thermostats = False
+    for dev in devices:
+      key = DeviceKey(dev)
+      old = self.generated.get(key)
+      if old is None:
+        affected.add('automation')  # the startup automation lists every device
+      self.devices[key] = dev
+      if old and old[0] == Fingerprint(dev):
+        continue
+      resort = resort or old is None or old[0][0] != dev.Name
+      thermostats = thermostats or self._IsThermostatDevice(dev)
+      view = DomoticzFilter(dev) if dev.Used else None
+      affected.update(self._Generate(dev, view, missing))
+    if complete:
+      present = set(DeviceKey(dev) for dev in devices)
+      for idx in [i for i in self.devices if i not in present]:
+        thermostats = thermostats or idx in self.thermostats['idxs']
+        _, _, outputs, groups = self.generated.pop(idx)
+        del self.devices[idx]
+        affected.update(outputs)
+        affected.add('automation')
+        if groups:
+          affected.add('group')
+    if resort:
+      self.devices = collections.OrderedDict(
+          sorted(self.devices.items(), key=lambda i: i[1].Name))
+    if thermostats:
+      affected.update(self._GenerateThermostats())
+    ReportNotImplemented(missing)
+    return affected
+
+  def UpdateScenes(self, scenes):
+    """Replaces the scenes, returning the names of the outputs that changed."""
+    scenes = list(scenes)
+    if scenes == self.scenes:
+      return set()
+    self.scenes = scenes
+    return {'light', 'scene', 'group'}
+
+  def _GenerateScenes(self):
+    if not args.scenes:
+      return []
+    names = dict((idx, dev.Name) for idx, dev in self.devices.items())
+    return [GenScene(scene, names) for scene in self.scenes]
+
+  def Outputs(self, names=None, sharded=None):
+    """Assembles the yaml data of the named outputs, all of them by default.
+
+    If sharded, which defaults to whether --shard_by is given, the
+    SHARDED_OUTPUTS are split into their shards, see CollectShards.
+    """
+    names = set(names or OUTPUT_NAMES)
+    if sharded is None:
+      sharded = bool(args.shard_by)
+    ordered = []
+    for view in ['light', 'temp', 'utility']:
+      ordered.extend(
+          (ShardName(dev) if sharded else None, self.generated[idx])
+          for idx, dev in self.devices.items()
+          if self.generated[idx][1] == view)
+    scenes = self._GenerateScenes()
+    out = {}
+    for name in DEVICE_OUTPUTS:
+      if name in names:
+        out[name] = [
+            (shard, e) for shard, g in ordered for e in g[2].get(name, [])]
+    if 'light' in names:
+      out['light'].extend(
+          (SHARED_SHARD, e) for o, _ in scenes for e in o.get('light', []))
+    if 'scene' in names and args.scenes:
+      out['scene'] = [e for o, _ in scenes for e in o.get('scene', [])]
+    if 'automation' in names:
+      out['automation'].extend(
+          (SHARED_SHARD, a) for a in self.thermostats['automation'])
+      if args.priming == 'automation':
+        startup = GenStartupAutomation(
+            {'result': list(self.devices.values())})
+        # Outputs may be dumped more than once, so no generators in here.
+        startup['action'] = list(startup['action'])
+        out['automation'].append((SHARED_SHARD, startup))
+    if 'climate' in names:
+      out['climate'] = [(SHARED_SHARD, c) for c in self.thermostats['climate']]
+    for name in SHARDED_OUTPUTS:
+      if name in out:
+        out[name] = CollectShards(out[name], name in MAPPING_OUTPUTS, sharded)
+    if 'group' in names:
+      groups = Groups()
+      for _, g in ordered:
+        groups.Merge(g[3])
+      for _, added in scenes:
+        groups.Merge(added)
+      out['group'] = GenGroupYaml(groups)
+    return out
+
+  def Discovery(self):
+    """The entities --discovery publishes, see DeviceDiscovery."""
+    for idx, dev in self.devices.items():
+      for entity in DeviceDiscovery(dev, self.generated[idx][2]):
+        yield entity
+    for scene, (outputs, _) in zip(self.scenes, self._GenerateScenes()):
+      for entity in SceneDiscovery(scene, outputs):
+        yield entity
+    for entity in ThermostatDiscovery(self.thermostats):
+      yield entity
+
+
+def GenGroupYaml(groups):
+  group_yaml = GenGroupedSensors(groups)
+  for k, v in GenGroups(groups).items():
+    group_yaml[k] = v
+  return group_yaml
+
+
+def DeviceDiscovery(dev, outputs):
+  """Yields the entities of a GenDevice result that --discovery publishes.
+
+  Each as (output name, device id, device name, entity config).
+  """
+  for name, entries in outputs.items():
+    if name in DISCOVERY_COMPONENTS:
+      for entry in entries:
+        yield name, 'domoticz_' + DeviceKey(dev), dev.Name, entry
+
+
+def SceneDiscovery(scene, outputs):
+  """DeviceDiscovery for the GenScene result of a domoticz group."""
+  device_id = 'domoticz_scene_' + NsIdx(Namespace(scene), scene.idx)
+  for entry in outputs.get('light', []):
+    yield 'light', device_id, scene.Name, entry
+
+
+def ThermostatDiscovery(thermostats):
+  """DeviceDiscovery for the climate entities of a GetThermostats result."""
+  for t_id, climate in zip(thermostats['t_ids'], thermostats['climate']):
+    yield ('climate', 'domoticz_thermostat_{}'.format(t_id), climate['name'],
+           climate)
+
+
+def GenDiscoveryConfig(name, device_id, device_name, entity):
+  """Returns the (topic, config) of the discovery message for an entity.
+
+  The object id is the device id, plus what the entity name adds to the
+  device name, like _temperature, so it stays the same when either is
+  renamed in domoticz.
+  """
+  suffix = ''
+  if entity['name'].startswith(device_name):
+    suffix = ConvertName(entity['name'][len(device_name):].strip('_ '))
+  object_id = '_'.join(filter(None, [device_id, suffix]))
+  config = UnsortableOrderedDict()
+  for key, value in entity.items():
+    if key == 'platform':
+      continue
+    if isinstance(value, bytes):
+      value = value.decode('ascii')
+    config[key] = value
+  config['unique_id'] = object_id
+  config['device'] = {'identifiers': [device_id], 'name': device_name}
+  topic = '{}/{}/{}/config'.format(
+      args.discovery_prefix, DISCOVERY_COMPONENTS[name], object_id)
+  return topic, config
+
+
+def StreamOutputs(views, paths, to_f=False, discovery=None):
+  """Generates and writes every output in a single pass over the devices.
+
+  Unlike ConfigGenerator nothing is kept per device: each entity goes to its
+  file, or --shard_by file, as soon as it is generated. Only the names the
+  groups need and the utility meters, which end up sorted by name, are held
+  until the end.
+  If discovery is a list, the entities of the DISCOVERY_COMPONENTS outputs
+  are added to it, see DeviceDiscovery, instead of being written, and their
+  files are emptied.
+  Returns the names of the outputs that changed.
+  """
+  files = {}
+  writers = {}
+
+  def Writer(name, shard):
+    if not files[name].sharded:
+      shard = None
+    if (name, shard) not in writers:
+      writers[name, shard] = YamlWriter(
+          files[name].File(shard), paths[name][1])
+    return writers[name, shard]
+
+  try:
+    for name in STREAMED_OUTPUTS:
+      if discovery is not None and name in DISCOVERY_COMPONENTS:
+        continue
+      files[name] = OutputFiles(name, paths[name][0])
+      if not files[name].sharded:
+        Writer(name, None)  # written even when empty
+    groups = Groups()
+    utility = []
+    missing = collections.Counter()
+    for view in ['light', 'temp', 'utility']:
+      for dev in views[view]['result']:
+        outputs, added, name = GenDevice(dev, view, to_f=to_f)
+        groups.Merge(added)
+        if name:
+          missing[name] += 1
+        if discovery is not None:
+          discovery.extend(DeviceDiscovery(dev, outputs))
+        shard = ShardName(dev) if args.shard_by else None
+        for name, entries in outputs.items():
+          for entry in entries:
+            if name == 'utility':
+              utility.append((shard, entry))
+            elif name in files:
+              Writer(name, shard).Write(entry)
+    scenes = []
+    if args.scenes:
+      names = dict(
+          (DeviceKey(dev), dev.Name) for dev in views['startup']['result'])
+      for scene in views['scene']['result']:
+        outputs, added = GenScene(scene, names)
+        groups.Merge(added)
+        if discovery is not None:
+          discovery.extend(SceneDiscovery(scene, outputs))
+        scenes.extend(outputs.get('scene', []))
+        if 'light' in files:
+          for entry in outputs.get('light', []):
+            Writer('light', SHARED_SHARD).Write(entry)
+    thermostats = GetThermostats(views['thermostat'], to_f=to_f)
+    for entry in thermostats['automation']:
+      Writer('automation', SHARED_SHARD).Write(entry)
+    if discovery is not None:
+      discovery.extend(ThermostatDiscovery(thermostats))
+    else:
+      for entry in thermostats['climate']:
+        Writer('climate', SHARED_SHARD).Write(entry)
+    if args.priming == 'automation':
+      Writer('automation', SHARED_SHARD).Write(
+          GenStartupAutomation(views['startup']))
+    for writer in writers.values():
+      writer.Close()
+  except BaseException:
+    for f in files.values():
+      f.Abort()
+    raise
+  ReportNotImplemented(missing)
+  changed = set(name for name, f in files.items() if f.Close())
+  if discovery is not None:
+    changed.update(EmptyDiscoveryOutputs(paths))
+  utility = CollectShards(utility, True, bool(args.shard_by))
+  written = [('utility', utility), ('group', GenGroupYaml(groups))]
+  if args.scenes:
+    written.append(('scene', scenes))
+  for name, yaml_in in written:
+    if WriteOutput(name, yaml_in, *paths[name]):
+      changed.add(name)
+  return [name for name in OUTPUT_NAMES if name in changed]
+
+
+DOMOTICZ_CLIENTS = {}
+
+
+def GetClient(host):
+  """The DomoticzClient for host, shared so its connections get reused."""
+  client = DOMOTICZ_CLIENTS.get(host)
+  if client is None:
+    client = DOMOTICZ_CLIENTS.setdefault(host, DomoticzClient(
+        host, timeout=args.http_timeout, retries=args.http_retries,
+        connections=args.http_connections))
+  return client
+
+
+def FetchAll(*calls):
+  """Runs independent domoticz requests at once, returns their results.
+
+  Each call is a (function, arguments...) tuple.
+  """
+  with concurrent.futures.ThreadPoolExecutor(args.http_connections) as pool:
+    futures = [pool.submit(*call) for call in calls]
+    return [f.result() for f in futures]
+
+
+def GetDevices(host, dev_filter, only_used=True, last_update=None):
+  params = collections.OrderedDict([('type', 'devices'), ('order', 'Name')])
   if dev_filter:
-    dev_f = '&filter={dev_filter}'.format(dev_filter=dev_filter)
-  req = urllib2.Request(
-      '{base_url}?type=devices&order=Name{dev_f}{used}'.format(
-          base_url=base_url, dev_f=dev_f, used=used))
-  resp = urllib2.urlopen(req)
-  data = resp.read().decode('ascii')
-  data = json.loads(data)
+    params['filter'] = dev_filter
+  if last_update:
+    params['lastupdate'] = last_update
+  if only_used:
+    params['used'] = 'true'
+  return ParseDevices(GetClient(host).Get(params))
+
+
+def LoadDevices(path):
+  """Reads a saved /json.htm?type=devices response."""
+  with open(path, 'rb') as f:
+    return ParseDevices(json.loads(f.read().decode('utf-8')))
+
+
+def ParseDevices(data):
+  """Turns the devices of a /json.htm?type=devices response into Devices."""
+  if 'result' in data:
+    data['result'] = [Device(entry) for entry in data['result']]
+  return data
+
+
+def DomoticzFilter(dev):
+  """Which domoticz device filter ('light', 'temp', 'utility') matches dev.
+
+  Mirrors the type checks domoticz does server side for the filter parameter,
+  as far as the generator cares about them.
+  """
+  if dev.SwitchType is not None:
+    return 'light'
+  if (dev.Type in TEMP_DEVICE_TYPES or
+      (dev.Type == 'Wind' and dev.Chill is not None) or
+      (dev.Type == 'General' and dev.SubType == 'System temperature')):
+    return 'temp'
+  if dev.Type in UTILITY_DEVICE_TYPES:
+    return 'utility'
+  return None
+
+
+def GetDeviceViews(host):
+  """Fetches the device list and splits it into the views the Gen* use.
+
+  Returns a dict of view name to a devices response: 'light', 'temp' and
+  'utility' hold the used devices domoticz would return for that filter,
+  'thermostat' and 'startup' hold every device, 'scene' the GetScenes. Unless
+  --server_side_filter is given this is a single request, filtered here
+  rather than by domoticz. With --input_json the device list is read from
+  that file instead.
+  """
+  if args.input_json:
+    everything = LoadDevices(args.input_json)
+  elif args.server_side_filter:
+    everything, light, temp, utility, scenes = FetchAll(
+        (GetDevices, host, 'all', False), (GetDevices, host, 'light'),
+        (GetDevices, host, 'temp'), (GetDevices, host, 'utility'),
+        (GetScenes, host))
+    return {
+        'light': light,
+        'temp': temp,
+        'utility': utility,
+        'thermostat': everything,
+        'startup': everything,
+        'scene': scenes,
+    }
+  else:
+    everything = GetDevices(host, None, only_used=False)
+  views = {'light': [], 'temp': [], 'utility': []}
+  for dev in everything['result']:
+    dev_filter = DomoticzFilter(dev)
+    if dev_filter and dev.Used:
+      views[dev_filter].append(dev)
+  views = {k: dict(everything, result=v) for k, v in views.items()}
+  views['thermostat'] = views['startup'] = everything
+  views['scene'] = GetScenes(host)
+  return views
+
+
+def TagDevices(instance, data):
+  """Marks the devices in a domoticz response with their named instance.
+
+  Their names get the instance name in front as well, so the entity names,
+  and the entity ids home assistant makes of them, are unique across
+  instances. Devices of an instance without a name are left as they are.
+  """
+  if instance.name:
+    for dev in data.get('result', []):
+      # The views of a response share their devices.
+      if not dev.Instance:
+        dev.Instance = instance.name
+        dev.Name = '{} {}'.format(instance.name, dev.Name)
   return data
 
 
-def GetScenes():
-  req = urllib2.Request('http://localhost:8080/json.htm?type=scenes')
-  resp = rullib2.urlopen(req)
-  data = resp.read()
-  data = json.loads(data)
+def FetchViews(instances):
+  """Fetches the GetDeviceViews of every instance at once.
+
+  Returns a list of (instance, views), with the devices tagged.
+  """
+  fetched = FetchAll(*[(GetDeviceViews, i.host) for i in instances])
+  for instance, views in zip(instances, fetched):
+    for data in views.values():
+      TagDevices(instance, data)
+  return list(zip(instances, fetched))
+
+
+def MergeViews(fetched):
+  """Combines the views of FetchViews into one, in name order."""
+  if len(fetched) == 1:
+    return fetched[0][1]
+  merged = {}
+  for view in fetched[0][1]:
+    responses = [views[view] for _, views in fetched]
+    merged[view] = dict(responses[0], result=sorted(
+        itertools.chain.from_iterable(r['result'] for r in responses),
+        key=lambda d: d.Name))
+  return merged
+
+
+def GetScenes(host):
+  """Fetches the scenes and groups of domoticz as a response of Scenes.
+
+  Along with the devices of every group, one request each. Without --scenes,
+  or with --input_json, there are none.
+  """
+  if not args.scenes or args.input_json:
+    return {'result': []}
+  data = GetClient(host).Get({'type': 'scenes'})
+  data['result'] = [Scene(entry) for entry in data.get('result', [])]
+  groups = [scene for scene in data['result'] if scene.Type == 'Group']
+  members = FetchAll(*[(GetSceneDevices, host, scene.idx) for scene in groups])
+  for scene, devices in zip(groups, members):
+    scene.Devices = devices
   return data
 
 
+def GetSceneDevices(host, idx):
+  """The idxs of the devices of a domoticz scene or group."""
+  data = GetClient(host).Get(collections.OrderedDict([
+      ('type', 'command'), ('param', 'getscenedevices'), ('idx', idx),
+      ('isscene', 'false')]))
+  return tuple(str(d.get('DevRealIdx', d.get('DevID')))
+               for d in data.get('result', []))
+
+
 def MakeDirIfNotExists(dest):
+  if not dest:
+    return  # The current directory.
   try:
     os.stat(dest)
   except OSError:
     os.mkdir(dest)
 
 
-def DumpAndSpaceYaml(input_dict, delimitor_line):
+def YamlDumper(backend):
+  """Returns the yaml Dumper class to use for a --yaml_backend."""
   import yaml
-  yaml.add_representer(
+  if backend == 'python' or not yaml.__with_libyaml__:
+    dumper = yaml.Dumper
+  else:
+    dumper = yaml.CDumper
+  dumper.add_representer(
       UnsortableOrderedDict, yaml.representer.SafeRepresenter.represent_dict)
-  output = yaml.dump(
-      input_dict, default_flow_style=False, width=240).split('\n')
-  retval = []
-  for l in output:
-    if delimitor_line in l:
-      retval.append('')
-    retval.append(l)
-  return '\n'.join(retval)
+  return dumper
+
+
+# Strings yaml writes plain, as long as they do not resolve to another type.
+SAFE_PLAIN = re.compile(
+    r'[A-Za-z0-9_/(][A-Za-z0-9_/()+. -]*[A-Za-z0-9_/()+.-]\Z')
+# Printable ascii starting with an indicator, which yaml single quotes.
+MUST_QUOTE = re.compile(r'[#,\[\]{}&*!|>\'"%@`][\x20-\x7e]*\Z')
+
+
+class _NotSupported(Exception):
+  pass
+
+
+class FastYamlEmitter(object):
+  """Writes the plain shapes the Gen* functions build straight to text.
+
+  Only dicts and lists of str, int, bool and None that fit on a line are
+  handled, which is nearly everything generated. Item returns None for
+  anything else, and the caller falls back to yaml, so the output is always
+  what yaml.dump gives. Scalar quoting is decided by yaml's own analysis and
+  resolver.
+  """
+
+  WIDTH = 240
+  MAX_CACHED = 10000
+
+  def __init__(self):
+    import yaml
+    self._analyze = yaml.emitter.Emitter(None).analyze_scalar
+    self._resolve = yaml.resolver.Resolver().resolve
+    self._scalar_node = yaml.ScalarNode
+    # str -> (text as a value, text as a key), None where not supported.
+    self._strings = {}
+
+  def Item(self, value, key=None):
+    """Returns value as a top level list item, or mapping item under key."""
+    out = []
+    try:
+      if key is None:
+        self._SeqItems([value], 0, out, False)
+      else:
+        self._MapItems([(key, value)], 0, out, False)
+    except _NotSupported:
+      return None
+    return ''.join(out)
+
+  def _String(self, value):
+    # analyze_scalar is slow, and most strings are obviously fine as plain
+    # (names, topics) or obviously need quotes (templates).
+    if SAFE_PLAIN.match(value):
+      plain = True
+    elif MUST_QUOTE.match(value):
+      plain = False
+    else:
+      analysis = self._analyze(value)
+      # Anything else needs double quotes or more than a line.
+      if analysis.multiline or not analysis.allow_single_quoted:
+        return None, None
+      plain = analysis.allow_block_plain
+    # Strings that would read as something else, like "on" or "12", too.
+    plain = plain and self._resolve(
+        self._scalar_node, value, (True, False)) == 'tag:yaml.org,2002:str'
+    text = value if plain else "'" + value.replace("'", "''") + "'"
+    # Empty and long keys are written as complex "? " keys.
+    if not value or len(value) >= 100:
+      return text, None
+    return text, text
+
+  def _Scalar(self, value, column, key=False):
+    t = type(value)
+    if t is str:
+      texts = self._strings.get(value)
+      if texts is None:
+        if len(self._strings) > self.MAX_CACHED:
+          self._strings.clear()
+        texts = self._strings[value] = self._String(value)
+      text = texts[key]
+    elif key:
+      text = None
+    elif t is bool:
+      text = 'true' if value else 'false'
+    elif t is int:
+      text = str(value)
+    elif value is None:
+      text = 'null'
+    else:
+      text = None
+    # yaml folds long lines, leave those to it.
+    if text is None or column + len(text) > self.WIDTH:
+      raise _NotSupported()
+    return text
+
+  def _SeqItems(self, items, indent, out, inline):
+    for value in items:
+      out.append('-' if inline else ' ' * indent + '-')
+      inline = False
+      text = self._Value(value, indent + 2)
+      if text is not None:
+        out.append(text)
+      elif type(value) in (list, UnsortableList):
+        out.append(' ')
+        self._SeqItems(value, indent + 2, out, True)
+      else:
+        out.append(' ')
+        self._MapItems(self._Sorted(value), indent + 2, out, True)
+
+  def _MapItems(self, items, indent, out, inline):
+    for key, value in items:
+      key = self._Scalar(key, indent, key=True)
+      out.append(key + ':' if inline else ' ' * indent + key + ':')
+      inline = False
+      text = self._Value(value, indent + len(key) + 2)
+      if text is not None:
+        out.append(text)
+      elif type(value) in (list, UnsortableList):
+        # Lists in a mapping are not indented further.
+        out.append('\n')
+        self._SeqItems(value, indent, out, False)
+      else:
+        out.append('\n')
+        self._MapItems(self._Sorted(value), indent + 2, out, False)
+
+  def _Value(self, value, column):
+    """Returns a scalar or empty value as text, or None for a collection."""
+    t = type(value)
+    if t is dict or t is UnsortableOrderedDict:
+      return None if value else ' {}\n'
+    if t is list or t is UnsortableList:
+      return None if value else ' []\n'
+    return ' ' + self._Scalar(value, column) + '\n'
+
+  @staticmethod
+  def _Sorted(mapping):
+    try:
+      return sorted(mapping.items(), key=lambda i: i[0])
+    except TypeError:
+      raise _NotSupported()
+
+
+def HasComplexKeys(data):
+  """Whether data has keys that are written as "? " keys by the python emitter.
+
+  libyaml writes those, empty and long keys, as simple keys instead.
+  Generators are not looked into.
+  """
+  if isinstance(data, dict):
+    for key, value in data.items():
+      if not isinstance(key, str) or not key or len(key) >= 100:
+        return True
+      if HasComplexKeys(value):
+        return True
+  elif isinstance(data, list):
+    for value in data:
+      if HasComplexKeys(value):
+        return True
+  return False
+
+
+def Materialize(data):
+  """Returns data with its generators turned into lists."""
+  if isinstance(data, types.GeneratorType):
+    return [Materialize(d) for d in data]
+  if isinstance(data, dict) and any(
+      isinstance(v, types.GeneratorType) for v in data.values()):
+    return type(data)((k, Materialize(v)) for k, v in data.items())
+  return data
+
+
+class MergeKey(str):
+  """The yaml << key, whose value's items are merged into its mapping."""
+
+  @staticmethod
+  def Represent(dumper, data):
+    return dumper.represent_scalar('tag:yaml.org,2002:merge', '<<')
+
+
+MERGE = MergeKey('<<')
+
+
+def ShareRepeated(data, min_size=24):
+  """Returns data with its repeated parts shared.
+
+  Equal dicts and lists are replaced by a single object, which yaml writes
+  with an anchor the first time and as an alias after that. Of dicts that are
+  not repeated as a whole, the items they share with other dicts are moved
+  into a dict of their own, that is merged back in with a << key.
+  Only parts of at least min_size characters of scalars and keys are shared,
+  smaller ones are not worth an alias.
+  """
+  # id -> (hashable key, size, items) of every dict and list, so each is
+  # walked once.
+  keys = {}
+  counts = collections.Counter()
+  item_counts = collections.Counter()
+
+  def Key(value):
+    if isinstance(value, dict):
+      items = [(k,) + Key(v) for k, v in value.items()]
+      try:
+        items.sort(key=lambda i: i[0])
+      except TypeError:
+        pass
+      key = ('dict', tuple((k, vk) for k, vk, _ in items))
+      size = sum(len(str(k)) + vs for k, _, vs in items)
+      item_counts.update(key[1])
+    elif isinstance(value, list):
+      items = [Key(v) for v in value]
+      key = ('list', tuple(k for k, _ in items))
+      size = sum(s for _, s in items)
+    else:
+      return (type(value).__name__, value), len(str(value))
+    keys[id(value)] = (key, size, items)
+    counts[key] += 1
+    return key, size
+
+  def Repeated(key, size):
+    return counts[key] > 1 and size >= min_size
+
+  def MergeCandidates(key, size, items):
+    """The sets of items of a dict worth moving to a merged dict, as keys.
+
+    From the items most dicts have to all items some other dict has too, as
+    a dict with a few items more common than the rest is left with just
+    those, eg a common template next to a topic of one device.
+    """
+    if key[0] != 'dict' or Repeated(key, size):
+      return []
+    candidates = []
+    for least in sorted(set(item_counts[k, vk] for k, vk, _ in items),
+                        reverse=True):
+      if least < 2:
+        break
+      merged = [i for i in items if item_counts[i[0], i[1]] >= least]
+      if len(merged) == len(items):
+        break
+      # Values that are aliased anyway only save their alias.
+      if sum(len(str(k)) + (6 if Repeated(vk, vs) else vs)
+             for k, vk, vs in merged) >= min_size:
+        candidates.append(('merged', tuple((k, vk) for k, vk, _ in merged)))
+    return candidates
+
+  shared = {}
+
+  def Share(value):
+    if isinstance(value, dict):
+      new = type(value)((k, Share(v)) for k, v in value.items())
+    elif isinstance(value, list):
+      new = [Share(v) for v in value]
+    else:
+      return value
+    key, size, _ = keys[id(value)]
+    if Repeated(key, size):
+      return shared.setdefault(key, new)
+    merged = merged_items.get(id(value))
+    if merged:
+      merged_keys = set(k for k, _ in merged[1])
+      base = shared.setdefault(merged, type(value)(
+          (k, v) for k, v in new.items() if k in merged_keys))
+      # The << key does not sort with the others, so they are put in order
+      # here and yaml leaves the order as is.
+      rest = [(k, v) for k, v in new.items() if k not in merged_keys]
+      try:
+        rest.sort(key=lambda i: i[0])
+      except TypeError:
+        pass
+      return type(value)([(MERGE, base)] + rest)
+    return new
+
+  Key(data)
+  candidates = {i: MergeCandidates(*record) for i, record in keys.items()}
+  merged_counts = collections.Counter(
+      itertools.chain.from_iterable(candidates.values()))
+  # The largest set of items some other dict shares, per dict.
+  merged_items = {}
+  for value_id, merged in candidates.items():
+    merged = [m for m in merged if merged_counts[m] > 1]
+    if merged:
+      merged_items[value_id] = merged[-1]
+  return Share(data)
+
+
+class YamlWriter(object):
+  """Emits a yaml list (or mapping) one entry at a time.
+
+  The result is exactly what yaml.dump of the whole list would give, plus a
+  blank line before every line containing delimitor_line, but only the entry
+  being written is ever held in memory. Entries may contain generators, which
+  are written as lists, item by item.
+
+  With anchors, the entries are kept until Close() instead, and written with
+  their repeated parts shared, see ShareRepeated.
+  """
+
+  def __init__(self, f, delimitor_line, mapping=False, backend=None,
+               anchors=None):
+    import yaml
+    backend = backend or args.yaml_backend
+    if anchors is None:
+      anchors = args.yaml_anchors
+    self._yaml = yaml
+    self._f = f
+    self._delimitor_line = delimitor_line
+    self._partial = []
+    self._mapping = mapping
+    self._python_dumper = YamlDumper('python')
+    self._dumper_class = YamlDumper(backend)
+    self._dumper = None
+    self._fast = None
+    self._empty = True
+    if backend == 'fast':
+      self._fast = FastYamlEmitter()
+    # An entry has the same text as a document of its own as it has in a
+    # longer one. With anything but the python emitter every entry is written
+    # that way, so the emitter can be picked per entry.
+    self._per_entry = self._fast or self._dumper_class is not self._python_dumper
+    self._kept = None
+    if anchors:
+      self._kept = {} if mapping else []
+    elif not self._per_entry:
+      self._Open(self._dumper_class)
+
+  def _Open(self, dumper_class):
+    self._dumper = dumper_class(self, default_flow_style=False, width=240)
+    # CDumper does not set up the python serializer state _Serialize uses.
+    self._ResetSerializer()
+    self._dumper.last_anchor_id = 0
+    self._dumper.open()
+    self._dumper.emit(self._yaml.DocumentStartEvent())
+    self._StartCollection(self._mapping)
+
+  def _Close(self):
+    if self._mapping:
+      self._dumper.emit(self._yaml.MappingEndEvent())
+    else:
+      self._dumper.emit(self._yaml.SequenceEndEvent())
+    self._dumper.emit(self._yaml.DocumentEndEvent())
+    self._dumper.close()
+    self._dumper = None
+
+  def _StartCollection(self, mapping):
+    if mapping:
+      self._dumper.emit(self._yaml.MappingStartEvent(
+          None, 'tag:yaml.org,2002:map', True, flow_style=False))
+    else:
+      self._dumper.emit(self._yaml.SequenceStartEvent(
+          None, 'tag:yaml.org,2002:seq', True, flow_style=False))
+
+  def _ResetSerializer(self):
+    dumper = self._dumper
+    dumper.represented_objects = {}
+    dumper.object_keeper = []
+    dumper.alias_key = None
+    dumper.anchors = {}
+    dumper.serialized_nodes = {}
+
+  def _Serialize(self, data):
+    if isinstance(data, types.GeneratorType):
+      self._StartCollection(False)
+      for item in data:
+        self._Serialize(item)
+      self._dumper.emit(self._yaml.SequenceEndEvent())
+    elif isinstance(data, dict) and any(
+        isinstance(v, types.GeneratorType) for v in data.values()):
+      self._StartCollection(True)
+      for key, value in sorted(data.items(), key=lambda i: i[0]):
+        self._Serialize(key)
+        self._Serialize(value)
+      self._dumper.emit(self._yaml.MappingEndEvent())
+    else:
+      dumper = self._dumper
+      node = dumper.represent_data(data)
+      dumper.anchor_node(node)
+      dumper.serialize_node(node, None, None)
+      self._ResetSerializer()
+
+  def _Write(self, data):
+    self._empty = False
+    if self._kept is not None:
+      if self._mapping:
+        self._kept[data[0]] = Materialize(data[1])
+      else:
+        self._kept.append(Materialize(data[0]))
+      return
+    if not self._per_entry:
+      for d in data:
+        self._Serialize(d)
+      return
+    if self._fast:
+      text = self._fast.Item(*reversed(data))
+      if text is not None:
+        self.write(text)
+        return
+    dumper_class = self._dumper_class
+    if any(HasComplexKeys(d) for d in data) or (
+        len(data) == 2 and HasComplexKeys({data[0]: None})):
+      dumper_class = self._python_dumper
+    self._Open(dumper_class)
+    for d in data:
+      self._Serialize(d)
+    self._Close()
+
+  def Write(self, entry):
+    self._Write((entry,))
+
+  def WriteItem(self, key, value):
+    self._Write((key, value))
+
+  def _WriteShared(self):
+    data = ShareRepeated(self._kept)
+    dumper_class = self._dumper_class
+    if HasComplexKeys(data):
+      dumper_class = self._python_dumper
+    dumper_class.add_representer(MergeKey, MergeKey.Represent)
+    self._yaml.dump(
+        data, self, Dumper=dumper_class, default_flow_style=False, width=240)
+
+  def Close(self):
+    if self._kept is not None:
+      self._WriteShared()
+    elif self._empty and not self._dumper:
+      self._Open(self._dumper_class)
+    if self._dumper:
+      self._Close()
+    self._WriteLines(''.join(self._partial).split('\n'), last=True)
+
+  def _WriteLines(self, lines, last=False):
+    out = []
+    for l in lines:
+      if self._delimitor_line in l:
+        out.append('')
+      out.append(l)
+    if not last:
+      out.append('')
+    self._f.write('\n'.join(out))
+
+  # The file interface the yaml emitter writes through.
+  def write(self, data):
+    self._partial.append(data)
+    if '\n' in data:
+      lines = ''.join(self._partial).split('\n')
+      self._partial = [lines.pop()]
+      self._WriteLines(lines)
+
+  def flush(self):
+    pass
+
+
+def DumpYaml(yaml_in, f, delimitor_line):
+  """Streams a list (or any iterable) or a dict of entries to f."""
+  if isinstance(yaml_in, dict):
+    writer = YamlWriter(f, delimitor_line, mapping=True)
+    # yaml.dump sorts mapping keys, so this one cannot be streamed in order.
+    for key, value in sorted(yaml_in.items(), key=lambda i: i[0]):
+      writer.WriteItem(key, value)
+  else:
+    writer = YamlWriter(f, delimitor_line)
+    for entry in yaml_in:
+      writer.Write(entry)
+  writer.Close()
+
+
+def DumpAndSpaceYaml(input_dict, delimitor_line):
+  out = io.StringIO()
+  DumpYaml(input_dict, out, delimitor_line)
+  return out.getvalue()
 
 
 def CheckForYamlPackage():
@@ -733,21 +2364,578 @@ def PrintDestinations(
   print('  utility       : {}'.format(utility_path))
 
 
-def WriteFile(yaml_in, path, delimitor_line):
-  MakeDirIfNotExists(os.path.dirname(path))
-  with open(path, 'w') as f:
-    f.truncate()
-    f.write(DumpAndSpaceYaml(yaml_in, delimitor_line))
+def HashFile(path):
+  digest = hashlib.sha256()
+  try:
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(65536), b''):
+        digest.update(chunk)
+  except OSError:
+    return None
+  return digest.hexdigest()
+
+
+class ReplaceIfChanged(object):
+  """Text file that replaces path on Close(), if its content is different.
+
+  The content goes to a temp file next to path and is hashed on the way, then
+  renamed over path atomically, so home assistant never sees a half written
+  config, and an identical file is left alone.
+  """
+
+  def __init__(self, path):
+    MakeDirIfNotExists(os.path.dirname(path))
+    self.path = path
+    fd, self._tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    self._file = os.fdopen(fd, 'wb')
+    self._digest = hashlib.sha256()
+
+  def write(self, text):
+    data = text.encode('utf-8')
+    self._digest.update(data)
+    self._file.write(data)
+
+  def Abort(self):
+    if not self._file.closed:
+      self._file.close()
+      os.unlink(self._tmp_path)
+
+  def Close(self):
+    """Returns whether path changed."""
+    self._file.close()
+    try:
+      if self._digest.hexdigest() == HashFile(self.path):
+        os.unlink(self._tmp_path)
+        return False
+      try:
+        mode = os.stat(self.path).st_mode & 0o777
+      except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+      os.chmod(self._tmp_path, mode)
+      os.replace(self._tmp_path, self.path)
+    except BaseException:
+      if os.path.exists(self._tmp_path):
+        os.unlink(self._tmp_path)
+      raise
+    return True
+
+
+class OutputFiles(object):
+  """The ReplaceIfChanged files an output is written to.
+
+  That is just path, unless --shard_by splits the output. Then every shard
+  goes to a file of its own in the output's dir in --shard_dir, path becomes
+  an index including that dir, and the files of shards that are gone are
+  removed on Close().
+  """
+
+  def __init__(self, name, path):
+    self.path = path
+    self.sharded = bool(args.shard_by) and name in SHARDED_OUTPUTS
+    self._include = '!include_dir_merge_list'
+    if name in MAPPING_OUTPUTS:
+      self._include = '!include_dir_merge_named'
+    self._dir = os.path.abspath(os.path.join(args.shard_dir, name))
+    self._files = collections.OrderedDict()
+    if self.sharded:
+      os.makedirs(self._dir, exist_ok=True)
+
+  def File(self, shard=None):
+    """The file of a shard, or of the whole output if it is not sharded."""
+    if not self.sharded:
+      shard = None
+    f = self._files.get(shard)
+    if f is None:
+      path = self.path
+      if shard is not None:
+        path = os.path.join(self._dir, shard + '.yaml')
+      f = self._files[shard] = ReplaceIfChanged(path)
+    return f
+
+  def Abort(self):
+    for f in self._files.values():
+      f.Abort()
+
+  def Close(self):
+    """Returns whether any file changed."""
+    changed = [f.Close() for f in self._files.values()]
+    if self.sharded:
+      written = set(os.path.basename(f.path) for f in self._files.values())
+      for entry in sorted(os.listdir(self._dir)):
+        if entry.endswith('.yaml') and entry not in written:
+          os.unlink(os.path.join(self._dir, entry))
+          changed.append(True)
+      # The index only changes when the dirs are moved.
+      index = ReplaceIfChanged(self.path)
+      index.write('{} {}\n'.format(
+          self._include,
+          os.path.relpath(self._dir, os.path.dirname(self.path))))
+      changed.append(index.Close())
+    return any(changed)
+
+
+def WriteOutput(name, yaml_in, path, delimitor_line):
+  """Streams an output to path, unless the file already holds exactly that.
+
+  If --shard_by splits the output, yaml_in maps shards to their data and
+  each is written to its OutputFiles file instead. Returns whether any file
+  changed.
+  """
+  files = OutputFiles(name, path)
+  try:
+    for shard, data in (yaml_in.items() if files.sharded else [(None, yaml_in)]):
+      DumpYaml(data, files.File(shard), delimitor_line)
+  except BaseException:
+    files.Abort()
+    raise
+  return files.Close()
+
+
+def EmptyDiscoveryOutputs(paths):
+  """Empties the files of the outputs --discovery publishes instead.
+
+  Entities an earlier run without --discovery left in them would be in home
+  assistant twice. Returns the names of those that changed.
+  """
+  return WriteOutputs(dict(
+      (name, CollectShards([], False, bool(args.shard_by)))
+      for name in DISCOVERY_COMPONENTS), paths)
+
+
+def WriteOutputs(outputs, paths):
+  """Writes the given outputs, returning the names of those that changed."""
+  changed = []
+  for name in OUTPUT_NAMES:
+    if name in outputs:
+      path, delimitor_line = paths[name]
+      if WriteOutput(name, outputs[name], path, delimitor_line):
+        changed.append(name)
+  return changed
+
+
+def ReportChanges(changed, paths):
+  if not changed:
+    print('No files changed')
+  for name in changed:
+    print('Changed: {}'.format(paths[name][0]))
+  if args.changed_domains_file:
+    domains = sorted(set(OUTPUT_DOMAINS[name] for name in changed))
+    with open(args.changed_domains_file, 'w') as f:
+      f.write(''.join(d + '\n' for d in domains))
+
+
+def Watch(instances, paths, to_f=False):
+  """Regenerates the outputs whenever domoticz reports changed devices."""
+  generator = ConfigGenerator(to_f=to_f)
+  discovery_pending = False
+
+  def Regenerate(changed, emptied=()):
+    nonlocal discovery_pending
+    written = [name for name in changed
+               if not args.discovery or name not in DISCOVERY_COMPONENTS]
+    if changed:
+      rewritten = set(emptied)
+      if written:
+        rewritten.update(WriteOutputs(generator.Outputs(written), paths))
+      ReportChanges([name for name in OUTPUT_NAMES if name in rewritten], paths)
+    discovery_pending = discovery_pending or len(written) < len(changed)
+    if discovery_pending:
+      try:
+        asyncio.run(PublishDiscovery(generator.Discovery()))
+        discovery_pending = False
+      except (OSError, EOFError, asyncio.TimeoutError, MqttError) as e:
+        print('Publishing discovery configs failed ({!r}), will retry'.format(e))
+
+  fetched = FetchViews(instances)
+  # Every domoticz has a clock of its own.
+  last_update = [views['startup'].get('ActTime') for _, views in fetched]
+  emptied = EmptyDiscoveryOutputs(paths) if args.discovery else []
+  Regenerate(generator.Load(MergeViews(fetched)), emptied)
+  last_full = time.time()
+  while True:
+    time.sleep(args.watch_interval)
+    # lastupdate never reports deleted devices, so fetch everything now and then.
+    complete = time.time() - last_full >= args.watch_full_refresh
+    scenes = None
+    try:
+      if args.input_json:
+        complete = True
+        responses = [LoadDevices(args.input_json)]
+      else:
+        responses = FetchAll(*[
+            (GetDevices, i.host, None, False, None if complete else last)
+            for i, last in zip(instances, last_update)])
+        # Scenes cannot be polled for changes, they come with the full fetch.
+        if complete:
+          scenes = FetchAll(*[(GetScenes, i.host) for i in instances])
+    except (OSError, ValueError) as e:
+      print('Polling domoticz failed: {}'.format(e))
+      continue
+    if complete:
+      last_full = time.time()
+    devices = []
+    for i, data in enumerate(responses):
+      last_update[i] = data.get('ActTime', last_update[i])
+      devices.extend(TagDevices(instances[i], data).get('result', []))
+    changed = generator.Update(devices, complete=complete)
+    if scenes is not None:
+      changed.update(generator.UpdateScenes(sorted(
+          itertools.chain.from_iterable(
+              TagDevices(i, data)['result']
+              for i, data in zip(instances, scenes)),
+          key=lambda scene: scene.Name)))
+    if changed:
+      print('Regenerating {}'.format(', '.join(sorted(changed))))
+      Regenerate(changed)
+    elif discovery_pending:
+      Regenerate([])
 
 
 def ConvertName(name):
   return name.lower().replace(' ', '_').replace('\'', '')
 
+
+def GenThermostatTranslators(t, temp):
+  """Returns (idx, topic, translator) for each device of a FindThermostats entry."""
+  translators = []
+  out_topic = OutTopic(t['ns'])
+  for idx, sub, translator in [
+      (t['t_idx'], 'temp', functools.partial(TranslateClimateTemp, temp)),
+      (t['hset_idx'], 'target', functools.partial(
+          TranslateClimateTarget, temp, FloatFilter(CLIMATE_MAX_TEMP))),
+      (t['tmode_idx'], 'mode', functools.partial(TranslateMode, t['t_modes_rev'])),
+      (t['tstate_idx'], 'action', TRANSLATE_THERMOSTAT_STATE),
+      (t['fmode_idx'], 'mode', functools.partial(TranslateMode, t['f_modes_rev']))]:
+    if idx:
+      translators.append((
+          idx, '{}/climate/{}/{}'.format(out_topic, idx, sub),
+          translator))
+  return translators
+
+
+def GenTranslators(views, to_f=False, energy=None):
+  """Compiles the idx -> ((topic, translator), ...) table the bridge uses.
+
+  Devices are picked from GetDeviceViews exactly like main() picks them for
+  the automations. The views are those of a single domoticz, as the idx in a
+  message is only unique within its instance. With an EnergyTotals, the kWh
+  meters get their totals published as well.
+  """
+  temp = ToF if to_f else FloatFilter
+  temp_translators = dict(
+      (t, functools.partial(fn, temp)) for t, fn in TEMP_TRANSLATORS.items())
+  table = collections.defaultdict(list)
+  for dev in views['light']['result']:
+    if args.ignore_types:
+      if dev.HardwareName in args.ignore_types.split(','):
+        continue
+    for kind, translator in SWITCH_TRANSLATORS.get(dev.SwitchType, ()):
+      table[int(dev.idx)].append((
+          StatusTopic(dev, kind),
+          translator))
+
+  for dev in views['temp']['result']:
+    translator = temp_translators.get(dev.Type)
+    if translator:
+      table[int(dev.idx)].append((
+          StatusTopic(dev, 'sensor'), translator))
+
+  for dev in views['utility']['result']:
+    if dev.SubType == 'kWh':
+      table[int(dev.idx)].append((
+          StatusTopic(dev, 'sensor'), TranslateUtilitySensor))
+      if energy:
+        table[int(dev.idx)].append((
+            StatusTopic(dev, 'energy'),
+            functools.partial(energy.Translate, DeviceKey(dev))))
+
+  for t in FindThermostats(views['thermostat']):
+    for idx, topic, translator in GenThermostatTranslators(t, temp):
+      table[int(idx)].append((topic, translator))
+  return dict((idx, tuple(translators)) for idx, translators in table.items())
+
+
+def StateMessages(views, table):
+  """Yields (topic, payload) with the current state for every status topic."""
+  for dev in views['startup']['result']:
+    translators = table.get(int(dev.idx))
+    if translators:
+      for topic_payload in Translate(translators, DeviceStateMessage(dev)):
+        yield topic_payload
+
+
+def GenEnergyTotals(shared=False):
+  return EnergyTotals(
+      args.energy_state, args.energy_checkpoint, shared=shared)
+
+
+def GenMqttClient(client_id='domoticz_hass_bridge'):
+  return MqttClient(
+      args.mqtt_host, args.mqtt_port, client_id=client_id,
+      username=args.mqtt_username, password=args.mqtt_password)
+
+
+async def PublishStates(client, views, table, cache=None):
+  """Publishes the state of every device, retained. Returns the topic count."""
+  count = 0
+  for topic, payload in StateMessages(views, table):
+    await client.Publish(topic, payload, retain=True)
+    if cache:
+      cache.Record(topic, payload)
+    count += 1
+  return count
+
+
+async def Prime(instances, to_f=False):
+  energy = GenEnergyTotals() if args.energy == 'bridge' else None
+  tables = [(views, GenTranslators(views, to_f=to_f, energy=energy))
+            for _, views in FetchViews(instances)]
+  count = 0
+  client = GenMqttClient()
+  try:
+    await client.Connect()
+    for views, table in tables:
+      count += await PublishStates(client, views, table)
+  finally:
+    await client.Close()
+    if energy:
+      energy.Save()
+  print('Primed {} status topics from {} devices'.format(
+      count, sum(len(table) for _, table in tables)))
+
+
+async def PublishDiscovery(entities):
+  """Brings the retained discovery configs in line with the entities.
+
+  entities are DeviceDiscovery tuples. The configs already on the broker are
+  read first, so only new and changed entities are published, and the
+  configs of entities that are gone are cleared.
+  """
+  configs = collections.OrderedDict(GenDiscoveryConfig(*e) for e in entities)
+  subscription = '{}/+/+/config'.format(args.discovery_prefix)
+  prefix_levels = args.discovery_prefix.count('/') + 1
+  retained = {}
+  published = removed = 0
+  # Its own client id, so a running bridge is not kicked off the broker.
+  client = GenMqttClient('domoticz_hass_discovery')
+  try:
+    await client.Connect()
+    await client.Subscribe(subscription)
+    async for topic, payload in client.Messages(idle=DISCOVERY_WAIT):
+      object_id = topic.split('/')[prefix_levels + 1]
+      if object_id.startswith('domoticz_'):
+        retained[topic] = payload
+    await client.Unsubscribe(subscription)
+    for topic, config in configs.items():
+      try:
+        unchanged = json.loads(retained.get(topic, b'null')) == config
+      except ValueError:
+        unchanged = False
+      if not unchanged:
+        await client.Publish(topic, json.dumps(config), retain=True)
+        published += 1
+    for topic in retained:
+      if topic not in configs:
+        # An empty retained config removes the entity.
+        await client.Publish(topic, b'', retain=True)
+        removed += 1
+  finally:
+    await client.Close()
+  print('Discovery: {} entities, published {}, removed {}'.format(
+      len(configs), published, removed))
+
+
+def BridgeWorker(options, worker, conn):
+  """Entry point of a BridgeWorkers process."""
+  global args
+  args = options
+  signal.signal(signal.SIGTERM, signal.default_int_handler)
+  try:
+    asyncio.run(RunBridgeWorker(worker, conn))
+  except KeyboardInterrupt:
+    pass
+
+
+async def RunBridgeWorker(worker, conn):
+  """Translates and publishes the messages of the devices a worker owns.
+
+  Gets ('load', FetchViews result) whenever the bridge (re)connected, then
+  batches of (namespace, payload). Does what RunBridge does with them
+  otherwise, including --priming retained and --publish_on_change, for its
+  own devices only.
+  """
+  retain = args.priming == 'retained'
+  cache = None
+  if args.publish_on_change:
+    cache = StateCache(args.deadband, args.min_interval)
+  energy = GenEnergyTotals(shared=True) if args.energy == 'bridge' else None
+  client = None
+  tables = {}
+  try:
+    while True:
+      try:
+        item = await Receive(conn)
+      except EOFError:
+        return  # the bridge is gone
+      if item is None:
+        return
+      if isinstance(item, tuple):
+        fetched = item[1]
+        tables = dict(
+            (i.name, PartitionTable(
+                GenTranslators(views, to_f=args.fahrenheit, energy=energy),
+                i.name, worker, args.bridge_workers))
+            for i, views in fetched)
+        if cache:
+          cache.Clear()
+      try:
+        if client is None:
+          client = GenMqttClient('domoticz_hass_bridge_{}'.format(worker))
+          await client.Connect()
+        if isinstance(item, tuple):
+          if retain:
+            for i, views in fetched:
+              await PublishStates(client, views, tables[i.name], cache)
+          continue
+        for ns, payload in item:
+          for topic, out in TranslateMessage(tables[ns], payload):
+            if cache is None or cache.Check(topic, out):
+              await client.Publish(topic, out, retain=retain)
+      except (OSError, EOFError, asyncio.TimeoutError, MqttError) as e:
+        print('Bridge worker {} lost the mqtt connection ({!r})'.format(
+            worker, e))
+        await client.Close()
+        client = None
+  finally:
+    if client:
+      await client.Close()
+    if energy:
+      energy.Save()
+
+
+async def RunBridge(instances, to_f=False):
+  retain = args.priming == 'retained'
+  # Workers translate, so they keep the state caches and energy totals.
+  workers = None
+  if args.bridge_workers > 1:
+    workers = BridgeWorkers(args.bridge_workers, BridgeWorker, (args,))
+  cache = energy = None
+  if args.publish_on_change and not workers:
+    cache = StateCache(args.deadband, args.min_interval)
+  if args.energy == 'bridge' and not workers:
+    energy = GenEnergyTotals()
+  # Subscription -> namespace of the domoticz messages arriving on it.
+  routes = collections.OrderedDict()
+  for i in instances:
+    if args.routing == 'topic':
+      routes[args.idx_topic.format(prefix=i.topic_prefix, idx='+')] = i.name
+    else:
+      routes[OutTopic(i.name)] = i.name
+  # Command topic -> namespace, of the instances whose commands are queued.
+  commands = collections.OrderedDict(
+      (CommandTopic(i.name), i.name) for i in instances
+      if CommandTopic(i.name) != InTopic(i.name))
+
+  def Route(topic):
+    if topic in routes:
+      return routes[topic]
+    for pattern, ns in routes.items():
+      if TopicMatches(pattern, topic):
+        return ns
+    return None
+
+  try:
+    while True:
+      client = GenMqttClient()
+      pipelines = {}
+      try:
+        await client.Connect()
+        for topic in itertools.chain(routes, commands):
+          await client.Subscribe(topic)
+        # Fetched after subscribing, so no update falls in between. Anything
+        # arriving meanwhile waits, and is newer than what is primed.
+        fetched = await asyncio.get_running_loop().run_in_executor(
+            None, FetchViews, instances)
+        tables = dict(
+            (i.name, GenTranslators(views, to_f=to_f, energy=energy))
+            for i, views in fetched)
+        print('Bridging {} devices from {} to mqtt {}:{}'.format(
+            sum(len(table) for table in tables.values()),
+            ', '.join(i.host for i in instances), args.mqtt_host,
+            args.mqtt_port))
+        if workers:
+          workers.Load(fetched, tables)
+        if cache:
+          cache.Clear()
+        if retain and not workers:
+          for i, views in fetched:
+            await PublishStates(client, views, tables[i.name], cache)
+        for i, views in fetched:
+          if CommandTopic(i.name) in commands:
+            hardware = dict((int(dev.idx), dev.HardwareName)
+                            for dev in views['startup']['result'])
+            pipelines[CommandTopic(i.name)] = CommandPipeline(
+                client.Publish, hardware, args.hardware_command_rate,
+                args.command_rate, topic=InTopic(i.name))
+        async for in_topic, payload in client.Messages():
+          pipeline = pipelines.get(in_topic)
+          if pipeline:
+            pipeline.Submit(payload)
+            continue
+          ns = Route(in_topic)
+          if ns not in tables:
+            continue
+          if workers:
+            workers.Submit(ns, payload)
+            continue
+          for topic, out in TranslateMessage(tables[ns], payload):
+            if cache is None or cache.Check(topic, out):
+              await client.Publish(topic, out, retain=retain)
+      except DomoticzError as e:
+        print('Getting the devices failed ({}), retrying'.format(e))
+      except (OSError, EOFError, asyncio.TimeoutError, MqttError) as e:
+        print('Lost the mqtt connection ({!r}), reconnecting'.format(e))
+      finally:
+        for pipeline in pipelines.values():
+          pipeline.Close()
+        await client.Close()
+        if energy:
+          energy.Save()
+      await asyncio.sleep(5)
+  finally:
+    if workers:
+      workers.Close()
+
+
 def main():
   CheckForYamlPackage()
   global args
   args = parser.parse_args()
+  if args.yaml_backend == 'libyaml':
+    import yaml
+    if not yaml.__with_libyaml__:
+      parser.error('--yaml_backend libyaml: pyyaml was built without libyaml')
+  if args.publish_on_change and args.priming != 'retained':
+    parser.error('--publish_on_change needs --priming retained')
+  if args.energy == 'bridge' and args.translation != 'bridge':
+    parser.error('--energy bridge needs --translation bridge')
+  if args.input_json and len(args.host) > 1:
+    parser.error('--input_json holds the devices of a single domoticz')
   to_f = args.fahrenheit
+  if args.bridge:
+    # Stopping the daemon unwinds it like ^C does, so it saves its state.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+      asyncio.run(RunBridge(args.host, to_f=to_f))
+    except KeyboardInterrupt:
+      pass
+    return
+  if args.prime:
+    asyncio.run(Prime(args.host, to_f=to_f))
+    return
   automation_path = os.path.abspath(
       os.path.join(args.automation_dir, args.automation_file))
   binary_sensor_path = os.path.abspath(
@@ -757,6 +2945,7 @@ def main():
   group_path = os.path.abspath(os.path.join(args.group_dir, args.group_file))
   light_path = os.path.abspath(os.path.join(args.light_dir, args.light_file))
   lock_path = os.path.abspath(os.path.join(args.lock_dir, args.lock_file))
+  scene_path = os.path.abspath(os.path.join(args.scene_dir, args.scene_file))
   power_path = os.path.abspath(os.path.join(args.sensor_dir, args.power_file))
   sensor_path = os.path.abspath(os.path.join(args.sensor_dir, args.sensor_file))
   utility_path = os.path.abspath(os.path.join(args.power_dir, args.power_file))
@@ -770,75 +2959,37 @@ def main():
       power_path,
       sensor_path,
       utility_path)
-
-  host = args.host
-  automation_yaml_out = []
-  sensors_yaml_out = []
-  binary_sensors_yaml_out = []
-  lights_yaml_out = []
-  lock_yaml_out = []
-  power_yaml_out = []
-  utility_yaml_out = {}
-
-  # Light/Binary sensor automation
-  data = GetDevices(host=host, dev_filter='light')
-  for dev in data['result']:
-    if args.ignore_types:
-      if dev['HardwareName'] in args.ignore_types.split(','):
-        print('Skipping {} due to hardware type {}'.format(
-            dev['Name'], dev['HardwareName']))
-        continue
-    if dev['SwitchType'] in ['Motion Sensor', 'Door Contact', 'Contact']:
-      automation_yaml_out.append(GenBinarySensorAutomation(dev))
-      binary_sensors_yaml_out.append(GenBinarySensor(dev))
-    if dev['SwitchType'] in ['On/Off', 'Dimmer', 'Push On Button']:
-      automation_yaml_out.append(GenLightAutomation(dev))
-      lights_yaml_out.append(GenLightConfigs(dev))
-    if dev['SwitchType'] == 'Dimmer':
-      automation_yaml_out.append(GenDimmerAutomation(dev))
-    if dev['SwitchType'] == 'Door Lock':
-      automation_yaml_out.append(GenLockAutomation(dev))
-      lock_yaml_out.append(GenLockConfigs(dev))
-
-  # Temp/Humidity automation
-  data = GetDevices(host=host, dev_filter='temp')
-  for dev in data['result']:
-    automation_yaml_out.append(GenTempSensorAutomation(dev, to_f=to_f))
-    for s in GenTempSensorList(dev, to_f=to_f):
-      sensors_yaml_out.append(s)
-
-  # Power automation
-  data = GetDevices(host=host, dev_filter='utility')
-  for dev in data['result']:
-    if dev.get('SubType', '') == 'kWh':
-      automation_yaml_out.append(GenUtilitySensorAutomation(dev))
-      for d in GenPowerConfigs(dev):
-        power_yaml_out.append(d)
-      utility_yaml_out.update(GenUtilityMeterConfigs(dev))
-
-
-  # Thermostat automation
-  t_data = GetThermostats(host=host, to_f=to_f)
-  automation_yaml_out.extend(t_data['automation'])
-
-  # Startup automation
-  automation_yaml_out.append(GenStartupAutomation(
-      GetDevices(host=host, dev_filter='all', only_used=False)))
-
-
-  WriteFile(automation_yaml_out, automation_path, 'alias')
-  WriteFile(lights_yaml_out, light_path, 'name')
-  WriteFile(binary_sensors_yaml_out, binary_sensor_path, 'name')
-  WriteFile(sensors_yaml_out, sensor_path, 'name')
-  WriteFile(power_yaml_out, power_path, 'name')
-  WriteFile(utility_yaml_out, utility_path, '____')
-  WriteFile(t_data['climate'], climate_path, 'platform')
-  WriteFile(lock_yaml_out, lock_path, 'name')
-  group_yaml = GenGroupedSensors()
-  for k, v in GenGroups().items():
-    group_yaml[k] = v
-  WriteFile(group_yaml, group_path, '____')
+  if args.scenes:
+    print('  scene         : {}'.format(scene_path))
+  if args.shard_by:
+    print('  shards        : {}'.format(os.path.abspath(args.shard_dir)))
+
+  paths = {
+      'automation': (automation_path, 'alias'),
+      'light': (light_path, 'name'),
+      'binary_sensor': (binary_sensor_path, 'name'),
+      'sensor': (sensor_path, 'name'),
+      'power': (power_path, 'name'),
+      'utility': (utility_path, '____'),
+      'climate': (climate_path, 'platform'),
+      'lock': (lock_path, 'name'),
+      'scene': (scene_path, 'name'),
+      'group': (group_path, '____'),
+  }
+  if args.watch:
+    Watch(args.host, paths, to_f=to_f)
+    return
+  discovery = [] if args.discovery else None
+  ReportChanges(
+      StreamOutputs(MergeViews(FetchViews(args.host)), paths, to_f=to_f,
+                    discovery=discovery), paths)
+  if args.discovery:
+    asyncio.run(PublishDiscovery(discovery))
 
 if __name__ == '__main__':
-  main()
+  try:
+    main()
+  except DomoticzError as e:
+    print('Giving up on domoticz: {}'.format(e))
+    exit(1)
 
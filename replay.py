@@ -0,0 +1,389 @@
+#!/usr/bin/python
+"""Replays domoticz/out traffic against a generated configuration.
+
+Traffic is recorded from a broker with --record, or synthesized from a
+device list with --synthesize, into a gzipped file of json lines, one
+[milliseconds, topic, payload] per message. Replaying it generates the
+configuration for a device list in process and feeds the messages, at
+--speed times their original pace, to a stand-in for what home assistant
+does with them: every automation with a matching mqtt trigger has its
+conditions and payload templates rendered with jinja2, or with
+--generator_args="--translation bridge" the bridge's translators run. The
+report gives the messages handled per second, the templates rendered per
+message and the p50/p99 latency from a message being due to it being done.
+
+Generation modes are compared with eg --generator_args="--routing topic".
+
+Besides what generate_homeassistant_mqtt needs, replaying automations needs
+jinja2 ("pip install jinja2"), home assistant's template engine. Recording,
+synthesizing and replaying with --translation bridge do not.
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import gzip
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import generate_homeassistant_mqtt as gen
+
+
+parser = argparse.ArgumentParser(
+    description='Record, synthesize or replay domoticz/out traffic')
+parser.add_argument(
+    'traffic', help='The traffic file, gzipped json lines.')
+parser.add_argument(
+    '--record', dest='record', default=False, action='store_true',
+    help='Record the domoticz/out traffic on the broker of --generator_args '
+    'to the traffic file, for --duration seconds or until interrupted.')
+parser.add_argument(
+    '--synthesize', dest='synthesize', default=False, action='store_true',
+    help='Write --duration seconds of made up traffic at --rate messages a '
+    'second for the devices of --input_json or --devices to the traffic file.')
+parser.add_argument(
+    '--input_json', dest='input_json', default=None,
+    help='The device list, a saved /json.htm?type=devices response.')
+parser.add_argument(
+    '--devices', dest='devices', default=None, type=int,
+    help='Use this many synthetic devices, see benchmark.py, instead of '
+    '--input_json.')
+parser.add_argument(
+    '--generator_args', dest='generator_args', default='',
+    help='generate_homeassistant_mqtt arguments, eg "--routing topic" or '
+    '"--mqtt_host broker". Unless they include "--translation bridge", the '
+    'automations are replayed, which needs jinja2.')
+parser.add_argument(
+    '--duration', dest='duration', default=60, type=float,
+    help='Seconds of traffic to record or synthesize.')
+parser.add_argument(
+    '--rate', dest='rate', default=20, type=float,
+    help='Messages a second to synthesize.')
+parser.add_argument(
+    '--seed', dest='seed', default=1, type=int,
+    help='Seed for the synthesized traffic.')
+parser.add_argument(
+    '--speed', dest='speed', default=1, type=float,
+    help='Replay this many times faster than the traffic was recorded. A high '
+    'one finds how many messages a second can be handled at all.')
+parser.add_argument(
+    '--json', dest='json', default=False, action='store_true',
+    help='Print the report as json instead of a table.')
+
+
+def ReadTraffic(path):
+  """Returns the (seconds, topic, payload) of a traffic file, in time order."""
+  traffic = []
+  with gzip.open(path, 'rt', encoding='utf-8') as f:
+    for line in f:
+      ms, topic, payload = json.loads(line)
+      traffic.append((ms / 1000.0, topic, payload))
+  traffic.sort(key=lambda m: m[0])
+  return traffic
+
+
+def WriteTraffic(path, traffic):
+  with gzip.open(path, 'wt', encoding='utf-8') as f:
+    for seconds, topic, payload in traffic:
+      f.write(json.dumps([int(seconds * 1000), topic, payload],
+                         ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+async def Record(path, duration):
+  """Writes the domoticz/out traffic of every --domoticz_host to path."""
+  client = gen.GenMqttClient('domoticz_hass_replay')
+  count = 0
+
+  async def Drain(f, start):
+    nonlocal count
+    async for topic, payload in client.Messages():
+      f.write(json.dumps(
+          [int((time.perf_counter() - start) * 1000), topic,
+           payload.decode('utf-8', 'replace')],
+          ensure_ascii=False, separators=(',', ':')) + '\n')
+      count += 1
+
+  with gzip.open(path, 'wt', encoding='utf-8') as f:
+    try:
+      await client.Connect()
+      for instance in gen.args.host:
+        await client.Subscribe(gen.OutTopic(instance.name))
+        await client.Subscribe(gen.OutTopic(instance.name) + '/+')
+      await asyncio.wait_for(Drain(f, time.perf_counter()), duration)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+      pass
+    finally:
+      await client.Close()
+  print('Recorded {} messages to {}'.format(count, path))
+
+
+def _Jitter(rand, value):
+  """A sensor reading moved a little, so not every message is a repeat."""
+  try:
+    number = float(value)
+  except ValueError:
+    return value
+  return str(round(number + rand.gauss(0, max(abs(number) * 0.01, 0.1)), 2))
+
+
+def Synthesize(views, duration, rate, seed=1):
+  """Makes up domoticz/out traffic for the used devices of GetDeviceViews.
+
+  Messages arrive at random, rate a second on average, each from a device
+  picked at random. Switches flip, sensor readings drift.
+  """
+  rand = random.Random(seed)
+  devices = [d for d in views['startup']['result'] if d.Used]
+  traffic = []
+  seconds = rand.expovariate(rate)
+  while seconds < duration:
+    dev = rand.choice(devices)
+    msg = gen.DeviceStateMessage(dev)
+    if dev.SwitchType is not None:
+      msg['nvalue'] = rand.choice([0, 1, 2] if dev.SwitchType == 'Dimmer'
+                                  else [0, 1])
+      if msg['nvalue'] == 2:
+        msg['svalue1'] = str(rand.randrange(1, 100))
+    else:
+      for key in [k for k in msg if k.startswith('svalue')]:
+        msg[key] = _Jitter(rand, msg[key])
+    msg.update({'name': dev.Name, 'dtype': dev.Type, 'id': dev.ID})
+    if dev.SubType is not None:
+      msg['stype'] = dev.SubType
+    if dev.SwitchType is not None:
+      msg['switchType'] = dev.SwitchType
+    traffic.append((seconds, gen.OutTopic(gen.Namespace(dev)),
+                    json.dumps(msg, ensure_ascii=False)))
+    seconds += rand.expovariate(rate)
+  return traffic
+
+
+def RouteTraffic(traffic):
+  """Moves the messages to the topics the --routing being replayed expects.
+
+  Recorded traffic is on whatever topics its domoticz published to, the
+  message itself tells which device it is from.
+  """
+  prefixes = sorted(gen.args.host, key=lambda i: -len(i.topic_prefix))
+  for seconds, topic, payload in traffic:
+    ns = None
+    for instance in prefixes:
+      if topic.startswith(gen.OutTopic(instance.name)):
+        ns = instance.name
+        break
+    try:
+      idx = json.loads(payload)['idx']
+    except (ValueError, KeyError, TypeError):
+      idx = None
+    if ns is not None and idx is not None:
+      if gen.args.routing == 'topic':
+        topic = gen.args.idx_topic.format(
+            prefix=gen.TopicPrefix(ns), idx=idx)
+      else:
+        topic = gen.OutTopic(ns)
+    yield seconds, topic, payload
+
+
+class AutomationStandIn(object):
+  """Does what home assistant does with the messages of its mqtt triggers.
+
+  Templates are compiled once each, like home assistant does, and every
+  render is counted. Publishes of the actions are counted, not sent.
+  """
+
+  def __init__(self, automations):
+    try:
+      import jinja2
+    except ImportError:
+      print('Replaying automations renders their templates with jinja2. '
+            'Install it with "pip install jinja2" or similar.')
+      sys.exit(1)
+    self.env = jinja2.Environment()
+    self.compiled = {}
+    self.renders = 0
+    self.published = 0
+    self.exact = collections.defaultdict(list)
+    self.wildcard = collections.defaultdict(list)
+    for automation in automations:
+      triggers = automation['trigger']
+      if isinstance(triggers, dict):
+        triggers = [triggers]
+      for trigger in triggers:
+        if trigger.get('platform') != 'mqtt':
+          continue
+        if '+' in trigger['topic'] or '#' in trigger['topic']:
+          self.wildcard[trigger['topic']].append(automation)
+        else:
+          self.exact[trigger['topic']].append(automation)
+
+  def _Render(self, template, variables):
+    compiled = self.compiled.get(template)
+    if compiled is None:
+      compiled = self.compiled[template] = self.env.from_string(template)
+    self.renders += 1
+    return compiled.render(variables)
+
+  def _Check(self, conditions, variables):
+    if isinstance(conditions, dict):
+      conditions = [conditions]
+    for condition in conditions:
+      if condition['condition'] == 'and':
+        if not self._Check(condition['conditions'], variables):
+          return False
+      elif condition['condition'] == 'template':
+        rendered = self._Render(condition['value_template'], variables)
+        if rendered.strip().lower() != 'true':
+          return False
+    return True
+
+  def Handle(self, topic, payload):
+    automations = list(self.exact.get(topic, ()))
+    for pattern, matched in self.wildcard.items():
+      if gen.TopicMatches(pattern, topic):
+        automations.extend(matched)
+    if not automations:
+      return
+    trigger = {'platform': 'mqtt', 'topic': topic, 'payload': payload}
+    try:
+      trigger['payload_json'] = json.loads(payload)
+    except ValueError:
+      pass
+    variables = {'trigger': trigger}
+    for automation in automations:
+      if not self._Check(automation.get('condition', []), variables):
+        continue
+      for action in automation['action']:
+        for value in action.get('data_template', {}).values():
+          if isinstance(value, str) and ('{{' in value or '{%' in value):
+            self._Render(value, variables)
+        self.published += 1
+
+
+class BridgeStandIn(object):
+  """Does what a --bridge does with the messages it subscribes to."""
+
+  def __init__(self, views, to_f=False):
+    energy = gen.EnergyTotals() if gen.args.energy == 'bridge' else None
+    self.table = gen.GenTranslators(views, to_f=to_f, energy=energy)
+    self.routes = {}
+    for instance in gen.args.host:
+      if gen.args.routing == 'topic':
+        self.routes[gen.args.idx_topic.format(
+            prefix=instance.topic_prefix, idx='+')] = instance.name
+      else:
+        self.routes[gen.OutTopic(instance.name)] = instance.name
+    self.cache = None
+    if gen.args.publish_on_change:
+      self.cache = gen.StateCache(gen.args.deadband, gen.args.min_interval)
+    self.renders = 0
+    self.published = 0
+
+  def Handle(self, topic, payload):
+    if topic not in self.routes and not any(
+        gen.TopicMatches(pattern, topic) for pattern in self.routes):
+      return
+    for status_topic, out in gen.TranslateMessage(self.table, payload):
+      if self.cache is None or self.cache.Check(status_topic, out):
+        self.published += 1
+
+
+def Percentile(ordered, fraction):
+  if not ordered:
+    return 0.0
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def Replay(traffic, stand_in, speed):
+  """Feeds the traffic to the stand-in at speed times its pace.
+
+  Messages are handled one at a time, like home assistant's event loop does,
+  so a message due while another is being handled waits. Its latency runs
+  from when it was due to when it was handled.
+  """
+  latencies = []
+  busy = 0.0
+  start = time.perf_counter()
+  for seconds, topic, payload in traffic:
+    due = start + seconds / speed
+    now = time.perf_counter()
+    if now < due:
+      time.sleep(due - now)
+      now = time.perf_counter()
+    stand_in.Handle(topic, payload)
+    done = time.perf_counter()
+    busy += done - now
+    latencies.append(done - due)
+  latencies.sort()
+  count = len(latencies)
+  span = traffic[-1][0] / speed if traffic else 0.0
+  return {
+      'messages': count,
+      'offered_per_second': count / span if span else 0.0,
+      'handled_per_second': count / busy if busy else 0.0,
+      'renders_per_message': stand_in.renders / count if count else 0.0,
+      'published': stand_in.published,
+      'p50_ms': Percentile(latencies, 0.5) * 1000,
+      'p99_ms': Percentile(latencies, 0.99) * 1000,
+      'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+  }
+
+
+def LoadViews(args, tmp):
+  """Sets up gen.args for the device list and returns its GetDeviceViews."""
+  input_json = args.input_json
+  if args.devices is not None:
+    import benchmark
+    input_json = os.path.join(tmp, 'devices.json')
+    with open(input_json, 'w') as f:
+      json.dump(benchmark.SynthesizeDevices(args.devices, args.seed), f)
+  if not input_json:
+    parser.error('a device list is needed, see --input_json and --devices')
+  gen.args = gen.parser.parse_args(
+      ['--input_json', input_json] + args.generator_args.split())
+  return gen.GetDeviceViews(None)
+
+
+def main():
+  args = parser.parse_args()
+  if args.record:
+    gen.args = gen.parser.parse_args(args.generator_args.split())
+    try:
+      asyncio.run(Record(args.traffic, args.duration))
+    except KeyboardInterrupt:
+      pass
+    return
+  with tempfile.TemporaryDirectory() as tmp:
+    views = LoadViews(args, tmp)
+  if args.synthesize:
+    traffic = Synthesize(views, args.duration, args.rate, args.seed)
+    WriteTraffic(args.traffic, traffic)
+    print('Wrote {} messages to {}'.format(len(traffic), args.traffic))
+    return
+  to_f = gen.args.fahrenheit
+  if gen.args.translation == 'bridge':
+    stand_in = BridgeStandIn(views, to_f=to_f)
+  else:
+    generator = gen.ConfigGenerator(to_f=to_f)
+    with contextlib.redirect_stdout(io.StringIO()):
+      generator.Load(views)
+    stand_in = AutomationStandIn(
+        generator.Outputs(['automation'], sharded=False)['automation'])
+  traffic = list(RouteTraffic(ReadTraffic(args.traffic)))
+  report = Replay(traffic, stand_in, args.speed)
+  if args.json:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    return
+  for key, value in report.items():
+    print('{:>20} {:>12}'.format(
+        key, value if isinstance(value, int) else '{:.3f}'.format(value)))
+
+
+if __name__ == '__main__':
+  main()
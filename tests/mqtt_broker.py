@@ -0,0 +1,158 @@
+"""An in-process MQTT 3.1.1 broker stand-in for the tests.
+
+Enough of a broker for MqttClient: CONNECT, SUBSCRIBE and UNSUBSCRIBE with +
+and # wildcards, QoS 0 PUBLISH with retained messages, where an empty
+retained payload clears the topic, PINGREQ and DISCONNECT. Every CONNECT is
+logged with its credentials, and every PUBLISH with the client id it came
+from.
+"""
+
+import asyncio
+import collections
+import struct
+
+
+Published = collections.namedtuple(
+    'Published', ['client_id', 'topic', 'payload', 'retain'])
+
+
+def TopicMatches(subscription, topic):
+  """Whether topic matches a subscription with + and # wildcards."""
+  levels = topic.split('/')
+  pattern = subscription.split('/')
+  for i, p in enumerate(pattern):
+    if p == '#':
+      return True
+    if i >= len(levels) or p not in ('+', levels[i]):
+      return False
+  return len(pattern) == len(levels)
+
+
+def _Packet(header, body):
+  length = len(body)
+  encoded = bytearray()
+  while True:
+    byte, length = length % 128, length // 128
+    encoded.append(byte | 0x80 if length else byte)
+    if not length:
+      break
+  return bytes([header]) + bytes(encoded) + body
+
+
+def _String(body, pos):
+  """Returns the string at pos of a packet body and the position after it."""
+  length = struct.unpack('!H', body[pos:pos + 2])[0]
+  return body[pos + 2:pos + 2 + length].decode('utf-8'), pos + 2 + length
+
+
+def _Publish(topic, payload, retain):
+  topic = topic.encode('utf-8')
+  return _Packet(0x31 if retain else 0x30,
+                 struct.pack('!H', len(topic)) + topic + payload)
+
+
+class Broker(object):
+  """Serves on a free port of 127.0.0.1, within the running event loop."""
+
+  def __init__(self):
+    self.port = None
+    self.retained = collections.OrderedDict()  # topic -> payload
+    self.published = []  # Published
+    self.connected = []  # (client id, username, password)
+    self._server = None
+    self._subscriptions = {}  # writer -> [subscription]
+
+  async def Start(self):
+    self._server = await asyncio.start_server(self._Serve, '127.0.0.1', 0)
+    self.port = self._server.sockets[0].getsockname()[1]
+
+  async def Close(self):
+    self._server.close()
+    for writer in list(self._subscriptions):
+      writer.close()
+    await self._server.wait_closed()
+
+  async def Settle(self):
+    """Waits for the clients to disconnect, and their packets to be read."""
+    while self._subscriptions:
+      await asyncio.sleep(0.01)
+
+  def PublishedBy(self, client_id):
+    return [p for p in self.published if p.client_id == client_id]
+
+  @staticmethod
+  async def _ReadPacket(reader):
+    header = (await reader.readexactly(1))[0]
+    length = shift = 0
+    while True:
+      byte = (await reader.readexactly(1))[0]
+      length |= (byte & 0x7f) << shift
+      shift += 7
+      if not byte & 0x80:
+        break
+    body = await reader.readexactly(length) if length else b''
+    return header, body
+
+  async def _Serve(self, reader, writer):
+    client_id = None
+    self._subscriptions[writer] = []
+    try:
+      while True:
+        header, body = await self._ReadPacket(reader)
+        kind = header >> 4
+        if kind == 1:
+          protocol, pos = _String(body, 0)
+          flags = body[pos + 1]
+          client_id, end = _String(body, pos + 4)
+          username = password = None
+          if flags & 0x80:
+            username, end = _String(body, end)
+          if flags & 0x40:
+            password, end = _String(body, end)
+          self.connected.append((client_id, username, password))
+          accepted = protocol == 'MQTT' and body[pos] == 4
+          code = b'\x00' if accepted else b'\x01'
+          writer.write(_Packet(0x20, b'\x00' + code))
+          if not accepted:
+            break
+        elif kind == 3:
+          self._Receive(client_id, header, body)
+        elif kind == 8:
+          subscription, _ = _String(body, 2)
+          self._subscriptions[writer].append(subscription)
+          writer.write(_Packet(0x90, body[:2] + b'\x00'))
+          for topic, payload in self.retained.items():
+            if TopicMatches(subscription, topic):
+              writer.write(_Publish(topic, payload, True))
+        elif kind == 10:
+          subscription, _ = _String(body, 2)
+          if subscription in self._subscriptions[writer]:
+            self._subscriptions[writer].remove(subscription)
+          writer.write(_Packet(0xb0, body[:2]))
+        elif kind == 12:
+          writer.write(_Packet(0xd0, b''))
+        elif kind == 14:
+          break
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      del self._subscriptions[writer]
+      writer.close()
+
+  def _Receive(self, client_id, header, body):
+    topic, pos = _String(body, 0)
+    if (header >> 1) & 0x03:
+      pos += 2  # The packet id, QoS 1 and 2 are handled like 0.
+    payload = body[pos:]
+    retain = bool(header & 0x01)
+    self.published.append(Published(client_id, topic, payload, retain))
+    if retain:
+      if payload:
+        self.retained[topic] = payload
+      else:
+        self.retained.pop(topic, None)
+    for writer, subscriptions in self._subscriptions.items():
+      if any(TopicMatches(s, topic) for s in subscriptions):
+        # Delivered as they are sent on, retained or not.
+        writer.write(_Publish(topic, payload, False))
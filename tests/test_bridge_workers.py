@@ -0,0 +1,146 @@
+"""Tests how BridgeWorkers spreads domoticz/out messages over its processes."""
+
+import asyncio
+import collections
+import json
+import multiprocessing
+import queue
+import time
+import unittest
+
+import domoticz_bridge
+
+WORKERS = 3
+
+
+def Echo(out, delay, worker, conn):
+  """A worker target that passes on what it receives, with its number.
+
+  Worker 0 only starts reading after delay.value seconds.
+  """
+  if worker == 0:
+    time.sleep(delay.value)
+  while True:
+    item = conn.recv()
+    if item is None:
+      return
+    if isinstance(item, tuple):
+      out.put((worker, item[0], None, None))
+      continue
+    for ns, payload in item:
+      out.put((worker, 'message', ns, payload))
+
+
+class BridgeWorkersTest(unittest.TestCase):
+
+  def setUp(self):
+    context = multiprocessing.get_context('spawn')
+    self.out = context.Queue()
+    self.delay = context.Value('d', 0)
+
+  def Received(self, count):
+    received = []
+    for _ in range(count):
+      received.append(self.out.get(timeout=30))
+    with self.assertRaises(queue.Empty):
+      self.out.get(timeout=0.2)
+    return received
+
+  def Run(self, test):
+    workers = domoticz_bridge.BridgeWorkers(
+        WORKERS, Echo, (self.out, self.delay))
+    try:
+      return asyncio.run(test(workers))
+    finally:
+      workers.Close()
+
+  def testKeepsTheOrderOfEveryDevice(self):
+    tables = {'': dict((idx, ()) for idx in range(1, 10)),
+              'barn': dict((idx, ()) for idx in range(1, 4))}
+
+    async def Test(workers):
+      workers.Load([], tables)
+      for seq in range(50):
+        for ns, table in sorted(tables.items()):
+          for idx in table:
+            workers.Submit(ns, json.dumps({'idx': idx, 'seq': seq}).encode())
+        # Devices without translators, and messages without an idx.
+        workers.Submit('', b'{"idx": 10, "seq": 0}')
+        workers.Submit('garage', b'{"idx": 1, "seq": 0}')
+        workers.Submit('', b'{"name": "x"}')
+        if seq % 7 == 0:
+          await asyncio.sleep(0)
+      await asyncio.sleep(0)
+
+    self.Run(Test)
+    received = self.Received(WORKERS + 50 * 12)
+    self.assertEqual(
+        list(range(WORKERS)),
+        sorted(worker for worker, kind, _, _ in received if kind == 'load'))
+    sequences = collections.defaultdict(list)
+    for worker, kind, ns, payload in received:
+      if kind == 'message':
+        msg = json.loads(payload)
+        self.assertEqual(
+            domoticz_bridge.WorkerOf(ns, msg['idx'], WORKERS), worker)
+        sequences[ns, msg['idx']].append(msg['seq'])
+    self.assertEqual(12, len(sequences))
+    for seqs in sequences.values():
+      self.assertEqual(list(range(50)), seqs)
+
+  def testRestartsAStoppedWorker(self):
+    idx = next(idx for idx in range(1, 10)
+               if domoticz_bridge.WorkerOf('', idx, WORKERS) == 0)
+
+    async def Test(workers):
+      workers.Load([], {'': {idx: ()}})
+      loaded = self.Received(WORKERS)
+      process = workers._workers[0][0]
+      process.kill()
+      process.join(10)
+      workers.Submit('', b'{"idx": %d, "seq": 0}' % idx)
+      await asyncio.sleep(0)
+      workers.Submit('', b'{"idx": %d, "seq": 1}' % idx)
+      await asyncio.sleep(0)
+      return loaded
+
+    received = self.Run(Test) + self.Received(3)
+    self.assertEqual(
+        [0, 0, 1, 2],
+        sorted(worker for worker, kind, _, _ in received if kind == 'load'))
+    # The batch that found the worker gone goes to the new one.
+    self.assertEqual(
+        [(0, b'{"idx": %d, "seq": 0}' % idx),
+         (0, b'{"idx": %d, "seq": 1}' % idx)],
+        [(worker, payload) for worker, kind, _, payload in received
+         if kind == 'message'])
+
+  def testBusyWorkerDoesNotHoldUpTheBridge(self):
+    self.delay.value = 2
+    idx = next(idx for idx in range(1, 10)
+               if domoticz_bridge.WorkerOf('', idx, WORKERS) == 0)
+    # Far more than the pipe holds.
+    payloads = [b'{"idx": %d, "seq": %d, "padding": "%s"}' % (
+        idx, seq, b'x' * 1000) for seq in range(2000)]
+
+    async def Test(workers):
+      workers.Load([], {'': {idx: ()}})
+      start = time.monotonic()
+      for payload in payloads:
+        workers.Submit('', payload)
+        await asyncio.sleep(0)
+      blocked = time.monotonic() - start
+      # The rest is written as the worker reads, while this waits for it.
+      received = await asyncio.get_running_loop().run_in_executor(
+          None, self.Received, WORKERS + len(payloads))
+      return blocked, received
+
+    blocked, received = self.Run(Test)
+    self.assertLess(blocked, 1)
+    self.assertEqual(
+        payloads,
+        [payload for _, kind, _, payload in received if kind == 'message'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+"""Tests how CommandPipeline coalesces and paces domoticz/in commands."""
+
+import asyncio
+import json
+import unittest
+
+import domoticz_bridge
+
+
+def Command(idx, level=None, command='switchlight'):
+  msg = {'command': command, 'idx': idx}
+  if level is not None:
+    msg['level'] = level
+  return json.dumps(msg)
+
+
+class CommandPipelineTest(unittest.TestCase):
+
+  def Run(self, submit, hardware=None, rates=None, default_rate=0, wait=0.1):
+    """Submits the commands submit(pipeline) does, returns what was sent."""
+    sent = []
+
+    async def Publish(topic, payload):
+      try:
+        msg = json.loads(payload)
+      except ValueError:
+        msg = payload
+      sent.append((asyncio.get_running_loop().time(), topic, msg))
+
+    async def Main():
+      pipeline = domoticz_bridge.CommandPipeline(
+          Publish, hardware or {}, rates, default_rate)
+      try:
+        await submit(pipeline)
+        await asyncio.sleep(wait)
+      finally:
+        pipeline.Close()
+      return pipeline
+
+    self.pipeline = asyncio.run(Main())
+    return sent
+
+  def testScenesAreNotPacedWithTheDeviceOfTheirIdx(self):
+    async def Submit(pipeline):
+      pipeline.Submit(Command(5, 10))
+      await asyncio.sleep(0.01)
+      pipeline.Submit(Command(5, 20))
+      pipeline.Submit(Command(5, command='switchscene'))
+
+    sent = self.Run(Submit, hardware={5: 'ZStick'}, rates={'ZStick': 1})
+    self.assertEqual(
+        [('switchlight', 10), ('switchscene', None)],
+        [(msg['command'], msg.get('level')) for _, _, msg in sent])
+
+  def testCoalescesToTheFirstAndLastCommandOfAnIdx(self):
+    async def Submit(pipeline):
+      for level in range(0, 101, 10):
+        pipeline.Submit(Command(5, level))
+        await asyncio.sleep(0.01)
+
+    sent = self.Run(Submit, hardware={5: 'ZStick'}, rates={'ZStick': 2},
+                    wait=0.6)
+    self.assertEqual([0, 100], [msg['level'] for _, _, msg in sent])
+    self.assertEqual(set(['domoticz/in']), set(topic for _, topic, _ in sent))
+    self.assertEqual((2, 9), (self.pipeline.sent, self.pipeline.coalesced))
+
+  def testKeepsItsPlaceInTheQueue(self):
+    async def Submit(pipeline):
+      pipeline.Submit(Command(1, 0))
+      await asyncio.sleep(0.01)
+      pipeline.Submit(Command(2, 10))
+      pipeline.Submit(Command(3, 10))
+      pipeline.Submit(Command(2, 20))
+      # Another kind of command for the same idx is not coalesced.
+      pipeline.Submit(Command(3, command='switchlight_toggle'))
+
+    sent = self.Run(Submit, default_rate=20, wait=0.3)
+    self.assertEqual(
+        [(1, 0), (2, 20), (3, 10), (3, None)],
+        [(msg['idx'], msg.get('level')) for _, _, msg in sent])
+
+  def testPacesEveryHardwareOnItsOwn(self):
+    start = []
+
+    async def Submit(pipeline):
+      start.append(asyncio.get_running_loop().time())
+      for idx in range(1, 4):
+        pipeline.Submit(Command(idx, 50))
+        pipeline.Submit(Command(idx + 10, 50))
+
+    sent = self.Run(
+        Submit, hardware={1: 'RFX', 2: 'RFX', 3: 'RFX',
+                          11: 'ZStick', 12: 'ZStick', 13: 'ZStick'},
+        rates={'ZStick': 5}, default_rate=100, wait=0.6)
+    times = dict((msg['idx'], at - start[0]) for at, _, msg in sent)
+    self.assertEqual(6, len(times))
+    # RFX at the default 100 a second, the ZStick at 5.
+    self.assertLess(times[3], 0.1)
+    self.assertLess(times[11], 0.1)
+    self.assertGreaterEqual(times[12], 0.2)
+    self.assertGreaterEqual(times[13], 0.4)
+
+  def testPassesOnWhatItDoesNotUnderstand(self):
+    async def Submit(pipeline):
+      pipeline.Submit('not json')
+      pipeline.Submit('not json')
+      pipeline.Submit(json.dumps({'command': 'switchlight'}))
+
+    sent = self.Run(Submit, default_rate=100)
+    self.assertEqual(
+        ['not json', 'not json', {'command': 'switchlight'}],
+        [msg for _, _, msg in sent])
+    self.assertEqual(0, self.pipeline.coalesced)
+
+
+if __name__ == '__main__':
+  unittest.main()
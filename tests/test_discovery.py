@@ -0,0 +1,148 @@
+"""Tests --discovery against the broker stand-in."""
+
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+import benchmark
+import generate_homeassistant_mqtt as gen
+from tests import mqtt_broker
+
+CLIENT_ID = 'domoticz_hass_discovery'
+
+
+class DiscoveryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.devices = benchmark.SynthesizeDevices(200)
+    self.input_json = os.path.join(self.tmp, 'devices.json')
+    self.wait = gen.DISCOVERY_WAIT
+    gen.DISCOVERY_WAIT = 0.2
+    self.broker = mqtt_broker.Broker()
+
+  def tearDown(self):
+    gen.DISCOVERY_WAIT = self.wait
+    shutil.rmtree(self.tmp)
+
+  def Parse(self, *argv):
+    gen.args = gen.parser.parse_args([
+        '--input_json', self.input_json, '--mqtt_host', '127.0.0.1',
+        '--mqtt_port', str(self.broker.port), '--discovery'] + list(argv))
+
+  def Paths(self):
+    return dict(
+        (name, (os.path.join(self.tmp, name + '.yaml'), 'name'))
+        for name in gen.OUTPUT_NAMES)
+
+  def Entities(self):
+    with open(self.input_json, 'w') as f:
+      json.dump(self.devices, f)
+    generator = gen.ConfigGenerator()
+    generator.Load(gen.MergeViews(gen.FetchViews(gen.args.host)))
+    return list(generator.Discovery())
+
+  def Runs(self, *changes):
+    """Publishes the discovery configs once, and again after every change.
+
+    Returns what every run published.
+    """
+    async def Main():
+      await self.broker.Start()
+      try:
+        self.Parse()
+        published = []
+        for change in (None,) + changes:
+          if change:
+            change()
+          start = len(self.broker.published)
+          await gen.PublishDiscovery(self.Entities())
+          await self.broker.Settle()
+          published.append(self.broker.published[start:])
+        return published
+      finally:
+        await self.broker.Close()
+
+    return asyncio.run(Main())
+
+  def Device(self, dev_type):
+    return next(d for d in self.devices['result']
+                if d['Type'] == dev_type and d['Used'] and
+                d['HardwareName'] != 'Hue')
+
+  def testFirstRunPublishesEveryEntity(self):
+    first, = self.Runs()
+    self.assertTrue(first)
+    self.assertEqual(set([CLIENT_ID]), set(p.client_id for p in first))
+    self.assertTrue(all(p.retain for p in first))
+    components = set(p.topic.split('/')[1] for p in first)
+    self.assertEqual(
+        set(['light', 'binary_sensor', 'sensor', 'lock', 'climate']),
+        components)
+    for p in first:
+      config = json.loads(p.payload)
+      self.assertEqual(p.topic.split('/')[2], config['unique_id'])
+      self.assertTrue(config['unique_id'].startswith('domoticz_'))
+    self.assertEqual(len(first), len(self.broker.retained))
+
+  def testUnchangedRerunPublishesNothing(self):
+    first, second = self.Runs(lambda: None)
+    self.assertTrue(first)
+    self.assertEqual([], second)
+
+  def testRenamedDeviceKeepsItsObjectId(self):
+    dev = self.Device('Temp + Humidity + Baro')
+
+    def Rename():
+      dev['Name'] = 'Attic weather'
+
+    first, second = self.Runs(Rename)
+    self.assertTrue(second)
+    before = set(p.topic for p in first)
+    for p in second:
+      self.assertIn(p.topic, before)
+      self.assertTrue(p.payload)
+      config = json.loads(p.payload)
+      self.assertEqual('Attic weather', config['device']['name'])
+
+  def testRemovedDeviceIsCleared(self):
+    dev = self.Device('Temp + Humidity + Baro')
+
+    def Remove():
+      self.devices['result'].remove(dev)
+
+    first, second = self.Runs(Remove)
+    self.assertTrue(second)
+    for p in second:
+      self.assertEqual(b'', p.payload)
+      self.assertTrue(p.retain)
+      self.assertNotIn(p.topic, self.broker.retained)
+    self.assertEqual(len(first) - len(second), len(self.broker.retained))
+
+  def testEmptiesTheEntityFiles(self):
+    with open(self.input_json, 'w') as f:
+      json.dump(self.devices, f)
+    self.broker.port = 1  # Not published to.
+    gen.args = gen.parser.parse_args(['--input_json', self.input_json])
+    paths = self.Paths()
+    views = gen.MergeViews(gen.FetchViews(gen.args.host))
+    gen.StreamOutputs(views, paths)
+    with open(paths['light'][0]) as f:
+      self.assertTrue(yaml.safe_load(f))
+    self.Parse()
+    discovery = []
+    changed = gen.StreamOutputs(views, paths, discovery=discovery)
+    self.assertTrue(discovery)
+    for name in gen.DISCOVERY_COMPONENTS:
+      self.assertIn(name, changed)
+      with open(paths[name][0]) as f:
+        self.assertEqual([], yaml.safe_load(f))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+"""Tests DomoticzClient against a local keep-alive http server."""
+
+import gzip
+import http.server
+import json
+import threading
+import unittest
+
+import domoticz_bridge
+import generate_homeassistant_mqtt as gen
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    super().setup()
+    with self.server.lock:
+      self.server.connections += 1
+
+  def do_GET(self):
+    self.server.paths.append(self.path)
+    status = self.server.statuses.pop(0) if self.server.statuses else 200
+    body = json.dumps({'status': 'OK', 'path': self.path}).encode('utf-8')
+    if 'gzip' in self.headers.get('Accept-Encoding', ''):
+      body = gzip.compress(body)
+    self.send_response(status)
+    self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    if self.server.barrier:
+      self.server.barrier.wait(5)
+
+  def log_message(self, *args):
+    pass
+
+
+class DomoticzClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.server.daemon_threads = True
+    self.server.lock = threading.Lock()
+    self.server.connections = 0
+    self.server.paths = []
+    self.server.statuses = []
+    self.server.barrier = None
+    threading.Thread(
+        target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+    self.host = '127.0.0.1:{}'.format(self.server.server_address[1])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def Client(self, **kwargs):
+    return domoticz_bridge.DomoticzClient(
+        self.host, timeout=5, backoff=0.01, **kwargs)
+
+  def testReusesTheConnection(self):
+    client = self.Client()
+    for i in range(5):
+      result = client.Get([('type', 'devices'), ('rid', i)])
+      self.assertEqual('/json.htm?type=devices&rid={}'.format(i),
+                       result['path'])
+    self.assertEqual(1, self.server.connections)
+
+  def testConcurrentRequestsGetConnectionsOfTheirOwn(self):
+    client = self.Client(connections=2)
+    self.server.barrier = threading.Barrier(2)
+    threads = [threading.Thread(target=client.Get, args=([('rid', i)],))
+               for i in range(2)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(5)
+    self.server.barrier = None
+    self.assertEqual(2, self.server.connections)
+    # Both are kept alive for the next requests.
+    client.Get([('rid', 2)])
+    client.Get([('rid', 3)])
+    self.assertEqual(2, self.server.connections)
+
+  def testRetriesServerErrors(self):
+    self.server.statuses = [500, 503]
+    self.assertEqual('OK', self.Client().Get([('type', 'devices')])['status'])
+    self.assertEqual(3, len(self.server.paths))
+
+  def testGivesUpAfterTheRetries(self):
+    self.server.statuses = [500] * 3
+    with self.assertRaises(domoticz_bridge.DomoticzError):
+      self.Client(retries=2).Get([('type', 'devices')])
+
+  def testTriesOnceWithoutRetries(self):
+    for retries in (0, -1):
+      self.server.statuses = [500]
+      with self.assertRaises(domoticz_bridge.DomoticzError):
+        self.Client(retries=retries).Get([('type', 'devices')])
+    self.assertEqual(2, len(self.server.paths))
+    self.assertEqual('OK', self.Client(retries=-1).Get([])['status'])
+
+  def testRefusedRequestIsNotRetried(self):
+    self.server.statuses = [404]
+    with self.assertRaises(domoticz_bridge.DomoticzError):
+      self.Client().Get([('type', 'devices')])
+    self.assertEqual(1, len(self.server.paths))
+
+
+class HttpConnectionsTest(unittest.TestCase):
+
+  def testNeedsAtLeastOne(self):
+    with self.assertRaises(SystemExit):
+      gen.parser.parse_args(['--http_connections', '0'])
+    self.assertEqual(
+        2, gen.parser.parse_args(['--http_connections', '2']).http_connections)
+
+
+class HttpRetriesTest(unittest.TestCase):
+
+  def testCannotBeNegative(self):
+    with self.assertRaises(SystemExit):
+      gen.parser.parse_args(['--http_retries', '-1'])
+    self.assertEqual(
+        0, gen.parser.parse_args(['--http_retries', '0']).http_retries)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,138 @@
+"""Tests how EnergyTotals totals kWh meters over ENERGY_CYCLES periods."""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import domoticz_bridge
+
+KEY = '12'
+
+
+def LocalTime(year, month, day, hour, minute):
+  return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+
+class Clock(object):
+
+  def __init__(self):
+    self.now = LocalTime(2026, 3, 31, 10, 15)
+
+  def __call__(self):
+    return self.now
+
+
+class EnergyTotalsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, 'energy.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def Totals(self, path=None):
+    return domoticz_bridge.EnergyTotals(path, 60, self.clock)
+
+  def Read(self, totals, kwh, at=None):
+    """Translates a reading of kwh, at the local time at if given."""
+    if at:
+      self.clock.now = LocalTime(*at)
+    msg = {'idx': int(KEY), 'svalue1': '300', 'svalue2': str(kwh * 1000)}
+    return json.loads(totals.Translate(KEY, msg))
+
+  def Saved(self):
+    with open(self.path) as f:
+      return json.load(f)[KEY]['last']
+
+  def testTotalsEveryCycle(self):
+    totals = self.Totals()
+    self.assertEqual(
+        dict((cycle, 0) for cycle in domoticz_bridge.ENERGY_CYCLES),
+        self.Read(totals, 1000))
+    self.assertEqual(
+        dict((cycle, 2.5) for cycle in domoticz_bridge.ENERGY_CYCLES),
+        self.Read(totals, 1002.5, at=(2026, 3, 31, 10, 45)))
+
+  def testNewPeriodStartsAtTheReadingBeforeIt(self):
+    totals = self.Totals()
+    self.Read(totals, 1000)
+    self.Read(totals, 1002, at=(2026, 3, 31, 10, 55))
+    out = self.Read(totals, 1003, at=(2026, 3, 31, 11, 5))
+    self.assertEqual(1, out['hourly'])
+    self.assertEqual(3, out['daily'])
+
+  def testDayMonthAndQuarterRollOver(self):
+    totals = self.Totals()
+    self.Read(totals, 1000, at=(2026, 3, 31, 23, 50))
+    self.Read(totals, 1001, at=(2026, 3, 31, 23, 55))
+    # A wednesday, in the same week.
+    self.assertEqual(
+        {'hourly': 0.5, 'daily': 0.5, 'weekly': 1.5, 'monthly': 0.5,
+         'quarterly': 0.5},
+        self.Read(totals, 1001.5, at=(2026, 4, 1, 0, 5)))
+    self.assertEqual(
+        {'hourly': 0.25, 'daily': 0.75, 'weekly': 1.75, 'monthly': 0.75,
+         'quarterly': 0.75},
+        self.Read(totals, 1001.75, at=(2026, 4, 1, 1, 0)))
+
+  def testResetMeterCarriesOn(self):
+    totals = self.Totals()
+    self.Read(totals, 1000)
+    self.assertEqual(2, self.Read(totals, 1002)['daily'])
+    self.assertEqual(2, self.Read(totals, 0.5)['daily'])
+    self.assertEqual(2.5, self.Read(totals, 1)['daily'])
+
+  def testCheckpoints(self):
+    totals = self.Totals(self.path)
+    self.Read(totals, 1000)
+    self.assertFalse(os.path.exists(self.path))
+    self.Read(totals, 1001, at=(2026, 3, 31, 10, 16))
+    self.assertEqual(1001, self.Saved())
+    # Not again within the interval,
+    self.Read(totals, 1002, at=(2026, 3, 31, 10, 16))
+    self.assertEqual(1001, self.Saved())
+    # unless a period starts.
+    self.Read(totals, 1003, at=(2026, 3, 31, 11, 0))
+    self.assertEqual(1003, self.Saved())
+    self.Read(totals, 1004)
+    totals.Save()
+    self.assertEqual(1004, self.Saved())
+    # Picks up where the checkpoint left off.
+    self.assertEqual(
+        {'hourly': 3, 'daily': 5, 'weekly': 5, 'monthly': 5, 'quarterly': 5},
+        self.Read(self.Totals(self.path), 1005))
+    self.assertEqual(['energy.json'], os.listdir(self.tmp))
+
+  def testRelativePath(self):
+    cwd = os.getcwd()
+    os.chdir(self.tmp)
+    self.addCleanup(os.chdir, cwd)
+    totals = self.Totals('energy.json')
+    self.Read(totals, 1000)
+    self.Read(totals, 1001, at=(2026, 3, 31, 10, 16))
+    self.assertEqual(1001, self.Saved())
+
+  def testFailedSaveIsReportedAndRetried(self):
+    missing = os.path.join(self.tmp, 'missing')
+    self.path = os.path.join(missing, 'energy.json')
+    totals = self.Totals(self.path)
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+      self.Read(totals, 1000)
+      self.assertEqual(1, self.Read(
+          totals, 1001, at=(2026, 3, 31, 10, 16))['hourly'])
+      self.assertFalse(totals.Save())
+    self.assertIn('Saving the energy totals to', out.getvalue())
+    os.mkdir(missing)
+    self.assertTrue(totals.Save())
+    self.assertEqual(1001, self.Saved())
+
+
+if __name__ == '__main__':
+  unittest.main()
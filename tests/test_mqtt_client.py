@@ -0,0 +1,114 @@
+"""Tests MqttClient against the broker stand-in."""
+
+import asyncio
+import unittest
+
+import domoticz_bridge
+from tests import mqtt_broker
+
+
+class MqttClientTest(unittest.TestCase):
+
+  def Run(self, test):
+    """Runs test(broker, Client) with a broker up, in an event loop."""
+    broker = mqtt_broker.Broker()
+
+    async def Main():
+      await broker.Start()
+      clients = []
+
+      async def Client(client_id, **kwargs):
+        client = domoticz_bridge.MqttClient(
+            '127.0.0.1', broker.port, client_id=client_id, **kwargs)
+        await client.Connect()
+        clients.append(client)
+        return client
+
+      try:
+        return await test(broker, Client)
+      finally:
+        for client in clients:
+          await client.Close()
+        await broker.Close()
+
+    return asyncio.run(Main())
+
+  def testPublishesToSubscribers(self):
+    async def Test(broker, Client):
+      sub = await Client('sub')
+      await sub.Subscribe('domoticz/out/+/status')
+      pub = await Client('pub')
+      await pub.Publish('domoticz/out/light/status', '{ "state": "on" }')
+      await pub.Publish('domoticz/out', 'not subscribed')
+      await pub.Publish('domoticz/out/sensor/status', b'\xff' * 20000)
+      return [m async for m in sub.Messages(idle=0.2)]
+
+    self.assertEqual(
+        [('domoticz/out/light/status', b'{ "state": "on" }'),
+         ('domoticz/out/sensor/status', b'\xff' * 20000)],
+        self.Run(Test))
+
+  def testRetainedMessages(self):
+    async def Test(broker, Client):
+      pub = await Client('pub')
+      await pub.Publish('a/b', 'kept', retain=True)
+      await pub.Publish('a/c', 'kept too', retain=True)
+      await pub.Publish('a/c', b'', retain=True)
+      await pub.Publish('a/d', 'gone')
+      await pub.Close()
+      await broker.Settle()
+      sub = await Client('sub')
+      await sub.Subscribe('a/#')
+      return [m async for m in sub.Messages(idle=0.2)], broker.published
+
+    received, published = self.Run(Test)
+    self.assertEqual([('a/b', b'kept')], received)
+    self.assertEqual(
+        [('pub', 'a/b', True), ('pub', 'a/c', True), ('pub', 'a/c', True),
+         ('pub', 'a/d', False)],
+        [(p.client_id, p.topic, p.retain) for p in published])
+
+  def testUnsubscribe(self):
+    async def Test(broker, Client):
+      sub = await Client('sub')
+      await sub.Subscribe('a/+')
+      await sub.Unsubscribe('a/+')
+      pub = await Client('pub')
+      await pub.Publish('a/b', 'missed')
+      return [m async for m in sub.Messages(idle=0.2)]
+
+    self.assertEqual([], self.Run(Test))
+
+  def testCredentials(self):
+    async def Test(broker, Client):
+      await Client('anonymous')
+      await Client('user', username='hass', password='secret')
+      return broker.connected
+
+    self.assertEqual(
+        [('anonymous', None, None), ('user', 'hass', 'secret')],
+        self.Run(Test))
+
+  def testRefusedConnection(self):
+    async def Refuse(reader, writer):
+      await reader.read(1024)
+      writer.write(b'\x20\x02\x00\x05')  # CONNACK, not authorized
+      await writer.drain()
+
+    async def Main():
+      server = await asyncio.start_server(Refuse, '127.0.0.1', 0)
+      client = domoticz_bridge.MqttClient(
+          '127.0.0.1', server.sockets[0].getsockname()[1])
+      try:
+        with self.assertRaises(domoticz_bridge.MqttError):
+          await client.Connect()
+      finally:
+        await client.Close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(Main())
+
+
+if __name__ == '__main__':
+  unittest.main()
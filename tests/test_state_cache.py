@@ -0,0 +1,98 @@
+"""Tests which states StateCache lets the bridge publish."""
+
+import unittest
+
+import domoticz_bridge
+
+TOPIC = 'domoticz/out/sensor/12/status'
+
+
+class Clock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class StateCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+
+  def Cache(self, deadbands=None, min_intervals=None):
+    return domoticz_bridge.StateCache(deadbands, min_intervals, self.clock)
+
+  def testPublishesOnChange(self):
+    cache = self.Cache()
+    self.assertTrue(cache.Check(TOPIC, '{"temperature": 20.5 }'))
+    self.assertFalse(cache.Check(TOPIC, '{"temperature": 20.5 }'))
+    self.assertTrue(cache.Check(TOPIC, '{"temperature": 20.6 }'))
+    # Topics are kept apart.
+    self.assertTrue(cache.Check(TOPIC + '2', '{"temperature": 20.6 }'))
+    self.assertEqual((3, 1), (cache.published, cache.suppressed))
+
+  def testSameJsonIsNotAChange(self):
+    cache = self.Cache()
+    self.assertTrue(cache.Check(TOPIC, '{"temperature": 20.5 }'))
+    self.assertFalse(cache.Check(TOPIC, '{"temperature":20.5}'))
+
+  def testDeadband(self):
+    cache = self.Cache({'temperature': 0.5})
+    state = '{{"temperature": {}, "humidity": {} }}'.format
+    self.assertTrue(cache.Check(TOPIC, state(20.0, 40)))
+    self.assertFalse(cache.Check(TOPIC, state(20.4, 40)))
+    # Compared with what was published, not with what was dropped.
+    self.assertTrue(cache.Check(TOPIC, state(20.6, 40)))
+    self.assertFalse(cache.Check(TOPIC, state(20.2, 40)))
+    # Fields without a deadband publish on any change.
+    self.assertTrue(cache.Check(TOPIC, state(20.6, 41)))
+
+  def testDeadbandOfPlainPayloads(self):
+    # They are a field named after the last level of their topic.
+    topic = 'domoticz/out/climate/7/temp'
+    cache = self.Cache({'temp': 1})
+    self.assertTrue(cache.Check(topic, '68.0'))
+    self.assertFalse(cache.Check(topic, '68.9'))
+    self.assertTrue(cache.Check(topic, '69.5'))
+    cache = self.Cache({'mode': 1})
+    self.assertTrue(cache.Check('x/mode', 'heat'))
+    self.assertTrue(cache.Check('x/mode', 'cool'))
+
+  def testChangedFieldsPublish(self):
+    cache = self.Cache({'temperature': 5})
+    self.assertTrue(cache.Check(TOPIC, '{"temperature": 20 }'))
+    self.assertTrue(cache.Check(TOPIC, '{"temperature": 21, "humidity": 40 }'))
+    self.assertTrue(cache.Check(TOPIC, '{"temperature": "21" }'))
+
+  def testMinInterval(self):
+    cache = self.Cache(min_intervals={'watts': 10})
+    self.assertTrue(cache.Check(TOPIC, '{"kwh": 1.0, "watts": 100 }'))
+    self.clock.now += 5
+    self.assertFalse(cache.Check(TOPIC, '{"kwh": 1.0, "watts": 150 }'))
+    # Other fields are not held back.
+    self.assertTrue(cache.Check(TOPIC, '{"kwh": 1.1, "watts": 150 }'))
+    self.clock.now += 5
+    self.assertFalse(cache.Check(TOPIC, '{"kwh": 1.1, "watts": 160 }'))
+    self.clock.now += 5
+    self.assertTrue(cache.Check(TOPIC, '{"kwh": 1.1, "watts": 160 }'))
+
+  def testDeadbandAndMinInterval(self):
+    cache = self.Cache({'watts': 20}, {'watts': 10})
+    self.assertTrue(cache.Check(TOPIC, '{"watts": 100 }'))
+    self.clock.now += 20
+    self.assertFalse(cache.Check(TOPIC, '{"watts": 110 }'))
+    self.assertTrue(cache.Check(TOPIC, '{"watts": 130 }'))
+    self.assertFalse(cache.Check(TOPIC, '{"watts": 200 }'))
+
+  def testRecordAndClear(self):
+    cache = self.Cache()
+    cache.Record(TOPIC, 'ON')
+    self.assertFalse(cache.Check(TOPIC, 'ON'))
+    cache.Clear()
+    self.assertTrue(cache.Check(TOPIC, 'ON'))
+
+
+if __name__ == '__main__':
+  unittest.main()
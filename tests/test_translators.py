@@ -0,0 +1,126 @@
+"""Tests the translators against what the automation templates render."""
+
+import functools
+import unittest
+
+import domoticz_bridge
+import generate_homeassistant_mqtt as gen
+
+
+class TranslatorTest(unittest.TestCase):
+
+  def testDimmer(self):
+    # {"state": "on", "brightness": {% with ... %}{{ d_val|int }} {% endwith %} }
+    self.assertEqual(
+        '{"state": "on", "brightness": 127  }',
+        domoticz_bridge.TranslateDimmer({'nvalue': 2, 'svalue1': '50'}))
+    self.assertIsNone(
+        domoticz_bridge.TranslateDimmer({'nvalue': 1, 'svalue1': '50'}))
+
+  def testSwitches(self):
+    on, off = {'nvalue': 1}, {'nvalue': 0}
+    self.assertEqual('ON', domoticz_bridge.TranslateBinarySensor(on))
+    self.assertEqual('OFF', domoticz_bridge.TranslateBinarySensor(off))
+    self.assertEqual('{"state": "LOCK" }', domoticz_bridge.TranslateLock(on))
+    self.assertEqual('{"state": "UNLOCK" }', domoticz_bridge.TranslateLock(off))
+    self.assertEqual('{ "state": "on" }', domoticz_bridge.TranslateLight(on))
+    self.assertEqual('{ "state": "off" }', domoticz_bridge.TranslateLight(off))
+    self.assertIsNone(domoticz_bridge.TranslateLight({'nvalue': 2}))
+
+  def testUtilitySensor(self):
+    self.assertEqual(
+        '{"kwh": 5123.456, "watts": 301.6 }',
+        domoticz_bridge.TranslateUtilitySensor(
+            {'svalue1': '301.6', 'svalue2': '5123456'}))
+
+  def testFilters(self):
+    self.assertEqual(20.0, domoticz_bridge.FloatFilter('20'))
+    self.assertEqual(68.0, domoticz_bridge.ToF('20'))
+    # Like jinja's float filter, what is not a number is 0.0.
+    self.assertEqual(0.0, domoticz_bridge.FloatFilter(''))
+
+  def testTemperatures(self):
+    msg = {'svalue1': '20.0', 'svalue2': '45', 'svalue4': '1013'}
+    translate = domoticz_bridge.TranslateTempHumidityBaro
+    self.assertEqual(
+        '{"temperature": 20.0, "humidity": 45, "barometer": 1013 }',
+        translate(domoticz_bridge.FloatFilter, msg))
+    self.assertEqual(
+        '{"temperature": 68.0, "humidity": 45, "barometer": 1013 }',
+        translate(domoticz_bridge.ToF, msg))
+    self.assertEqual(
+        '{"temperature": 68.0 }',
+        domoticz_bridge.TranslateTemp(domoticz_bridge.ToF, {'svalue1': '20'}))
+
+  def testWind(self):
+    msg = {'svalue2': 'NW', 'svalue3': '35', 'svalue4': '60', 'svalue6': '-5'}
+    self.assertEqual(
+        '{"windspeed": 35, "windgust": 60, "windchill": 23.0, '
+        '"direction": "NW" }',
+        domoticz_bridge.TranslateWind(domoticz_bridge.ToF, msg))
+
+  def testClimateTarget(self):
+    translate = functools.partial(
+        domoticz_bridge.TranslateClimateTarget, domoticz_bridge.ToF, 78.0)
+    self.assertEqual('68.0', translate({'svalue1': '20'}))
+    # A setpoint that is fahrenheit already is left alone.
+    self.assertEqual('70.0', translate({'svalue1': '70'}))
+
+  def testMode(self):
+    self.assertEqual(
+        'heating', domoticz_bridge.TRANSLATE_THERMOSTAT_STATE({'nvalue': 2}))
+    self.assertEqual(
+        '', domoticz_bridge.TRANSLATE_THERMOSTAT_STATE({'nvalue': 7}))
+
+  def testTranslateMessage(self):
+    table = {5: (('light', domoticz_bridge.TranslateLight),
+                 ('dimmer', domoticz_bridge.TranslateDimmer)),
+             6: (('sensor', domoticz_bridge.TranslateUtilitySensor),)}
+    translate = lambda payload: list(
+        domoticz_bridge.TranslateMessage(table, payload))
+    self.assertEqual(
+        [('dimmer', '{"state": "on", "brightness": 51  }')],
+        translate(b'{"idx": 5, "nvalue": 2, "svalue1": "20"}'))
+    self.assertEqual(
+        [('light', '{ "state": "on" }')], translate(b'{"idx": 5, "nvalue": 1}'))
+    # Bad messages, unknown devices and missing fields publish nothing.
+    self.assertEqual([], translate(b'{"idx": 5'))
+    self.assertEqual([], translate(b'[5]'))
+    self.assertEqual([], translate(b'{"idx": 7, "nvalue": 1}'))
+    self.assertEqual([], translate(b'{"idx": 6, "nvalue": 0}'))
+
+  def testTranslate(self):
+    translators = [('a', domoticz_bridge.TranslateDimmer),
+                   ('b', domoticz_bridge.TranslateBinarySensor)]
+    self.assertEqual(
+        [('b', 'ON')],
+        list(domoticz_bridge.Translate(translators, {'nvalue': 1})))
+
+  def testFailingTranslatorOnlyCostsItsTopic(self):
+    def Fail(msg):
+      raise RuntimeError('broken')
+
+    self.assertEqual(
+        [('b', 'ON')],
+        list(domoticz_bridge.Translate(
+            [('a', Fail), ('b', domoticz_bridge.TranslateBinarySensor)],
+            {'nvalue': 1})))
+
+  def testDeviceStateMessage(self):
+    dimmer, meter = gen.ParseDevices({'result': [
+        {'idx': '3', 'Name': 'Hall', 'Type': 'Light/Switch',
+         'SwitchType': 'Dimmer', 'Status': 'Set Level: 40 %', 'Level': 40},
+        {'idx': '4', 'Name': 'Meter', 'Type': 'General', 'SubType': 'kWh',
+         'Usage': '301.6 Watt', 'Data': '5123.456 kWh'}]})['result']
+    msg = domoticz_bridge.DeviceStateMessage(dimmer)
+    self.assertEqual({'idx': 3, 'nvalue': 2, 'svalue1': '40'}, msg)
+    self.assertEqual(
+        '{"state": "on", "brightness": 102  }',
+        domoticz_bridge.TranslateDimmer(msg))
+    self.assertEqual(
+        {'idx': 4, 'nvalue': 0, 'svalue1': '301.6', 'svalue2': '5123456.0'},
+        domoticz_bridge.DeviceStateMessage(meter))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,103 @@
+"""Tests that every --yaml_backend writes what yaml.dump does."""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+import benchmark
+import generate_homeassistant_mqtt as gen
+
+BACKENDS = ['fast', 'libyaml', 'python']
+
+
+def Dumped(data, delimitor_line):
+  """What DumpAndSpaceYaml wrote before the backends, with yaml.dump."""
+  yaml.add_representer(
+      gen.UnsortableOrderedDict,
+      yaml.representer.SafeRepresenter.represent_dict)
+  lines = []
+  for l in yaml.dump(data, default_flow_style=False, width=240).split('\n'):
+    if delimitor_line in l:
+      lines.append('')
+    lines.append(l)
+  return '\n'.join(lines)
+
+
+class YamlBackendTest(unittest.TestCase):
+
+  def Written(self, data, delimitor_line, backend):
+    out = io.StringIO()
+    writer = gen.YamlWriter(
+        out, delimitor_line, mapping=isinstance(data, dict), backend=backend)
+    if isinstance(data, dict):
+      for key, value in sorted(data.items(), key=lambda i: i[0]):
+        writer.WriteItem(key, value)
+    else:
+      for entry in data:
+        writer.Write(entry)
+    writer.Close()
+    return out.getvalue()
+
+  def assertDumpedAlike(self, data, delimitor_line='name'):
+    expected = Dumped(data, delimitor_line)
+    for backend in BACKENDS:
+      if backend == 'libyaml' and not yaml.__with_libyaml__:
+        continue
+      with self.subTest(backend=backend):
+        self.assertEqual(expected, self.Written(data, delimitor_line, backend))
+
+  def testGeneratedEntries(self):
+    tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp)
+    input_json = os.path.join(tmp, 'devices.json')
+    with open(input_json, 'w') as f:
+      json.dump(benchmark.SynthesizeDevices(300), f)
+    gen.args = gen.parser.parse_args(['--input_json', input_json])
+    generator = gen.ConfigGenerator(to_f=gen.args.fahrenheit)
+    generator.Load(gen.GetDeviceViews(None))
+    # Scenes are only generated with --scenes, from domoticz itself.
+    names = [name for name in gen.OUTPUT_NAMES if name != 'scene']
+    outputs = generator.Outputs(names)
+    for name in names:
+      self.assertTrue(outputs[name], name)
+      with self.subTest(output=name):
+        self.assertDumpedAlike(outputs[name])
+
+  def testQuoting(self):
+    values = [
+        'on', 'off', 'yes', 'No', 'true', 'null', '~', '', '12', '-3', '1.5',
+        '0x1f', '1e3', '2020-01-02', '12:30', 'plain text', 'it\'s',
+        '"quoted"', ' leading', 'trailing ', 'a: b', 'a #b', 'café', 'a\nb',
+        '{{ value_json.nvalue }}']
+    # Every indicator yaml has, leading a value.
+    values += [c + 'x' for c in '#,[]{}&*!|>\'"%@`-?:']
+    self.assertDumpedAlike([{'name': v, 'value': v} for v in values])
+    self.assertDumpedAlike([[v] for v in values])
+    self.assertDumpedAlike(dict((v or 'empty', {'name': v}) for v in values))
+
+  def testKeys(self):
+    keys = ['k' * 99, 'k' * 100, 'k' * 150, '', 'on', '12', '#k', 'a b']
+    self.assertDumpedAlike([{key: 'value'} for key in keys])
+    self.assertDumpedAlike([{'name': 'x', 'nested': {key: [key]}}
+                            for key in keys])
+    self.assertDumpedAlike(dict((key, {'name': key}) for key in keys))
+
+  def testLineWidth(self):
+    # Lines around 240 columns, where yaml starts folding, at two indents.
+    entries = []
+    for width in range(230, 250):
+      for word in ('x', 'word '):
+        value = (word * width)[:width - len('- name: ')].strip()
+        entries.append({'name': value})
+        entries.append({'name': 'x', 'nested': {'name': value}})
+        entries.append([value, "'" + value])
+    self.assertDumpedAlike(entries)
+
+
+if __name__ == '__main__':
+  unittest.main()